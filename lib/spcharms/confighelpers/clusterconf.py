@@ -0,0 +1,106 @@
+"""
+A StorPool Juju charm helper module for the structured form of the StorPool
+configuration: cluster-wide settings plus per-host overrides, rendered for
+a single host at a time.
+"""
+import socket
+
+import yaml
+
+
+def host_names(hostname=None):
+    """
+    Return the full and the short name of the specified host or this one.
+    """
+    if hostname is None:
+        hostname = socket.gethostname()
+    return [hostname, hostname.split('.', 1)[0]]
+
+
+def format_value(value):
+    """
+    Format a single setting for the StorPool configuration file.
+    """
+    if isinstance(value, bool):
+        return 'true' if value else 'false'
+    return str(value)
+
+
+def check_section(name, section):
+    """
+    Make sure that a section is a dictionary of scalar values.
+    """
+    if section is None:
+        return {}
+    if not isinstance(section, dict):
+        raise ValueError('"{name}" should be a dictionary'.format(name=name))
+    for key, value in section.items():
+        if not isinstance(key, str) or '=' in key or not key.strip():
+            raise ValueError('invalid key "{key}" in "{name}"'
+                             .format(key=key, name=name))
+        if isinstance(value, (dict, list)) or value is None:
+            raise ValueError('invalid value for "{key}" in "{name}"'
+                             .format(key=key, name=name))
+    return section
+
+
+def parse(text):
+    """
+    Parse the YAML structured configuration: a "common" dictionary of
+    settings and a "hosts" dictionary of per-host overrides.
+    """
+    try:
+        data = yaml.safe_load(text)
+    except yaml.YAMLError as e:
+        raise ValueError('invalid YAML: {e}'.format(e=e))
+    if data is None:
+        data = {}
+    if not isinstance(data, dict) or \
+            not set(data.keys()).issubset(set(['common', 'hosts'])):
+        raise ValueError('expected a dictionary with "common" and "hosts"')
+
+    hosts = data.get('hosts') or {}
+    if not isinstance(hosts, dict):
+        raise ValueError('"hosts" should be a dictionary')
+    return {
+        'common': check_section('common', data.get('common')),
+        'hosts': dict((str(name), check_section(str(name), section))
+                      for (name, section) in hosts.items()),
+    }
+
+
+def render_lines(section):
+    """
+    Render the settings in a section as "KEY=value" lines.
+    """
+    return ['{key}={value}'.format(key=key, value=format_value(section[key]))
+            for key in sorted(section.keys())]
+
+
+def render(data, hostname=None, verbatim=''):
+    """
+    Render the common settings, any verbatim configuration text, and
+    this host's section, if there is one.
+    """
+    text = ''.join(line + '\n' for line in render_lines(data['common']))
+    if verbatim:
+        text += verbatim if verbatim.endswith('\n') else verbatim + '\n'
+    for name in host_names(hostname):
+        section = data['hosts'].get(name)
+        if section is not None:
+            text += '\n[{name}]\n'.format(name=name)
+            text += ''.join(line + '\n' for line in render_lines(section))
+            break
+    return text
+
+
+def effective_conf(text, structured, hostname=None):
+    """
+    Combine the verbatim StorPool configuration and the structured one
+    rendered for this host into the contents of the configuration file.
+    The structured common settings come first, so that they may be
+    overridden by the host sections in the verbatim text.
+    """
+    if not structured:
+        return text or ''
+    return render(parse(structured), hostname, verbatim=text or '')
@@ -0,0 +1,155 @@
+"""
+A StorPool Juju charm helper module for reading the StorPool configuration
+file: index the offsets of the common section and of this host's section
+and only parse those when a key is first looked up, keeping a single
+snapshot of the file per hook.
+"""
+import re
+import socket
+
+from spcharms.confighelpers import files as spcfiles
+
+STORPOOL_CONF = '/etc/storpool.conf'
+
+RE_SECTION = re.compile(br'^[ \t]*\[([^\]\n]*)\][ \t]*$', re.M)
+
+_SNAPSHOTS = {}
+
+
+def parse_value(value):
+    """
+    Strip the whitespace and any matching quotes from a value.
+    """
+    value = value.strip()
+    if len(value) > 1 and value[0] == value[-1] and value[0] in '"\'':
+        value = value[1:-1]
+    return value
+
+
+class IndexedConfig(object):
+    """
+    A StorPool configuration file indexed by section.  Only the common
+    section (the part before the first section header) and the sections
+    named after this host are ever parsed, and only when needed.
+    """
+
+    def __init__(self, data, hostname=None):
+        if hostname is None:
+            hostname = socket.gethostname()
+        self.data = data
+        self.hostnames = set([hostname, hostname.split('.', 1)[0]])
+        self.common = None
+        self.host = []
+        self._values = None
+
+        start = 0
+        name = None
+        for m in RE_SECTION.finditer(data):
+            self._add_section(name, start, m.start())
+            name = m.group(1).decode('UTF-8').strip()
+            start = m.end()
+        self._add_section(name, start, len(data))
+
+    def _add_section(self, name, start, end):
+        """
+        Record the byte offsets of a section if we care about it.
+        """
+        if name is None:
+            self.common = (start, end)
+        elif name in self.hostnames:
+            self.host.append((start, end))
+
+    def _parse(self, start, end, values):
+        """
+        Parse the "VAR=value" lines in the specified part of the file.
+        """
+        for line in self.data[start:end].decode('UTF-8').split('\n'):
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            parts = line.split('=', 1)
+            if len(parts) != 2:
+                continue
+            values[parts[0].strip()] = parse_value(parts[1])
+
+    def _resolve(self):
+        """
+        Parse the common section and this host's sections.
+        """
+        if self._values is None:
+            values = {}
+            for (start, end) in [self.common] + self.host:
+                self._parse(start, end, values)
+            self._values = values
+        return self._values
+
+    def get(self, key, default=None):
+        """
+        Look up a value, this host's sections overriding the common one.
+        """
+        return self._resolve().get(key, default)
+
+    def __getitem__(self, key):
+        return self._resolve()[key]
+
+    def __contains__(self, key):
+        return key in self._resolve()
+
+    def __len__(self):
+        return len(self._resolve())
+
+    def as_dict(self):
+        """
+        Return all the values that apply to this host.
+        """
+        return dict(self._resolve())
+
+    def validate(self):
+        """
+        Return a list of problems with the configuration.
+        """
+        res = []
+        oid = self.get('SP_OURID')
+        if oid is None:
+            res.append('no SP_OURID for this host')
+        elif not oid.isdigit():
+            res.append('invalid SP_OURID "{oid}"'.format(oid=oid))
+        return res
+
+
+def get_config(path=STORPOOL_CONF, hostname=None):
+    """
+    Return the snapshot of the StorPool configuration file, only reading
+    it again if it has changed since the snapshot was taken.
+    """
+    key = spcfiles.stat_key(path)
+    snap = _SNAPSHOTS.get(path)
+    if key is not None and snap is not None and snap[0] == key and \
+            (hostname is None or hostname in snap[1].hostnames):
+        return snap[1]
+
+    with open(path, mode='rb') as f:
+        cfg = IndexedConfig(f.read(), hostname=hostname)
+    if key is not None:
+        _SNAPSHOTS[path] = (key, cfg)
+    return cfg
+
+
+def index_text(text, hostname=None):
+    """
+    Index the contents of a StorPool configuration file that has not been
+    written out yet.
+    """
+    return IndexedConfig(text.encode('UTF-8'), hostname=hostname)
+
+
+def remember(cfg, path=STORPOOL_CONF):
+    """
+    Use an already indexed configuration as the snapshot of the file
+    that it has just been written to.
+    """
+    key = spcfiles.stat_key(path)
+    if key is not None and key[1] == len(cfg.data):
+        _SNAPSHOTS[path] = (key, cfg)
+    else:
+        _SNAPSHOTS.pop(path, None)
@@ -0,0 +1,186 @@
+"""
+A StorPool Juju charm helper module for choosing the CPU cores dedicated to
+the StorPool services: whole cores, preferably on the NUMA nodes of
+the StorPool network interfaces, confined via the storpool.slice systemd
+unit so that the services do not compete with the rest of the host.
+"""
+import os
+import re
+import subprocess
+
+from charmhelpers.core import unitdata
+
+from spcharms.confighelpers import dpkg as spcdpkg
+from spcharms.confighelpers import files as spcfiles
+from spcharms.confighelpers import ifspec as spcifspec
+from spcharms.confighelpers import irq as spcirq
+from spcharms.confighelpers import log as spclog
+from spcharms.confighelpers import perf as spcperf
+from spcharms.confighelpers import tuning as spctuning
+
+SYS_CPU = 'sys/devices/system/cpu'
+
+SLICE_DROPIN = \
+    '/etc/systemd/system/storpool.slice.d/storpool-config-cpus.conf'
+
+KV_CPUSET = 'storpool-config.cpuset'
+
+# The first systemd version that supports AllowedCPUs= for slices.
+MIN_SYSTEMD_VERSION = 244
+
+
+def rdebug(s, *args, **kwargs):
+    """
+    Pass the diagnostic message string `s` to the central diagnostic logger,
+    formatting it with any arguments only if it is going to be logged.
+    """
+    spclog.rdebug(s, *args, **kwargs)
+
+
+def systemd_version(path=spcdpkg.DPKG_STATUS):
+    """
+    Return the major version of the installed systemd package or None if
+    it cannot be determined.
+    """
+    version = spcdpkg.installed_packages(path).get('systemd', '')
+    match = re.match(r'(?:[0-9]+:)?([0-9]+)', version)
+    return int(match.group(1)) if match else None
+
+
+def unsupported(sysroot='/', dpkg_status=spcdpkg.DPKG_STATUS):
+    """
+    Return the reason why the StorPool services cannot be confined to
+    some CPUs on this host or None if they can: the storpool.slice drop-in
+    needs the unified cgroup hierarchy and a systemd version that supports
+    AllowedCPUs=.
+    """
+    if not spcirq.cgroup_unified(sysroot):
+        return 'storpool_cores needs the unified cgroup hierarchy (cgroup v2)'
+    version = systemd_version(dpkg_status)
+    if version is None or version < MIN_SYSTEMD_VERSION:
+        return 'storpool_cores needs systemd {min} or later, found {ver}' \
+            .format(min=MIN_SYSTEMD_VERSION,
+                    ver=version if version is not None else 'none')
+    return None
+
+
+def cpu_nodes(sysroot='/'):
+    """
+    Return the NUMA node of each CPU.
+    """
+    base = os.path.join(sysroot, spcirq.SYS_NODE)
+    try:
+        names = os.listdir(base)
+    except OSError:
+        return {}
+    res = {}
+    for name in sorted(names):
+        if not name.startswith('node') or not name[4:].isdigit():
+            continue
+        cpus = spcirq.read_cpulist(os.path.join(base, name, 'cpulist'))
+        for cpu in cpus or []:
+            res[cpu] = int(name[4:])
+    return res
+
+
+def cpu_cores(sysroot='/'):
+    """
+    Group the online CPUs into physical cores, each one a dictionary with
+    the NUMA node and the sorted list of its hardware threads.
+    """
+    nodes = cpu_nodes(sysroot)
+    cores = {}
+    for cpu in spcirq.node_cpus(None, sysroot=sysroot):
+        topo = os.path.join(sysroot, SYS_CPU, 'cpu{cpu}'.format(cpu=cpu),
+                            'topology')
+        key = (
+            spctuning.read_sys_int(os.path.join(topo, 'physical_package_id'),
+                                   0),
+            spctuning.read_sys_int(os.path.join(topo, 'core_id'), cpu),
+        )
+        core = cores.setdefault(key, {'node': nodes.get(cpu, -1), 'cpus': []})
+        core['cpus'].append(cpu)
+    for core in cores.values():
+        core['cpus'].sort()
+    return sorted(cores.values(), key=lambda core: core['cpus'][0])
+
+
+def nic_nodes(ifaces, sysroot='/'):
+    """
+    Return the NUMA nodes of the physical network interfaces behind
+    the StorPool ones, the node with the most interfaces first.
+    """
+    devices = spcifspec.build_model(ifaces, sysroot=sysroot)
+    counts = {}
+    for iface in sorted(devices.keys()):
+        if devices[iface]['kind'] != 'phys':
+            continue
+        node = spctuning.read_sys_int(
+            os.path.join(sysroot, spctuning.SYS_CLASS_NET, iface, 'device',
+                         'numa_node'), -1)
+        if node >= 0:
+            counts[node] = counts.get(node, 0) + 1
+    return sorted(counts.keys(), key=lambda node: (-counts[node], node))
+
+
+def plan(ifaces, count, sysroot='/'):
+    """
+    Choose `count` whole cores for the StorPool services: first the ones on
+    the NUMA nodes of the StorPool interfaces, then any others, from
+    the highest-numbered down so that the first CPUs, which the kernel
+    and the boot-time services favour, are left alone.  Raise a ValueError
+    if that would not leave at least one core for the rest of the host.
+    """
+    cores = cpu_cores(sysroot)
+    if count >= len(cores):
+        raise ValueError('cannot dedicate {count} of the {total} CPU cores '
+                         'to StorPool'.format(count=count, total=len(cores)))
+    nodes = nic_nodes(ifaces, sysroot)
+    rank = dict((node, idx) for (idx, node) in enumerate(nodes))
+    ordered = sorted(cores, key=lambda core: (
+        rank.get(core['node'], len(rank)), -core['cpus'][0]))
+    chosen = ordered[:count]
+    return {
+        'nodes': nodes,
+        'cpus': sorted(cpu for core in chosen for cpu in core['cpus']),
+    }
+
+
+def render_dropin(cpus):
+    """
+    Render the storpool.slice drop-in that confines the StorPool services
+    to the specified CPUs; leave it empty if there are none.
+    """
+    if not cpus:
+        return spcfiles.SNIPPET_HEADER
+    return spcfiles.SNIPPET_HEADER + '[Slice]\nAllowedCPUs={cpus}\n' \
+        .format(cpus=spcirq.format_cpulist(cpus))
+
+
+def planned_cpus():
+    """
+    Return the CPUs last dedicated to the StorPool services.
+    """
+    return unitdata.kv().get(KV_CPUSET, [])
+
+
+def apply(cpus):
+    """
+    Install the storpool.slice drop-in for the specified CPUs (None to
+    lift the restriction) and record them.  Return True if the StorPool
+    CPU set has changed.
+    """
+    cpus = list(cpus or [])
+    if cpus or os.path.exists(SLICE_DROPIN):
+        if spcfiles.install(SLICE_DROPIN, render_dropin(cpus)):
+            rdebug('updated {path}, reloading systemd', path=SLICE_DROPIN)
+            spcperf.count_procs()
+            subprocess.call(['systemctl', 'daemon-reload'])
+
+    if cpus == planned_cpus():
+        return False
+    if cpus:
+        unitdata.kv().set(KV_CPUSET, cpus)
+    else:
+        unitdata.kv().unset(KV_CPUSET)
+    return True
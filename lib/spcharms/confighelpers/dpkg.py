@@ -0,0 +1,73 @@
+"""
+A StorPool Juju charm helper module for checking whether the requested
+versions of some packages are already installed by looking at the dpkg
+status database directly instead of running apt or dpkg.
+"""
+from spcharms.confighelpers import files as spcfiles
+
+DPKG_STATUS = '/var/lib/dpkg/status'
+
+_cache = {}
+
+
+def parse_status(data):
+    """
+    Parse the contents of a dpkg status file into a dictionary of
+    the installed packages' versions keyed by package name.
+    """
+    res = {}
+    for para in data.split('\n\n'):
+        name = None
+        version = None
+        installed = False
+        for line in para.split('\n'):
+            if line.startswith('Package:'):
+                name = line[8:].strip()
+            elif line.startswith('Version:'):
+                version = line[8:].strip()
+            elif line.startswith('Status:'):
+                installed = line[7:].split()[-1:] == ['installed']
+        if name is not None and version is not None and installed:
+            res[name] = version
+    return res
+
+
+def installed_packages(path=DPKG_STATUS):
+    """
+    Return the installed packages' versions, only reading the dpkg status
+    file again if it has been modified since the last time.
+    """
+    key = spcfiles.stat_key(path)
+    if key is None:
+        return {}
+    cached = _cache.get(path)
+    if cached is not None and cached[0] == key:
+        return cached[1]
+
+    with open(path, mode='r', encoding='UTF-8', errors='replace') as f:
+        res = parse_status(f.read())
+    _cache[path] = (key, res)
+    return res
+
+
+def version_matches(wanted, version):
+    """
+    Check whether an installed package version satisfies the requested
+    one: "*" matches anything, otherwise either the exact version or
+    one that starts with the requested one followed by a separator.
+    """
+    if wanted == '*' or wanted == version:
+        return True
+    return version.startswith(wanted) and \
+        version[len(wanted):len(wanted) + 1] in ('.', '-', '+', '~')
+
+
+def missing(packages, path=DPKG_STATUS):
+    """
+    Return the packages from the `packages` dictionary (name: version)
+    that are not installed in the requested versions.
+    """
+    installed = installed_packages(path)
+    return dict((name, version) for (name, version) in packages.items()
+                if name not in installed or
+                not version_matches(version, installed[name]))
@@ -0,0 +1,88 @@
+"""
+A StorPool Juju charm helper module for checking whether the network
+configuration files and settings that the layer manages have been changed
+behind its back.  It only needs stat calls and sysfs reads, so it does not
+load the modules that actually write the network configuration.
+"""
+import os
+
+from charmhelpers.core import unitdata
+
+from spcharms.confighelpers import files as spcfiles
+from spcharms.confighelpers import tuning as spctuning
+
+KV_INTERFACES_CACHE = 'storpool-config.interfaces-cache'
+KV_NETWORK_DESIRED = 'storpool-config.network-desired'
+KV_MANAGED_FILES = 'storpool-config.managed-files'
+
+
+def file_drifted(path, rec):
+    """
+    Check whether a file that we manage has been modified since we last
+    wrote it.  Only read it if its inode number, size, or modification
+    time have changed; if the contents are still the same, update
+    the record in place.
+    """
+    st = spcfiles.stat_key(path)
+    if st == rec['stat']:
+        return False
+    if st is None:
+        return True
+    try:
+        with open(path, mode='r') as f:
+            contents = f.read()
+    except (IOError, OSError):
+        return True
+    if spcfiles.contents_digest(contents) != rec['digest']:
+        return True
+    rec['stat'] = st
+    return False
+
+
+def config_drift():
+    """
+    Return the network configuration files and directories that have
+    been modified since we last examined or wrote them, using only stat
+    calls unless a file we wrote looks different.
+    """
+    kv = unitdata.kv()
+    res = []
+    managed = kv.get(KV_MANAGED_FILES, {})
+    updated = False
+    for path in sorted(managed.keys()):
+        old = managed[path]['stat']
+        if file_drifted(path, managed[path]):
+            res.append(path)
+        elif managed[path]['stat'] != old:
+            updated = True
+    if updated:
+        kv.set(KV_MANAGED_FILES, managed)
+
+    cache = kv.get(KV_INTERFACES_CACHE)
+    if cache is not None:
+        for fname, rec in sorted(cache.get('files', {}).items()):
+            if spcfiles.stat_key(fname) != rec['stat']:
+                res.append(fname)
+        for pattern, rec in sorted(cache.get('globs', {}).items()):
+            dirname = os.path.dirname(pattern)
+            if spcfiles.stat_key(dirname) != rec['stat']:
+                res.append(dirname)
+    return res
+
+
+def mtu_drift(sysroot='/'):
+    """
+    Return the StorPool interfaces whose live MTU differs from the desired
+    one, only reading it from sysfs.
+    """
+    desired = unitdata.kv().get(KV_NETWORK_DESIRED, {})
+    res = []
+    for iface in sorted(desired.keys()):
+        mtu = desired[iface].get('mtu')
+        if mtu is None:
+            continue
+        current = spctuning.read_sys_int(os.path.join(
+            sysroot, spctuning.SYS_CLASS_NET, iface, 'mtu'))
+        if current is not None and current != int(mtu):
+            res.append(iface)
+    return res
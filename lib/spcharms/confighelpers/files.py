@@ -0,0 +1,84 @@
+"""
+A StorPool Juju charm helper module for the files that the layer examines
+and manages: summarizing their state for cheap change detection and
+installing small configuration snippets via txn so that they may be
+rolled back when the charm is removed.
+"""
+import hashlib
+import os
+import tempfile
+
+from charmhelpers.core import unitdata
+
+from spcharms.confighelpers import lazy as spclazy
+from spcharms.confighelpers import perf as spcperf
+
+# Only needed when actually installing a file, not for the stat checks.
+txn = spclazy.module('spcharms.txn')
+
+SNIPPET_HEADER = '# Managed by the storpool-config charm layer.\n'
+
+
+def stat_key(path):
+    """
+    Return a summary of the inode number, size, and modification time of
+    the specified file or directory or None if it does not exist.  It is
+    a list, so that it compares equal to one stored in the unit's
+    key/value store.
+    """
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return [st.st_ino, st.st_size, st.st_mtime_ns]
+
+
+def contents_digest(contents):
+    """
+    Return a digest of the contents of a configuration file.
+    """
+    return hashlib.sha256(contents.encode('UTF-8')).hexdigest()
+
+
+def record_file(record, path, contents):
+    """
+    Remember the state of a file that we manage in the `record` dictionary
+    in the unit's key/value store, so that it may be checked for drift.
+    """
+    managed = unitdata.kv().get(record, {})
+    managed[path] = {
+        'stat': stat_key(path),
+        'digest': contents_digest(contents),
+    }
+    unitdata.kv().set(record, managed)
+
+
+def install(path, contents, mode='644', record=None):
+    """
+    Install a snippet using txn unless it already has the specified
+    contents.  If `record` is specified, remember the state of the file
+    under that key for the drift check.  Return True if the file was
+    modified.
+    """
+    try:
+        with open(path, mode='r') as f:
+            if f.read() == contents:
+                if record is not None:
+                    record_file(record, path, contents)
+                return False
+    except (IOError, OSError):
+        pass
+
+    dirname = os.path.dirname(path)
+    if not os.path.isdir(dirname):
+        os.makedirs(dirname, mode=0o755)
+    with tempfile.NamedTemporaryFile(dir=dirname, prefix='.storpool-',
+                                     mode='w+t') as tempf:
+        tempf.write(contents)
+        tempf.flush()
+        with spcperf.measure('txn-install', procs=1):
+            txn.install('-o', 'root', '-g', 'root', '-m', mode, '--',
+                        tempf.name, path)
+    if record is not None:
+        record_file(record, path, contents)
+    return True
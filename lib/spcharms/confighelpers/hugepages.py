@@ -0,0 +1,204 @@
+"""
+A StorPool Juju charm helper module for reserving the hugepages that
+the StorPool services need, computed from the StorPool configuration:
+persistently through sysctl.d and kernel command line snippets and,
+as early as possible, at runtime on each NUMA node.
+"""
+import os
+import subprocess
+
+from spcharms.confighelpers import files as spcfiles
+from spcharms.confighelpers import log as spclog
+from spcharms.confighelpers import perf as spcperf
+from spcharms.confighelpers import tuning as spctuning
+
+SYS_NODE = 'sys/devices/system/node'
+SYS_HUGEPAGES = 'sys/kernel/mm/hugepages'
+PROC_COMPACT_MEMORY = 'proc/sys/vm/compact_memory'
+
+PAGE_SIZE_KB = 2048
+
+SYSCTL_SNIPPET = '/etc/sysctl.d/60-storpool-hugepages.conf'
+GRUB_SNIPPET = '/etc/default/grub.d/60-storpool-hugepages.cfg'
+
+# The settings that take memory from the hugepages pool: the cache of
+# each storpool_server instance in megabytes and the number of instances.
+CACHE_SIZE_VAR = 'SP_CACHE_SIZE'
+INSTANCES_VAR = 'SP_SERVER_INSTANCES'
+
+
+def rdebug(s, *args, **kwargs):
+    """
+    Pass the diagnostic message string `s` to the central diagnostic logger,
+    formatting it with any arguments only if it is going to be logged.
+    """
+    spclog.rdebug(s, *args, **kwargs)
+
+
+def required_mb(cfg):
+    """
+    Return the number of megabytes of hugepages that the StorPool services
+    on this host need.  Raise a ValueError if the settings are invalid.
+    """
+    cache = cfg.get(CACHE_SIZE_VAR, None)
+    if cache is None or cache == '':
+        return 0
+    try:
+        cache = int(cache)
+        instances = int(cfg.get(INSTANCES_VAR, None) or 1)
+    except ValueError:
+        raise ValueError('invalid {cache} or {inst} value'
+                         .format(cache=CACHE_SIZE_VAR, inst=INSTANCES_VAR))
+    if cache < 0 or instances < 1:
+        raise ValueError('invalid {cache} or {inst} value'
+                         .format(cache=CACHE_SIZE_VAR, inst=INSTANCES_VAR))
+    return cache * instances
+
+
+def pool_dir(page_kb=PAGE_SIZE_KB):
+    """
+    Return the name of the sysfs directory for the hugepages of
+    the specified size.
+    """
+    return 'hugepages-{size}kB'.format(size=page_kb)
+
+
+def numa_nodes(sysroot='/', page_kb=PAGE_SIZE_KB):
+    """
+    Return the NUMA nodes that have a pool of hugepages of the specified
+    size or None if the kernel does not report any.
+    """
+    base = os.path.join(sysroot, SYS_NODE)
+    try:
+        names = os.listdir(base)
+    except OSError:
+        return None
+    nodes = []
+    for name in names:
+        if not name.startswith('node') or not name[4:].isdigit():
+            continue
+        if os.path.isdir(os.path.join(base, name, 'hugepages',
+                                      pool_dir(page_kb))):
+            nodes.append(int(name[4:]))
+    return sorted(nodes) or None
+
+
+def nr_hugepages_path(node, sysroot='/', page_kb=PAGE_SIZE_KB):
+    """
+    Return the path to the hugepages count of a NUMA node or of the whole
+    system if `node` is None.
+    """
+    if node is None:
+        return os.path.join(sysroot, SYS_HUGEPAGES, pool_dir(page_kb),
+                            'nr_hugepages')
+    return os.path.join(sysroot, SYS_NODE, 'node{node}'.format(node=node),
+                        'hugepages', pool_dir(page_kb), 'nr_hugepages')
+
+
+def plan(cfg, sysroot='/', page_kb=PAGE_SIZE_KB):
+    """
+    Compute the number of hugepages to reserve on each NUMA node, spreading
+    them evenly.  Return None if the StorPool services need none.
+    """
+    mb = required_mb(cfg)
+    if mb == 0:
+        return None
+    pages = -(-mb * 1024 // page_kb)
+    nodes = numa_nodes(sysroot, page_kb)
+    if nodes is None:
+        per_node = {None: pages}
+    else:
+        count = -(-pages // len(nodes))
+        per_node = dict((node, count) for node in nodes)
+    return {
+        'page_kb': page_kb,
+        'total': sum(per_node.values()),
+        'nodes': per_node,
+    }
+
+
+def write_sys(path, value):
+    """
+    Write a single value to a sysfs or procfs file.  Return False if that
+    could not be done.
+    """
+    try:
+        with open(path, mode='w') as f:
+            f.write('{value}\n'.format(value=value))
+        return True
+    except (IOError, OSError) as e:
+        rdebug('could not write {value} to {path}: {e}',
+               value=value, path=path, e=e)
+        return False
+
+
+def reserve(hplan, sysroot='/'):
+    """
+    Reserve the planned hugepages at runtime, compacting the memory first
+    so that there are as many free contiguous pages as possible.  Never
+    reduce an existing reservation.  Return the wanted and the actually
+    reserved number of pages for each NUMA node.
+    """
+    pending = []
+    for (node, wanted) in hplan['nodes'].items():
+        path = nr_hugepages_path(node, sysroot, hplan['page_kb'])
+        if spctuning.read_sys_int(path, 0) < wanted:
+            pending.append((path, wanted))
+
+    if pending:
+        write_sys(os.path.join(sysroot, PROC_COMPACT_MEMORY), 1)
+        for (path, wanted) in sorted(pending):
+            write_sys(path, wanted)
+
+    return dict((node, {
+        'wanted': wanted,
+        'reserved': spctuning.read_sys_int(
+            nr_hugepages_path(node, sysroot, hplan['page_kb']), 0),
+    }) for (node, wanted) in hplan['nodes'].items())
+
+
+def shortfall(report):
+    """
+    Return the number of pages that could not be reserved.
+    """
+    return sum(max(0, rec['wanted'] - rec['reserved'])
+               for rec in report.values())
+
+
+def render_snippets(hplan):
+    """
+    Render the sysctl.d and the kernel command line snippets that make
+    the reservation persistent; they are left empty if no hugepages are
+    needed.
+    """
+    header = spcfiles.SNIPPET_HEADER
+    if hplan is None:
+        return {
+            SYSCTL_SNIPPET: header,
+            GRUB_SNIPPET: header,
+        }
+    size = '{mb}M'.format(mb=hplan['page_kb'] // 1024)
+    return {
+        SYSCTL_SNIPPET: header + 'vm.nr_hugepages = {total}\n'
+                                 .format(total=hplan['total']),
+        GRUB_SNIPPET: header + 'GRUB_CMDLINE_LINUX_DEFAULT='
+                               '"$GRUB_CMDLINE_LINUX_DEFAULT '
+                               'hugepagesz={size} hugepages={total}"\n'
+                               .format(size=size, total=hplan['total']),
+    }
+
+
+def persist(hplan):
+    """
+    Install the snippets, skipping the ones that would only say that
+    nothing is needed if they are not there yet, and regenerate the boot
+    loader configuration if the kernel command line changed.
+    """
+    for (path, contents) in sorted(render_snippets(hplan).items()):
+        if hplan is None and not os.path.exists(path):
+            continue
+        if spcfiles.install(path, contents):
+            rdebug('updated {path}', path=path)
+            if path == GRUB_SNIPPET:
+                spcperf.count_procs()
+                subprocess.call(['update-grub'])
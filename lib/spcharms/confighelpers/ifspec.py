@@ -0,0 +1,95 @@
+"""
+A StorPool Juju charm helper module for parsing the SP_IFACE setting into
+a model of the StorPool network interfaces, their VLAN parents and their
+bond slaves, along with the MTU that each of them needs.
+"""
+import os
+
+SYS_CLASS_NET = 'sys/class/net'
+
+DEFAULT_MTU = 9000
+
+
+def parse_sp_iface(value):
+    """
+    Parse an SP_IFACE value ("eth0=9000,bond0.100,eth1.200=1500") into
+    a list of (name, MTU) pairs.
+    """
+    res = []
+    for iface_data in value.split(','):
+        iface_data = iface_data.strip()
+        if not iface_data:
+            continue
+        parts = iface_data.split('=', 1)
+        if len(parts) == 2:
+            mtu = int(parts[1])
+        else:
+            mtu = DEFAULT_MTU
+        res.append((parts[0], mtu))
+    return res
+
+
+def bond_slaves(iface, sysroot='/'):
+    """
+    Return the slaves of a bonding interface or None if it is not one.
+    """
+    path = os.path.join(sysroot, SYS_CLASS_NET, iface, 'bonding', 'slaves')
+    try:
+        with open(path, mode='r') as f:
+            return sorted(f.read().split())
+    except (IOError, OSError):
+        return None
+
+
+def build_model(value, sysroot='/'):
+    """
+    Build a model of the StorPool network interfaces from the SP_IFACE
+    value: a dictionary keyed by interface name, each value a dictionary
+    with the interface kind ("vlan", "bond", or "phys"), the MTU it needs
+    (the largest one required by itself or anything stacked on top of it),
+    its VLAN parent, and its bond slaves.
+    """
+    devices = {}
+
+    def add(name, mtu):
+        """
+        Record an interface and make sure that its MTU and the MTU of
+        its VLAN parent, if any, are large enough.
+        """
+        dev = devices.get(name)
+        if dev is None:
+            dev = {
+                'name': name,
+                'kind': 'phys',
+                'mtu': mtu,
+                'parent': None,
+                'slaves': [],
+            }
+            parts = name.rsplit('.', 1)
+            if len(parts) == 2 and parts[1].isdigit():
+                dev['kind'] = 'vlan'
+                dev['parent'] = parts[0]
+            devices[name] = dev
+        elif dev['mtu'] < mtu:
+            dev['mtu'] = mtu
+
+        if dev['parent'] is not None:
+            add(dev['parent'], mtu)
+
+    for (name, mtu) in parse_sp_iface(value):
+        add(name, mtu)
+
+    # Propagate the MTUs down from the bonds to their slaves.
+    for name in sorted(devices.keys()):
+        dev = devices[name]
+        if dev['kind'] == 'vlan':
+            continue
+        slaves = bond_slaves(name, sysroot)
+        if slaves is None:
+            continue
+        dev['kind'] = 'bond'
+        dev['slaves'] = slaves
+        for slave in slaves:
+            add(slave, dev['mtu'])
+
+    return devices
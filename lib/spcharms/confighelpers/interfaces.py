@@ -0,0 +1,190 @@
+"""
+A StorPool Juju charm helper module for parsing /etc/network/interfaces-like
+files into a model of their interface stanzas and included files and for
+caching that model between runs.
+"""
+import glob
+import os
+
+from spcharms.confighelpers import files as spcfiles
+
+# Bumped whenever the parsed model changes, so that the models cached by
+# an older version of the layer are not used.
+MODEL_VERSION = 2
+
+
+def is_new_stanza(s):
+    """
+    Check if a line starting with the `s` word actually starts a new
+    stanza in an /etc/network/interfaces-like file.
+    """
+    if s in ('iface', 'mapping', 'auto', 'source', 'source-directory'):
+        return True
+    return s.startswith('allow-')
+
+
+def parse_file(fname):
+    """
+    Parse an /etc/network/interfaces-like file into a dictionary:
+    - stanzas: a list of the "iface" stanzas, each one a dictionary with
+      the interface name, the stripped option lines, the index of
+      the "iface" line itself, and the index of the line before which
+      any new option lines should be inserted
+    - includes: a list of [directive, pattern] pairs for the "source" and
+      "source-directory" directives
+    - lines: the number of lines in the file
+    - eol: false if the last line of the file is not terminated
+    """
+    stanzas = []
+    includes = []
+    current = None
+    count = 0
+    eol = True
+    with open(fname, mode='r') as f:
+        for idx, ln in enumerate(f):
+            count = idx + 1
+            eol = ln.endswith('\n')
+            words = ln.split()
+            if not words:
+                continue
+
+            if current is not None:
+                if not is_new_stanza(words[0]):
+                    current['options'].append(ln.strip())
+                    continue
+                current['insert'] = idx
+                current = None
+
+            if len(words) < 2:
+                continue
+            if words[0] == 'iface':
+                current = {
+                    'iface': words[1],
+                    'options': [],
+                    'start': idx,
+                    'insert': None,
+                }
+                stanzas.append(current)
+            elif words[0] in ('source', 'source-directory'):
+                includes.append([words[0], words[1]])
+
+    if current is not None:
+        current['insert'] = count
+    return {
+        'stanzas': stanzas,
+        'includes': includes,
+        'lines': count,
+        'eol': eol,
+    }
+
+
+def option_changes(model, data, managed=None):
+    """
+    Return a list of the changes needed to bring the interface stanzas in
+    the parsed file `model` in line with the option lines in the `data`
+    dictionary, in file order.  Each change is a dictionary with
+    the "start" and "insert" indices of the stanza, the option lines to
+    "add" before the "insert" one, and the option lines to "remove": the ones
+    that the `managed(iface, line)` function recognizes as ours, but that
+    are no longer wanted.
+    """
+    res = []
+    for stanza in model['stanzas']:
+        iface = stanza['iface']
+        wanted = data.get(iface)
+        if wanted is None:
+            continue
+        add = [line for line in wanted if line not in stanza['options']]
+        if managed is not None:
+            remove = [line for line in stanza['options']
+                      if line not in wanted and managed(iface, line)]
+        else:
+            remove = []
+        if add or remove:
+            res.append({
+                'start': stanza['start'],
+                'insert': stanza['insert'],
+                'add': add,
+                'remove': remove,
+            })
+    return res
+
+
+class InterfacesCache(object):
+    """
+    Keep the parsed models of the network interface configuration files
+    and the results of expanding the "source" and "source-directory"
+    patterns, keyed by the path and validated by the inode number, size,
+    and modification time of the file or directory.
+    """
+
+    def __init__(self, data=None):
+        if data is None or data.get('version') != MODEL_VERSION:
+            data = {}
+        self.files = dict(data.get('files', {}))
+        self.globs = dict(data.get('globs', {}))
+        self.dirty = False
+
+    def to_dict(self):
+        """
+        Return a serializable representation of the cached data.
+        """
+        return {
+            'version': MODEL_VERSION,
+            'files': self.files,
+            'globs': self.globs,
+        }
+
+    def get_file(self, fname):
+        """
+        Return the parsed model of a file, only parsing it again if it has
+        changed since the last time.
+        """
+        st = spcfiles.stat_key(fname)
+        cached = self.files.get(fname)
+        if cached is not None and st is not None and cached['stat'] == st:
+            return cached['model']
+
+        model = parse_file(fname)
+        if st is not None:
+            self.files[fname] = {'stat': st, 'model': model}
+        else:
+            self.files.pop(fname, None)
+        self.dirty = True
+        return model
+
+    def forget(self, fname):
+        """
+        Drop the cached model of a file that is about to be modified.
+        """
+        if self.files.pop(fname, None) is not None:
+            self.dirty = True
+
+    def resolve(self, directive, pattern):
+        """
+        Return the list of files included by a "source" or
+        "source-directory" directive.
+        """
+        if directive == 'source-directory':
+            pattern = pattern + '/*'
+        if not glob.has_magic(pattern):
+            return [pattern] if os.path.isfile(pattern) else []
+
+        dirname = os.path.dirname(pattern)
+        if glob.has_magic(dirname):
+            return sorted(filter(lambda s: os.path.isfile(s),
+                                 glob.glob(pattern)))
+
+        st = spcfiles.stat_key(dirname)
+        cached = self.globs.get(pattern)
+        if cached is not None and st is not None and cached['stat'] == st:
+            return cached['files']
+
+        files = sorted(filter(lambda s: os.path.isfile(s),
+                              glob.glob(pattern)))
+        if st is not None:
+            self.globs[pattern] = {'stat': st, 'files': files}
+        else:
+            self.globs.pop(pattern, None)
+        self.dirty = True
+        return files
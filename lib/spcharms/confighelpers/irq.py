@@ -0,0 +1,378 @@
+"""
+A StorPool Juju charm helper module for placing the interrupts and
+the receive/transmit packet steering of the StorPool network interfaces
+on NUMA-local CPUs that are not used by the StorPool services.
+"""
+import os
+import re
+
+from spcharms.confighelpers import log as spclog
+
+
+PROC_INTERRUPTS = 'proc/interrupts'
+SYS_CLASS_NET = 'sys/class/net'
+SYS_NODE = 'sys/devices/system/node'
+SYS_CPU_ONLINE = 'sys/devices/system/cpu/online'
+
+CGROUP_CONTROLLERS = 'sys/fs/cgroup/cgroup.controllers'
+
+STORPOOL_CPUSET_V1 = 'sys/fs/cgroup/cpuset/storpool.slice/cpuset.cpus'
+STORPOOL_CPUSET_V2 = 'sys/fs/cgroup/storpool.slice/cpuset.cpus'
+
+IRQBALANCE_DROPIN = \
+    '/etc/systemd/system/irqbalance.service.d/storpool-config.conf'
+
+PIN_SCRIPT = '/usr/local/sbin/storpool-config-pin-irqs'
+POLICY_SCRIPT = '/usr/local/sbin/storpool-config-irqbalance-policy'
+
+HEADER = '# Generated by the storpool-config charm, do not edit.\n'
+
+# The interrupt numbers of a NIC's queues may change across reboots and
+# driver reloads, so the "post-up" command looks them up by name each time,
+# the same way nic_irqs() does.  SYSROOT is only set by the unit tests.
+PIN_SCRIPT_BODY = r'''
+# Usage: storpool-config-pin-irqs iface cpu...
+#
+# Spread the queue interrupts of a network interface over the CPUs.
+
+set -e
+
+iface="$1"
+shift
+[ "$#" -gt 0 ] || exit 0
+root="${SYSROOT:-}"
+
+devlink="$root/sys/class/net/$iface/device"
+pci=''
+if [ -e "$devlink" ]; then
+    pci="@pci:$(basename "$(readlink -f "$devlink")")"
+fi
+
+irqs="$(awk -v iface="$iface" -v pci="$pci" '
+    $1 ~ /^[0-9]+:$/ && $NF !~ /async/ {
+        act = $NF
+        n = length(act) - length(pci)
+        if (act == iface || index(act, iface "-") == 1 ||
+            (pci != "" && n >= 0 && substr(act, n + 1) == pci))
+            print substr($1, 1, length($1) - 1)
+    }' "$root/proc/interrupts")"
+if [ -z "$irqs" ] && [ -d "$devlink/msi_irqs" ]; then
+    irqs="$(ls "$devlink/msi_irqs" | sort -n)"
+fi
+
+nth()
+{
+    shift "$1"
+    echo "$1"
+}
+
+idx=0
+for irq in $irqs; do
+    cpu="$(nth "$((idx % $# + 1))" "$@")"
+    echo "$cpu" > "$root/proc/irq/$irq/smp_affinity_list" || true
+    idx="$((idx + 1))"
+done
+'''
+
+MANAGED_LINES = [
+    r'post-up ' + re.escape(PIN_SCRIPT) + r' {iface} ',
+    r'post-up /bin/sh -c \'echo \S+ > /sys/class/net/{iface}/queues/',
+]
+
+
+def rdebug(s, *args, **kwargs):
+    """
+    Pass the diagnostic message string `s` to the central diagnostic logger,
+    formatting it with any arguments only if it is going to be logged.
+    """
+    spclog.rdebug(s, *args, **kwargs)
+
+
+def parse_cpulist(value):
+    """
+    Parse a Linux CPU list string ("0-3,8,10-11") into a sorted list of
+    CPU numbers.
+    """
+    res = set()
+    for part in value.strip().split(','):
+        part = part.strip()
+        if not part:
+            continue
+        bounds = part.split('-', 1)
+        if len(bounds) == 2:
+            res.update(range(int(bounds[0]), int(bounds[1]) + 1))
+        else:
+            res.add(int(part))
+    return sorted(res)
+
+
+def format_cpulist(cpus):
+    """
+    Format a list of CPU numbers as a Linux CPU list string.
+    """
+    ranges = []
+    for cpu in sorted(set(cpus)):
+        if ranges and ranges[-1][1] == cpu - 1:
+            ranges[-1][1] = cpu
+        else:
+            ranges.append([cpu, cpu])
+    return ','.join(str(first) if first == last
+                    else '{first}-{last}'.format(first=first, last=last)
+                    for (first, last) in ranges)
+
+
+def cpu_mask(cpus):
+    """
+    Format a list of CPU numbers as a sysfs CPU bitmask: hexadecimal
+    32-bit words separated by commas.
+    """
+    mask = 0
+    for cpu in cpus:
+        mask |= 1 << cpu
+    words = []
+    while True:
+        words.append(mask & 0xffffffff)
+        mask >>= 32
+        if not mask:
+            break
+    return ','.join(['{w:x}'.format(w=words[-1])] +
+                    ['{w:08x}'.format(w=w) for w in reversed(words[:-1])])
+
+
+def read_cpulist(path):
+    """
+    Read a CPU list from a sysfs or cgroup file; return None if the file
+    does not exist or cannot be parsed.
+    """
+    try:
+        with open(path, mode='r') as f:
+            return parse_cpulist(f.read())
+    except (IOError, OSError, ValueError):
+        return None
+
+
+def cgroup_unified(sysroot='/'):
+    """
+    Check whether the host only uses the unified (v2) cgroup hierarchy.
+    """
+    return os.path.exists(os.path.join(sysroot, CGROUP_CONTROLLERS))
+
+
+def storpool_cpus(sysroot='/'):
+    """
+    Return the CPUs assigned to the StorPool services' cgroup, if any,
+    in the cgroup hierarchy that the host uses.
+    """
+    path = STORPOOL_CPUSET_V2 if cgroup_unified(sysroot) \
+        else STORPOOL_CPUSET_V1
+    return read_cpulist(os.path.join(sysroot, path)) or []
+
+
+def node_cpus(node, sysroot='/'):
+    """
+    Return the CPUs on the specified NUMA node or all the online CPUs if
+    the node is not known.
+    """
+    if node is not None and node >= 0:
+        cpus = read_cpulist(os.path.join(sysroot, SYS_NODE,
+                                         'node{node}'.format(node=node),
+                                         'cpulist'))
+        if cpus:
+            return cpus
+    cpus = read_cpulist(os.path.join(sysroot, SYS_CPU_ONLINE))
+    return cpus if cpus else []
+
+
+def nic_irqs(iface, sysroot='/'):
+    """
+    Find the queue interrupts of a network interface: the /proc/interrupts
+    entries named after the interface or its PCI device, or, failing that,
+    all of the device's MSI interrupts.
+    """
+    devlink = os.path.join(sysroot, SYS_CLASS_NET, iface, 'device')
+    if os.path.exists(devlink):
+        pci = '@pci:' + os.path.basename(os.path.realpath(devlink))
+    else:
+        pci = None
+
+    res = []
+    try:
+        with open(os.path.join(sysroot, PROC_INTERRUPTS), mode='r') as f:
+            for line in f:
+                fields = line.split()
+                if not fields or not fields[0].endswith(':'):
+                    continue
+                try:
+                    irq = int(fields[0][:-1])
+                except ValueError:
+                    continue
+                action = fields[-1]
+                if 'async' in action:
+                    continue
+                if action == iface or action.startswith(iface + '-') or \
+                        (pci is not None and action.endswith(pci)):
+                    res.append(irq)
+    except (IOError, OSError):
+        pass
+    if res:
+        return sorted(res)
+
+    msidir = os.path.join(devlink, 'msi_irqs')
+    try:
+        return sorted(int(name) for name in os.listdir(msidir)
+                      if name.isdigit())
+    except OSError:
+        return []
+
+
+def nic_queues(iface, prefix, sysroot='/'):
+    """
+    Return the sorted indices of the receive ("rx-") or transmit ("tx-")
+    queues of a network interface.
+    """
+    qdir = os.path.join(sysroot, SYS_CLASS_NET, iface, 'queues')
+    try:
+        names = os.listdir(qdir)
+    except OSError:
+        return []
+    return sorted(int(name[len(prefix):]) for name in names
+                  if name.startswith(prefix) and
+                  name[len(prefix):].isdigit())
+
+
+def plan_nic(iface, numa_node, exclude, sysroot='/'):
+    """
+    Compute the IRQ-to-CPU mapping and the RPS/XPS masks for a network
+    interface: its queue interrupts are spread over the CPUs on its NUMA
+    node that are not in the `exclude` list.  Return None if there is
+    nothing to do.
+    """
+    local = node_cpus(numa_node, sysroot)
+    cpus = [cpu for cpu in local if cpu not in set(exclude)]
+    if not cpus:
+        rdebug('no CPUs left for the {iface} interrupts', iface=iface)
+        return None
+
+    irqs = nic_irqs(iface, sysroot)
+    rx = nic_queues(iface, 'rx-', sysroot)
+    tx = nic_queues(iface, 'tx-', sysroot)
+    if not irqs and not rx and not tx:
+        return None
+
+    return {
+        'iface': iface,
+        'cpus': cpus,
+        'irqs': [[irq, cpus[idx % len(cpus)]]
+                 for (idx, irq) in enumerate(irqs)],
+        'rps': [[queue, cpu_mask(cpus)] for queue in rx],
+        'xps': [[queue, cpu_mask([cpus[queue % len(cpus)]])]
+                for queue in tx],
+    }
+
+
+def plan_files(plan, sysroot='/'):
+    """
+    Return a list of (path, value) pairs to write to apply the plan.
+    """
+    base = os.path.join(sysroot, SYS_CLASS_NET, plan['iface'], 'queues')
+    return [(os.path.join(sysroot, 'proc', 'irq', str(irq),
+                          'smp_affinity_list'), str(cpu))
+            for (irq, cpu) in plan['irqs']] + \
+        [(os.path.join(base, 'rx-{q}'.format(q=queue), 'rps_cpus'), mask)
+         for (queue, mask) in plan['rps']] + \
+        [(os.path.join(base, 'tx-{q}'.format(q=queue), 'xps_cpus'), mask)
+         for (queue, mask) in plan['xps']]
+
+
+def apply_plan(plan, sysroot='/'):
+    """
+    Apply the IRQ affinity and the RPS/XPS masks at runtime.  Return
+    the number of settings that could not be applied.
+    """
+    failed = 0
+    for (path, value) in plan_files(plan, sysroot):
+        try:
+            with open(path, mode='w') as f:
+                f.write(value + '\n')
+        except (IOError, OSError) as e:
+            rdebug('could not write {value} to {path}: {e}',
+                   value=value, path=path, e=e)
+            failed += 1
+    return failed
+
+
+def post_up_lines(plan):
+    """
+    Produce the "post-up" lines that apply the plan when the interface is
+    brought up: the interrupts are looked up by the pinning script then,
+    the queues' RPS/XPS masks are written directly.
+    """
+    res = []
+    if plan['irqs']:
+        res.append('post-up {script} {iface} {cpus} || true'
+                   .format(script=PIN_SCRIPT, iface=plan['iface'],
+                           cpus=' '.join(str(cpu) for cpu in plan['cpus'])))
+    if plan['rps'] or plan['xps']:
+        res.append('post-up /bin/sh -c \'{cmds}\' || true'.format(
+            cmds='; '.join('echo {value} > {path}'.format(value=value,
+                                                          path=path)
+                           for (path, value) in plan_files(
+                               dict(plan, irqs=[])))))
+    return res
+
+
+def render_pin_script():
+    """
+    Render the script that pins an interface's interrupts when it is
+    brought up.
+    """
+    return '#!/bin/sh\n' + HEADER + PIN_SCRIPT_BODY
+
+
+def render_policy_script(plans):
+    """
+    Render an irqbalance policy script that bans the interrupts of
+    the pinned interfaces' devices; irqbalance runs it for each interrupt
+    with the device's sysfs path, so it does not depend on the interrupt
+    numbers either.
+    """
+    ifaces = sorted(set(plan['iface'] for plan in plans if plan['irqs']))
+    return '#!/bin/sh\n' + HEADER + '''
+dev="$(readlink -f "$1")"
+for iface in {ifaces}; do
+    if [ "$(readlink -f "/sys/class/net/$iface/device")" = "$dev" ]; then
+        echo 'ban=true'
+        exit 0
+    fi
+done
+'''.format(ifaces=' '.join(ifaces))
+
+
+def irqbalance_dropin(plans):
+    """
+    Render a systemd drop-in for the irqbalance service that tells it to
+    leave the StorPool interfaces' interrupts alone.  The IRQBALANCE_ARGS
+    setting from /etc/default/irqbalance is still honored.  Return None if
+    there are no pinned interrupts.
+    """
+    if not any(plan['irqs'] for plan in plans):
+        return None
+    return '[Service]\nExecStart=\n' \
+        'ExecStart=/usr/sbin/irqbalance --foreground $IRQBALANCE_ARGS ' \
+        '--policyscript={script}\n'.format(script=POLICY_SCRIPT)
+
+
+def render_files(plans):
+    """
+    Return a dictionary of the files needed to apply the plans at boot
+    time, each value a (contents, mode) pair.  The irqbalance drop-in is
+    left without any settings if there are no pinned interrupts.
+    """
+    dropin = irqbalance_dropin(plans)
+    if dropin is None:
+        return {IRQBALANCE_DROPIN: (HEADER, '644')}
+    return {
+        PIN_SCRIPT: (render_pin_script(), '755'),
+        POLICY_SCRIPT: (render_policy_script(plans), '755'),
+        IRQBALANCE_DROPIN: (HEADER + dropin, '644'),
+    }
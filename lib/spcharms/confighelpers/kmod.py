@@ -0,0 +1,136 @@
+"""
+A StorPool Juju charm helper module for examining and unloading
+the StorPool kernel modules.
+"""
+import subprocess
+import time
+
+from spcharms.confighelpers import log as spclog
+from spcharms.confighelpers import perf as spcperf
+
+
+PROC_MODULES = '/proc/modules'
+
+
+def rdebug(s, *args, **kwargs):
+    """
+    Pass the diagnostic message string `s` to the central diagnostic logger,
+    formatting it with any arguments only if it is going to be logged.
+    """
+    spclog.rdebug(s, *args, **kwargs)
+
+
+def read_modules(path=PROC_MODULES):
+    """
+    Parse /proc/modules into a dictionary keyed by module name; each value
+    is a dictionary with the reference count and the list of the modules
+    that use this one.
+    """
+    res = {}
+    with open(path, mode='r') as f:
+        for line in f:
+            fields = line.split()
+            if len(fields) < 4:
+                continue
+            try:
+                refcount = int(fields[2])
+            except ValueError:
+                refcount = 0
+            users = [] if fields[3] == '-' else \
+                sorted(filter(None, fields[3].split(',')))
+            res[fields[0]] = {
+                'refcount': refcount,
+                'used_by': users,
+            }
+    return res
+
+
+def unload_order(mods, names):
+    """
+    Sort the specified modules so that each one comes after all the modules
+    that use it.  Return a (removable, blocked) tuple: the modules that may
+    be unloaded in that order and a dictionary of the ones that may not be
+    unloaded along with the reason why.
+    """
+    names = set(names)
+    blocked = {}
+    for name in sorted(names):
+        mod = mods[name]
+        others = [user for user in mod['used_by'] if user not in names]
+        if others:
+            blocked[name] = 'used by {users}'.format(users=' '.join(others))
+        elif mod['refcount'] > len(mod['used_by']):
+            blocked[name] = 'in use, reference count {cnt}' \
+                            .format(cnt=mod['refcount'])
+
+    # Anything used by a blocked module is blocked, too.
+    changed = True
+    while changed:
+        changed = False
+        for name in sorted(names - set(blocked.keys())):
+            held = [user for user in mods[name]['used_by']
+                    if user in blocked]
+            if held:
+                blocked[name] = 'used by {users}'.format(users=' '.join(held))
+                changed = True
+
+    left = names - set(blocked.keys())
+    order = []
+    while left:
+        ready = sorted(name for name in left
+                       if not set(mods[name]['used_by']) & left)
+        if not ready:
+            for name in sorted(left):
+                blocked[name] = 'circular dependency'
+            break
+        order.extend(ready)
+        left -= set(ready)
+    return (order, blocked)
+
+
+def unload_modules(prefix='storpool_', path=PROC_MODULES, attempts=3,
+                   delay=1):
+    """
+    Unload all the kernel modules whose names start with the specified
+    prefix, users first, with a single rmmod invocation per attempt.
+    Return a dictionary describing the modules that were removed and
+    the ones that are still loaded and why.
+    """
+    removed = []
+    blocked = {}
+    for attempt in range(attempts):
+        mods = read_modules(path)
+        names = [name for name in mods if name.startswith(prefix)]
+        if not names:
+            break
+        (order, blocked) = unload_order(mods, names)
+        if not order:
+            break
+
+        rdebug('trying to remove kernel modules: {mods}', mods=' '.join(order))
+        spcperf.count_procs()
+        subprocess.call(['rmmod', '--'] + order)
+
+        mods = read_modules(path)
+        gone = [name for name in order if name not in mods]
+        removed.extend(gone)
+        if len(gone) == len(order):
+            continue
+        if attempt + 1 < attempts:
+            time.sleep(delay)
+
+    mods = read_modules(path)
+    remaining = {}
+    for name in sorted(mods):
+        if not name.startswith(prefix):
+            continue
+        mod = mods[name]
+        remaining[name] = {
+            'refcount': mod['refcount'],
+            'used_by': mod['used_by'],
+            'reason': blocked.get(name, 'could not be unloaded'),
+        }
+    return {
+        'removed': removed,
+        'remaining': remaining,
+    }
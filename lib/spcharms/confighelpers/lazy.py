@@ -0,0 +1,46 @@
+"""
+A StorPool Juju charm helper module for deferring the import of modules
+that a reactive layer only needs within some of its handlers, so that
+the hooks that do not run those handlers do not pay for loading them.
+"""
+import importlib
+
+
+class LazyModule(object):
+    """
+    Import a module the first time one of its attributes is accessed.
+    """
+
+    def __init__(self, name):
+        self.__dict__['_lazy_name'] = name
+        self.__dict__['_lazy_module'] = None
+
+    def _lazy_load(self):
+        """
+        Import the module the same way "from package import name" would,
+        so that a module already set as an attribute of its package is
+        picked up.
+        """
+        module = self.__dict__['_lazy_module']
+        if module is None:
+            name = self.__dict__['_lazy_name']
+            (parent, _, base) = name.rpartition('.')
+            if parent:
+                module = getattr(importlib.import_module(parent), base, None)
+            if module is None:
+                module = importlib.import_module(name)
+            self.__dict__['_lazy_module'] = module
+        return module
+
+    def __getattr__(self, attr):
+        return getattr(self._lazy_load(), attr)
+
+    def __repr__(self):
+        return '<lazy module {name}>'.format(name=self.__dict__['_lazy_name'])
+
+
+def module(name):
+    """
+    Return a proxy for the specified module that imports it on first use.
+    """
+    return LazyModule(name)
@@ -0,0 +1,126 @@
+"""
+A StorPool Juju charm helper module for bringing the live state of
+the StorPool network interfaces (MTU, ring sizes, interrupt coalescing)
+in line with the desired one without waiting for the next ifup.
+"""
+import os
+import subprocess
+
+from spcharms.confighelpers import log as spclog
+from spcharms.confighelpers import perf as spcperf
+from spcharms.confighelpers import tuning as spctuning
+
+
+def rdebug(s, *args, **kwargs):
+    """
+    Pass the diagnostic message string `s` to the central diagnostic logger,
+    formatting it with any arguments only if it is going to be logged.
+    """
+    spclog.rdebug(s, *args, **kwargs)
+
+
+def current_state(iface, sysroot='/', ethtool=None, want_ethtool=True):
+    """
+    Examine the live state of a network interface; return None if it
+    does not exist.
+    """
+    if ethtool is None:
+        ethtool = spctuning.run_ethtool
+    base = os.path.join(sysroot, spctuning.SYS_CLASS_NET, iface)
+    if not os.path.isdir(base):
+        return None
+    res = {
+        'mtu': spctuning.read_sys_int(os.path.join(base, 'mtu')),
+        'ring': {},
+        'coalesce': {},
+    }
+    if want_ethtool:
+        output = ethtool('-g', iface)
+        if output is not None:
+            res['ring'] = spctuning.parse_rings(output)['current']
+        output = ethtool('-c', iface)
+        if output is not None:
+            res['coalesce'] = spctuning.parse_coalesce(output)
+    return res
+
+
+def changed_settings(wanted, current):
+    """
+    Return the (parameter, value) pairs from the `wanted` list whose
+    values differ from the ones in the `current` dictionary.
+    """
+    return [(key, value) for (key, value) in wanted
+            if key in current and str(current[key]) != str(value)]
+
+
+def plan_changes(desired, sysroot='/', ethtool=None):
+    """
+    Compare the desired state of the network interfaces with the live one
+    and return the "ip -batch" commands and the ethtool invocations needed
+    to reconcile them.  MTU decreases are applied children first and
+    increases parents first, so that a VLAN never has a larger MTU than
+    its underlying device.
+    """
+    lower = []
+    raise_ = []
+    ethtool_cmds = []
+    for iface in sorted(desired.keys()):
+        want = desired[iface]
+        want_ethtool = bool(want.get('ring') or want.get('coalesce'))
+        cur = current_state(iface, sysroot=sysroot, ethtool=ethtool,
+                            want_ethtool=want_ethtool)
+        if cur is None:
+            rdebug('no {iface} interface yet', iface=iface)
+            continue
+
+        mtu = want.get('mtu')
+        if mtu is not None and cur['mtu'] is not None and \
+                cur['mtu'] != int(mtu):
+            depth = iface.count('.')
+            entry = (depth, iface, 'link set dev {iface} mtu {mtu}'
+                     .format(iface=iface, mtu=mtu))
+            if int(mtu) < cur['mtu']:
+                lower.append(entry)
+            else:
+                raise_.append(entry)
+
+        for (option, key) in (('-G', 'ring'), ('-C', 'coalesce')):
+            changed = changed_settings(want.get(key, []), cur[key])
+            if changed:
+                ethtool_cmds.append(
+                    ['/sbin/ethtool', option, iface] +
+                    [str(item) for pair in changed for item in pair])
+
+    ip_cmds = [cmd for (_, _, cmd) in sorted(lower, reverse=True)] + \
+        [cmd for (_, _, cmd) in sorted(raise_)]
+    return {
+        'ip': ip_cmds,
+        'ethtool': ethtool_cmds,
+    }
+
+
+def apply_changes(changes):
+    """
+    Apply the changes computed by plan_changes(): a single "ip -batch"
+    invocation for all the MTU changes and a single ethtool invocation
+    for each group of settings of each interface.  Return the number of
+    commands that failed.
+    """
+    failed = 0
+    if changes['ip']:
+        rdebug('about to run ip -batch: {cmds}', cmds=changes['ip'])
+        spcperf.count_procs()
+        proc = subprocess.Popen(['/sbin/ip', '-force', '-batch', '-'],
+                                stdin=subprocess.PIPE)
+        proc.communicate(('\n'.join(changes['ip']) + '\n').encode())
+        if proc.returncode != 0:
+            rdebug('ip -batch failed with exit code {code}',
+                   code=proc.returncode)
+            failed += 1
+
+    for cmd in changes['ethtool']:
+        rdebug('about to run {cmd}', cmd=' '.join(cmd))
+        spcperf.count_procs()
+        if subprocess.call(cmd) != 0:
+            failed += 1
+    return failed
@@ -0,0 +1,54 @@
+"""
+A StorPool Juju charm helper module for the storpool-config layer's
+diagnostic messages: they are only formatted if the "debug_level" charm
+config option asks for them, and they are passed on to the central
+diagnostic logger one line at a time so that each line gets its prefix.
+"""
+from spcharms import config as spconfig
+from spcharms import utils as sputils
+
+INFO = 1
+DEBUG = 2
+TRACE = 3
+
+LEVELS = {
+    'info': INFO,
+    'debug': DEBUG,
+    'trace': TRACE,
+}
+
+DEFAULT_LEVEL = 'debug'
+
+PREFIX = 'config'
+
+_state = {'level': None}
+
+
+def current_level():
+    """
+    Return the verbosity level selected by the charm config.
+    """
+    if _state['level'] is None:
+        name = spconfig.m().get('debug_level', None)
+        _state['level'] = LEVELS.get(name, LEVELS[DEFAULT_LEVEL]) \
+            if isinstance(name, str) else LEVELS[DEFAULT_LEVEL]
+    return _state['level']
+
+
+def enabled(lvl=DEBUG):
+    """
+    Check whether messages of the specified level should be logged.
+    """
+    return lvl <= current_level()
+
+
+def rdebug(fmt, *args, level=DEBUG, **kwargs):
+    """
+    Log a diagnostic message, only formatting it with the specified
+    arguments if its level is enabled.
+    """
+    if not enabled(level):
+        return
+    text = fmt.format(*args, **kwargs) if args or kwargs else fmt
+    for line in text.split('\n'):
+        sputils.rdebug(line, prefix=PREFIX)
@@ -0,0 +1,150 @@
+"""
+A StorPool Juju charm helper module for rendering the StorPool network
+interface settings for hosts configured by netplan and systemd-networkd:
+a netplan overlay for the MTUs of the devices that the host's netplan
+configuration already defines and a networkd-dispatcher hook for
+the NIC tuning commands.
+"""
+import glob
+import os
+
+import yaml
+
+from spcharms.confighelpers import log as spclog
+
+NETPLAN_DIR = '/etc/netplan'
+NETPLAN_OVERLAY = '/etc/netplan/90-storpool-config.yaml'
+DISPATCHER_HOOK = '/etc/networkd-dispatcher/carrier.d/50-storpool-config'
+
+HEADER = '# Generated by the storpool-config charm, do not edit.\n'
+
+
+def rdebug(s, *args, **kwargs):
+    """
+    Pass the diagnostic message string `s` to the central diagnostic logger,
+    formatting it with any arguments only if it is going to be logged.
+    """
+    spclog.rdebug(s, *args, **kwargs)
+
+
+def detect(sysroot='/'):
+    """
+    Check whether the host's network is configured by netplan rather than
+    ifupdown: there are netplan configuration files and ifupdown itself
+    is not installed.
+    """
+    if os.path.exists(os.path.join(sysroot, 'sbin', 'ifup')):
+        return False
+    return bool(glob.glob(os.path.join(sysroot, 'etc', 'netplan', '*.yaml')))
+
+
+def read_definitions():
+    """
+    Read the device definitions from the host's netplan files, except for
+    our own overlay: a dictionary of the "ethernets", "vlans", and "bonds"
+    sections, each one a dictionary of the definitions keyed by their IDs.
+    """
+    res = {'ethernets': {}, 'vlans': {}, 'bonds': {}}
+    for fname in sorted(glob.glob(os.path.join(NETPLAN_DIR, '*.yaml'))):
+        if fname == NETPLAN_OVERLAY:
+            continue
+        try:
+            with open(fname, mode='r') as f:
+                network = (yaml.safe_load(f) or {}).get('network') or {}
+        except (IOError, OSError, AttributeError, yaml.YAMLError) as e:
+            rdebug('could not parse {fname}: {e}', fname=fname, e=e)
+            continue
+        for (section, defs) in res.items():
+            found = network.get(section)
+            if not isinstance(found, dict):
+                continue
+            for (ident, value) in found.items():
+                defs.setdefault(str(ident), {}).update(
+                    value if isinstance(value, dict) else {})
+    return res
+
+
+def linux_names(definitions):
+    """
+    Map the Linux names of the devices defined in netplan to their netplan
+    (section, ID) pairs.  Ethernet devices and bonds may be renamed or
+    matched by name; a VLAN is named after its ID, but it is also matched
+    by its VLAN ID and the Linux name of its link, e.g. "bond0.100".
+    """
+    res = {}
+    for section in ('ethernets', 'bonds'):
+        for ident in sorted(definitions[section].keys()):
+            value = definitions[section][ident]
+            name = value.get('set-name') or \
+                (value.get('match') or {}).get('name')
+            if name is None or glob.has_magic(str(name)):
+                name = ident
+            res.setdefault(str(name), (section, ident))
+    vlans = definitions['vlans']
+    for ident in sorted(vlans.keys()):
+        res.setdefault(ident, ('vlans', ident))
+
+    parents = dict((found[1], name) for (name, found) in res.items())
+    for ident in sorted(vlans.keys()):
+        parent = parents.get(str(vlans[ident].get('link')))
+        vid = vlans[ident].get('id')
+        if parent is not None and vid is not None:
+            res.setdefault('{parent}.{vid}'.format(parent=parent, vid=vid),
+                           ('vlans', ident))
+    return res
+
+
+def render_overlay(devices, definitions):
+    """
+    Render a netplan overlay that sets the MTU of the StorPool interfaces;
+    netplan merges it with the definitions in the rest of its files, so it
+    only refers to the devices that those already define, by the same IDs.
+    The MTUs of any other devices are only set by the dispatcher hook.
+    """
+    names = linux_names(definitions)
+    sections = {}
+    for name in sorted(devices.keys()):
+        found = names.get(name)
+        if found is None:
+            rdebug('{name} is not defined in netplan, only setting its MTU '
+                   'in the dispatcher hook', name=name)
+            continue
+        (section, ident) = found
+        sections.setdefault(section, {})[ident] = {
+            'mtu': devices[name]['mtu'],
+        }
+
+    network = {'version': 2}
+    network.update(sections)
+    return HEADER + yaml.safe_dump({'network': network},
+                                   default_flow_style=False)
+
+
+def render_hook(data):
+    """
+    Render a networkd-dispatcher hook that runs the same commands as
+    the ifupdown "post-up" lines when an interface gets a carrier.
+    """
+    lines = ['#!/bin/sh', HEADER.rstrip('\n'), '', 'case "$IFACE" in']
+    for iface in sorted(data.keys()):
+        cmds = [line[len('post-up '):] for line in data[iface]
+                if line.startswith('post-up ')]
+        if not cmds:
+            continue
+        lines.append('\t{iface})'.format(iface=iface))
+        lines.extend('\t\t' + cmd for cmd in cmds)
+        lines.append('\t\t;;')
+    lines.append('esac')
+    return '\n'.join(lines) + '\n'
+
+
+def render_files(devices, data):
+    """
+    Return a dictionary of the files to write, each value a (contents,
+    mode) pair.
+    """
+    return {
+        NETPLAN_OVERLAY: (render_overlay(devices, read_definitions()),
+                          '600'),
+        DISPATCHER_HOOK: (render_hook(data), '755'),
+    }
@@ -2,160 +2,398 @@
 A StorPool Juju charm helper module for parsing and updating the Ubuntu
 network interface configuration if needed.
 """
-import glob
 import os
+import re
+import shutil
+import subprocess
 import tempfile
 
+from charmhelpers.core import unitdata
+
+from spcharms.confighelpers import drift as spcdrift
+from spcharms.confighelpers import files as spcfiles
+from spcharms.confighelpers import ifspec as spcifspec
+from spcharms.confighelpers import interfaces as spcifaces
+from spcharms.confighelpers import irq as spcirq
+from spcharms.confighelpers import linkstate as spclinkstate
+from spcharms.confighelpers import log as spclog
+from spcharms.confighelpers import netplan as spcnetplan
+from spcharms.confighelpers import perf as spcperf
+from spcharms.confighelpers import tuning as spctuning
 from spcharms import txn
-from spcharms import utils as sputils
 
 vlandef = [
-    'post-up /sbin/ip link set dev {IF_VLAN_RAW_DEVICE} mtu {MTU}',
+    'post-up /sbin/ip link set dev {IF_VLAN_RAW_DEVICE} mtu {RAW_MTU}',
     'post-up /sbin/ip link set dev {IFACE} mtu {MTU}',
 ]
 nonvlandef = [
     'post-up /sbin/ip link set dev {IFACE} mtu {MTU}',
-    'post-up /sbin/ethtool -A {IFACE} autoneg off tx off rx on || true',
-    'post-up /sbin/ethtool -C {IFACE} rx-usecs 16 || true',
-    'post-up /sbin/ethtool -G {IFACE} rx 4096 tx 512 || true',
 ]
 
+# The option lines that we add to the StorPool interfaces' stanzas and
+# replace if the wanted ones change, e.g. when the tuning profile or
+# the hardware does.
+MANAGED_LINES = [
+    r'post-up /sbin/ip link set dev \S+ mtu \S+$',
+    r'post-up /sbin/ethtool -[ACG] {iface} ',
+] + spcirq.MANAGED_LINES
+
+# Compiled once instead of once per interface, which would overflow
+# the re module's cache on hosts with many interfaces.
+_MANAGED_RE = [re.compile(pattern.format(iface=r'(?P<iface>[^\s/]+)'))
+               for pattern in MANAGED_LINES]
+
+
+def rdebug(s, *args, **kwargs):
+    """
+    Pass the diagnostic message string `s` to the central diagnostic logger,
+    formatting it with any arguments only if it is going to be logged.
+    """
+    spclog.rdebug(s, *args, **kwargs)
+
+
+def managed_line(iface, line):
+    """
+    Check whether an option line in the stanza of the `iface` interface is
+    one that we manage.
+    """
+    for pattern in _MANAGED_RE:
+        match = pattern.match(line)
+        if match is not None and \
+                match.groupdict().get('iface', iface) == iface:
+            return True
+    return False
+
 
-def rdebug(s):
+def render_interfaces_file(fname, changes, target):
     """
-    Pass the diagnostic message string `s` to the central diagnostic logger.
+    Write the contents of the specified file with the option line changes
+    applied to its interface stanzas to the `target` file object.
     """
-    sputils.rdebug(s, prefix='config')
+    with open(fname, mode='r') as f:
+        lines = f.readlines()
+    if lines and not lines[-1].endswith('\n'):
+        lines[-1] += '\n'
+
+    inserts = {}
+    skip = set()
+    for change in changes:
+        inserts[change['insert']] = change['add']
+        remove = set(change['remove'])
+        skip.update(idx for idx in range(change['start'] + 1,
+                                         change['insert'])
+                    if lines[idx].strip() in remove)
+
+    for idx in range(len(lines) + 1):
+        for line in inserts.get(idx, []):
+            print(line, file=target)
+        if idx < len(lines) and idx not in skip:
+            print(lines[idx], file=target, end='')
+
+
+def commit_interfaces_changes(changes):
+    """
+    Write out all the modified network interface configuration files.
+    The new versions of all the files are first staged into temporary
+    directories next to the real ones and synced to disk, and then
+    the files in each directory are installed by a single txn invocation.
+    """
+    bydir = {}
+    for fname in sorted(changes.keys()):
+        bydir.setdefault(os.path.dirname(fname), []).append(fname)
+
+    staged = {}
+    try:
+        for basedir, fnames in sorted(bydir.items()):
+            stagedir = tempfile.mkdtemp(dir=basedir, prefix='.storpool-')
+            staged[basedir] = (stagedir, [])
+            for fname in fnames:
+                rdebug('Updating {fname}', fname=fname)
+                tempname = os.path.join(stagedir, os.path.basename(fname))
+                with open(tempname, mode='w') as tempf:
+                    render_interfaces_file(fname, changes[fname], tempf)
+                    tempf.flush()
+                    os.fsync(tempf.fileno())
+                shutil.copymode(fname, tempname)
+                staged[basedir][1].append(tempname)
+
+            dirfd = os.open(stagedir, os.O_RDONLY)
+            try:
+                os.fsync(dirfd)
+            finally:
+                os.close(dirfd)
+
+        for basedir, (stagedir, tempnames) in sorted(staged.items()):
+            rdebug('Installing {count} file(s) into {basedir}',
+                   count=len(tempnames), basedir=basedir)
+            with spcperf.measure('txn-install', procs=1):
+                txn.install(*(tempnames + [basedir]), exact=True)
+    finally:
+        for stagedir, _ in staged.values():
+            shutil.rmtree(stagedir, ignore_errors=True)
 
 
-def fixup_interfaces_file(fname, data, handled):
+def collect_interfaces_changes(fname, data, handled, cache, changes):
+    """
+    Look for the interfaces listed in the `data` dictionary in
+    an /etc/network/interfaces-like file and the files that it includes
+    and record any missing or stale option lines in the `changes`
+    dictionary.
+    """
+    if fname in handled:
+        return
+    rdebug('Trying to add interface data to {fname}', fname=fname)
+    handled.add(fname)
+
+    model = cache.get_file(fname)
+    found = spcifaces.option_changes(model, data, managed_line)
+    if found:
+        cache.forget(fname)
+        changes[fname] = found
+    else:
+        rdebug('No need to update {fname}', fname=fname)
+
+    for directive, pattern in model['includes']:
+        for new_fname in cache.resolve(directive, pattern):
+            collect_interfaces_changes(new_fname, data, handled, cache,
+                                       changes)
+
+
+def fixup_interfaces_file(fname, data, handled, cache=None):
     """
     Read an /etc/network/interfaces-like file, look for the interfaces
     listed in the `data` dictionary.  If any of them are found, check that
     they have all of the lines defined in the dictionary; otherwise add
-    the missing lines.
+    the missing lines and remove the ones that we added before, but are
+    no longer wanted.
 
     If the file contains a "source" or "source-directory" directive, process
-    the specified files recursively.
+    the specified files recursively.  All the modified files are written
+    out together once the whole tree has been examined.
+
+    The parsed files are kept in the `cache` object, so that files that
+    have not changed since the last run are not read again.
     """
-    if fname in handled:
-        return
-    rdebug('Trying to add interface data to {fname}'.format(fname=fname))
-    handled.add(fname)
+    if cache is None:
+        cache = spcifaces.InterfacesCache()
 
-    def is_new_stanza(s):
-        """
-        Check if a line starting with the `s` word actually starts a new
-        stanza in an /etc/network/interfaces-like file.
-        """
-        if s in ('iface', 'mapping', 'auto', 'source', 'source-directory'):
-            return True
-        return s.startswith('allow-')
+    changes = {}
+    collect_interfaces_changes(fname, data, handled, cache, changes)
+    if changes:
+        commit_interfaces_changes(changes)
+        # Cache the files and directories as we left them, so that
+        # the drift check does not mistake our changes for somebody else's.
+        collect_interfaces_changes(fname, data, set(), cache, {})
 
-    basedir = os.path.dirname(fname)
-    in_iface = ''
-    left = []
-    with open(fname, mode='r') as f:
-        with tempfile.NamedTemporaryFile(dir=basedir,
-                                         mode='w+t',
-                                         delete=True) as tempf:
-            updated = False
-
-            while True:
-                ln = f.readline()
-                if not ln:
-                    break
-                stripped = ln.strip()
-                words = stripped.split()
-                if not words:
-                    print(ln, file=tempf, end='')
-                    continue
-
-                if in_iface:
-                    if is_new_stanza(words[0]):
-                        for missing in left:
-                            print(missing, file=tempf)
-                            updated = True
-                        in_iface = False
-                    else:
-                        left = list(filter(lambda s: s != stripped, left))
-
-                print(ln, file=tempf, end='')
-
-                # A separate conditional, since we may fall through.
-                if not in_iface and len(words) > 1:
-                    if words[0] == 'iface' and words[1] in data:
-                        in_iface = words[1]
-                        left = data[in_iface]
-                    elif words[0] == 'source':
-                        for new_fname in filter(lambda s: os.path.isfile(s),
-                                                glob.glob(words[1])):
-                            fixup_interfaces_file(new_fname, data, handled)
-                    elif words[0] == 'source-directory':
-                        for new_fname in filter(lambda s: os.path.isfile(s),
-                                                glob.glob(words[1] + '/*')):
-                            fixup_interfaces_file(new_fname, data, handled)
-
-            if in_iface:
-                for missing in left:
-                    print(missing, file=tempf)
-                    updated = True
-
-            if updated:
-                rdebug('Updating {fname}'.format(fname=fname))
-                tempf.flush()
-                txn.install(tempf.name, fname, exact=True)
-            else:
-                rdebug('No need to update {fname}'.format(fname=fname))
-
-    rdebug('Done adding interface data to {fname}'.format(fname=fname))
-
-
-def fixup_interfaces(ifaces):
+    rdebug('Done adding interface data to {fname}', fname=fname)
+
+
+def nic_lines(iface, mtu, profile, sysroot, irq_exclude, result):
     """
-    Modify the system network configuration to add the post-up commands to
-    the StorPool interfaces.
+    Produce the "post-up" lines for a physical network interface: set
+    the MTU, tune the NIC according to the specified profile, and, if
+    `irq_exclude` is not None, pin its interrupts and packet steering to
+    local CPUs not in that list.  Record the desired state of the NIC and
+    the IRQ plan in the `result` dictionary.
     """
-    rdebug('fixup_interfaces invoked for {ifaces}'.format(ifaces=ifaces))
+    subst = {
+        'IFACE': iface,
+        'MTU': mtu,
+    }
+    info = spctuning.nic_info(iface, sysroot=sysroot)
+    rdebug('NIC info for {iface}: {info}', iface=iface, info=info,
+           level=spclog.TRACE)
+    settings = spctuning.nic_settings(profile, info)
+    res = list(map(lambda s: s.format(**subst), nonvlandef)) + \
+        spctuning.post_up_lines(iface, settings)
+    result['desired'][iface] = {
+        'mtu': int(mtu),
+        'ring': settings['ring'],
+        'coalesce': settings['coalesce'],
+    }
 
-    # Parse the interface names
-    data = {}
-    for iface_data in ifaces.split(','):
-        parts = iface_data.split('=', 1)
-        iface = parts[0]
-        if len(parts) == 2:
-            mtu = parts[1]
-        else:
-            mtu = '9000'
+    if irq_exclude is not None and info is not None:
+        plan = spcirq.plan_nic(iface, info['numa_node'], irq_exclude,
+                               sysroot=sysroot)
+        rdebug('IRQ plan for {iface}: {plan}', iface=iface, plan=plan,
+               level=spclog.TRACE)
+        if plan is not None:
+            result['plans'].append(plan)
+            res.extend(spcirq.post_up_lines(plan))
+    return res
 
-        parts = iface.split('.', 1)
-        if len(parts) == 2:
-            vlan = True
-            parent = parts[0]
+
+def setup_irqs(plans, sysroot='/'):
+    """
+    Apply the IRQ affinity and RPS/XPS plans at runtime, install
+    the script that pins the interrupts at boot time, and tell irqbalance
+    to leave the StorPool interfaces' interrupts alone.  If there are no
+    plans, make irqbalance manage them again.
+    """
+    for plan in plans:
+        failed = spcirq.apply_plan(plan, sysroot=sysroot)
+        if failed:
+            rdebug('could not apply {cnt} IRQ/RPS/XPS setting(s) for {iface}',
+                   cnt=failed, iface=plan['iface'])
+
+    files = spcirq.render_files(plans)
+    restart = False
+    for path in sorted(files.keys()):
+        (contents, mode) = files[path]
+        if not plans and not os.path.exists(path):
+            continue
+        if spcfiles.install(path, contents, mode=mode,
+                            record=spcdrift.KV_MANAGED_FILES) and \
+                path != spcirq.PIN_SCRIPT:
+            restart = True
+    if restart:
+        rdebug('updated the irqbalance ban list, restarting it')
+        spcperf.count_procs(2)
+        subprocess.call(['systemctl', 'daemon-reload'])
+        subprocess.call(['systemctl', 'try-restart', 'irqbalance.service'])
+
+
+def write_ifupdown(devices, data):
+    """
+    Add the post-up commands to the StorPool interfaces' stanzas in
+    the ifupdown configuration.
+    """
+    cache = spcifaces.InterfacesCache(
+        unitdata.kv().get(spcdrift.KV_INTERFACES_CACHE))
+    with spcperf.measure('fixup-interfaces-file'):
+        fixup_interfaces_file('/etc/network/interfaces', data, set(), cache)
+    if cache.dirty:
+        unitdata.kv().set(spcdrift.KV_INTERFACES_CACHE, cache.to_dict())
+
+
+def write_netplan(devices, data):
+    """
+    Write out a netplan overlay with the StorPool interfaces' MTUs and
+    a networkd-dispatcher hook that runs the post-up commands.
+    """
+    files = spcnetplan.render_files(devices, data)
+    for path in sorted(files.keys()):
+        (contents, mode) = files[path]
+        if spcfiles.install(path, contents, mode=mode,
+                            record=spcdrift.KV_MANAGED_FILES):
+            rdebug('Updated {path}', path=path)
         else:
-            vlan = False
-            parent = ''
+            rdebug('No need to update {path}', path=path)
+
+
+BACKENDS = {
+    'ifupdown': write_ifupdown,
+    'netplan': write_netplan,
+}
+
+
+def detect_backend(sysroot='/'):
+    """
+    Figure out which network configuration system the host uses.
+    """
+    if spcnetplan.detect(sysroot=sysroot):
+        return 'netplan'
+    return 'ifupdown'
+
+
+def plan_interfaces(ifaces, profile='default', sysroot='/',
+                    irq_exclude=None, backend=None):
+    """
+    Compute the post-up commands for the StorPool interfaces, the desired
+    state of the interfaces, and the IRQ plans without changing anything.
+    Use the specified backend ("ifupdown" or "netplan") or the one
+    detected on the host.
+    """
+    rdebug('plan_interfaces invoked for {ifaces}, tuning profile {prof}',
+           ifaces=ifaces, prof=profile)
 
-        if vlan:
+    # Parse the interface names
+    devices = spcifspec.build_model(ifaces, sysroot=sysroot)
+    rdebug('Interface model: {devices}', devices=devices,
+           level=spclog.TRACE)
+    data = {}
+    result = {
+        'desired': {},
+        'plans': [],
+    }
+    for iface in sorted(devices.keys()):
+        dev = devices[iface]
+        if dev['kind'] == 'vlan':
             subst = {
                 'IFACE': iface,
-                'MTU': mtu,
-                'IF_VLAN_RAW_DEVICE': parent,
+                'MTU': dev['mtu'],
+                'IF_VLAN_RAW_DEVICE': dev['parent'],
+                'RAW_MTU': devices[dev['parent']]['mtu'],
             }
             data[iface] = list(map(lambda s: s.format(**subst), vlandef))
-            subst = {
-                'IFACE': parent,
-                'MTU': mtu,
-            }
-            data[parent] = list(map(lambda s: s.format(**subst), nonvlandef))
-        else:
+            result['desired'][iface] = {'mtu': dev['mtu']}
+        elif dev['kind'] == 'bond':
             subst = {
                 'IFACE': iface,
-                'MTU': mtu,
+                'MTU': dev['mtu'],
             }
             data[iface] = list(map(lambda s: s.format(**subst), nonvlandef))
+            result['desired'][iface] = {'mtu': dev['mtu']}
+        else:
+            data[iface] = nic_lines(iface, dev['mtu'], profile, sysroot,
+                                    irq_exclude, result)
 
-    rdebug('Gone through the interfaces, got data: {data}'.format(data=data))
+    rdebug('Gone through the interfaces, got data: {data}', data=data,
+           level=spclog.TRACE)
+
+    if backend is None:
+        backend = detect_backend(sysroot=sysroot)
+    return {
+        'backend': backend,
+        'devices': devices,
+        'data': data,
+        'desired': result['desired'],
+        'plans': result['plans'],
+    }
+
+
+def commit_plan(plan, sysroot='/'):
+    """
+    Modify the system network configuration according to a plan computed
+    by plan_interfaces().  Record and return the desired state of
+    the interfaces.
+    """
+    rdebug('Now about to update the {backend} network configuration...',
+           backend=plan['backend'])
+    unitdata.kv().unset(spcdrift.KV_MANAGED_FILES)
+    BACKENDS[plan['backend']](plan['devices'], plan['data'])
 
-    rdebug('Now about to go through the system network configuration...')
-    fixup_interfaces_file('/etc/network/interfaces', data, set())
+    setup_irqs(plan['plans'], sysroot=sysroot)
+
+    rdebug('Desired network interface state: {desired}',
+           desired=plan['desired'], level=spclog.TRACE)
+    unitdata.kv().set(spcdrift.KV_NETWORK_DESIRED, plan['desired'])
+    return plan['desired']
+
+
+def fixup_interfaces(ifaces, profile='default', sysroot='/',
+                     irq_exclude=None, backend=None):
+    """
+    Modify the system network configuration to add the post-up commands to
+    the StorPool interfaces, using the specified backend ("ifupdown" or
+    "netplan") or the one detected on the host.  Record and return
+    the desired state of the interfaces.
+    """
+    return commit_plan(plan_interfaces(ifaces, profile=profile,
+                                       sysroot=sysroot,
+                                       irq_exclude=irq_exclude,
+                                       backend=backend),
+                       sysroot=sysroot)
+
+
+def apply_interfaces(sysroot='/'):
+    """
+    Bring the live state of the StorPool network interfaces in line with
+    the desired state recorded by the last fixup_interfaces() run.
+    Return the number of commands that failed.
+    """
+    desired = unitdata.kv().get(spcdrift.KV_NETWORK_DESIRED, {})
+    changes = spclinkstate.plan_changes(desired, sysroot=sysroot)
+    rdebug('Live network interface changes: {changes}', changes=changes,
+           level=spclog.TRACE)
+    return spclinkstate.apply_changes(changes)
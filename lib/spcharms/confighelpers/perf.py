@@ -0,0 +1,232 @@
+"""
+A StorPool Juju charm helper module for measuring the time spent, the number
+of subprocesses started, and the amount of data written by the various
+stages of the storpool-config layer's hooks.
+
+The records are kept in memory and appended to a per-unit JSON lines log
+once at the end of the hook.  Nothing is measured outside of a Juju unit.
+"""
+import contextlib
+import functools
+import json
+import os
+import time
+
+from charmhelpers.core import hookenv
+
+PERF_LOG_DIR = '/var/log/storpool'
+PERF_LOG_MAX_SIZE = 1024 * 1024
+
+_records = []
+_stack = []
+_counters = {'procs': 0, 'atexit': False}
+_handler_exit = []
+
+
+def log_path(unit=None):
+    """
+    Return the path to the performance log of the specified unit.
+    """
+    if unit is None:
+        unit = hookenv.local_unit()
+    return os.path.join(PERF_LOG_DIR, 'storpool-config-perf-{unit}.jsonl'
+                        .format(unit=unit.replace('/', '-')))
+
+
+def enabled():
+    """
+    Check whether we are running within a Juju unit.
+    """
+    return bool(os.environ.get('JUJU_UNIT_NAME'))
+
+
+def bytes_written():
+    """
+    Return the number of bytes written by this process so far.
+    """
+    try:
+        with open('/proc/self/io', mode='r') as f:
+            for line in f.readlines():
+                if line.startswith('wchar:'):
+                    return int(line.split(':', 1)[1])
+    except (IOError, OSError, ValueError):
+        pass
+    return 0
+
+
+def flush():
+    """
+    Append the records gathered during this hook to the unit's log.
+    """
+    if not _records:
+        return
+    path = log_path()
+    data = ''.join(json.dumps(rec, sort_keys=True) + '\n'
+                   for rec in _records)
+    del _records[:]
+    try:
+        if not os.path.isdir(PERF_LOG_DIR):
+            os.makedirs(PERF_LOG_DIR, mode=0o755)
+        try:
+            if os.stat(path).st_size > PERF_LOG_MAX_SIZE:
+                os.rename(path, path + '.1')
+        except OSError:
+            pass
+        with open(path, mode='a') as f:
+            f.write(data)
+    except (IOError, OSError) as e:
+        hookenv.log('storpool-config: could not write {path}: {e}'
+                    .format(path=path, e=e), hookenv.WARNING)
+
+
+def count_procs(count=1):
+    """
+    Note that the layer has started some subprocesses.  Only the ones that
+    the layer's own code starts are counted; those of charmhelpers and of
+    the other layers are none of our business.
+    """
+    _counters['procs'] += count
+
+
+def at_handler_exit(func):
+    """
+    Invoke `func` whenever a handler decorated with stage() returns.
+    """
+    if func not in _handler_exit:
+        _handler_exit.append(func)
+
+
+def _start():
+    """
+    Prepare for gathering records during this hook.
+    """
+    if not _counters['atexit']:
+        _counters['atexit'] = True
+        hookenv.atexit(flush)
+
+
+@contextlib.contextmanager
+def measure(name, procs=0):
+    """
+    Record the wall time, the subprocesses and the bytes written while
+    the body of the `with` statement runs; `procs` is the number of
+    subprocesses that the body starts without counting them itself.
+    """
+    if not enabled():
+        yield
+        return
+
+    _start()
+    parent = _stack[-1] if _stack else None
+    _stack.append(name)
+    started = _counters['procs']
+    written = bytes_written()
+    start = time.time()
+    try:
+        yield
+    finally:
+        wall = time.time() - start
+        _stack.pop()
+        count_procs(procs)
+        _records.append({
+            'ts': round(start, 3),
+            'pid': os.getpid(),
+            'hook': hookenv.hook_name(),
+            'stage': name,
+            'parent': parent,
+            'wall': round(wall, 6),
+            'procs': _counters['procs'] - started,
+            'written': bytes_written() - written,
+        })
+
+
+def stage(name):
+    """
+    Decorate a reactive handler so that its runs are measured and
+    the at_handler_exit() functions are invoked when it returns.  Place it
+    immediately above the function, below the charms.reactive decorators.
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            try:
+                with measure(name):
+                    return func(*args, **kwargs)
+            finally:
+                for exit_func in list(_handler_exit):
+                    exit_func()
+
+        # Let charms.reactive tell the wrapped handlers apart.
+        code = func.__code__
+        wrapper._action_id = '{fname}:{line}:{name}'.format(
+            fname=code.co_filename, line=code.co_firstlineno,
+            name=code.co_name)
+        wrapper._short_action_id = '{fname}:{line}:{name}'.format(
+            fname=os.path.join(
+                os.path.basename(os.path.dirname(code.co_filename)),
+                os.path.basename(code.co_filename)),
+            line=code.co_firstlineno, name=code.co_name)
+        return wrapper
+
+    return decorator
+
+
+def read_log(path, hooks=None):
+    """
+    Read the records from a performance log, only the ones from the last
+    `hooks` hook runs if specified.
+    """
+    res = []
+    try:
+        with open(path, mode='r') as f:
+            for line in f.readlines():
+                try:
+                    res.append(json.loads(line))
+                except ValueError:
+                    continue
+    except (IOError, OSError):
+        return []
+    if hooks is not None:
+        runs = []
+        for rec in res:
+            if not runs or runs[-1] != rec['pid']:
+                runs.append(rec['pid'])
+        wanted = set(runs[-hooks:])
+        res = [rec for rec in res if rec['pid'] in wanted]
+    return res
+
+
+def summarize(records):
+    """
+    Aggregate the records by stage: the number of runs, the total and
+    the largest wall time, the subprocesses and the bytes written.
+    """
+    res = {}
+    for rec in records:
+        cur = res.setdefault(rec['stage'], {
+            'runs': 0,
+            'wall': 0.0,
+            'max': 0.0,
+            'procs': 0,
+            'written': 0,
+        })
+        cur['runs'] += 1
+        cur['wall'] += rec['wall']
+        cur['max'] = max(cur['max'], rec['wall'])
+        cur['procs'] += rec['procs']
+        cur['written'] += rec['written']
+    return res
+
+
+def format_summary(summary):
+    """
+    Format the aggregated records as a short table, the slowest stages
+    first.
+    """
+    lines = []
+    for name in sorted(summary.keys(), key=lambda n: -summary[n]['wall']):
+        cur = summary[name]
+        lines.append('{name}: {runs} run(s), {wall:.3f}s total, '
+                     '{max:.3f}s max, {procs} process(es), {written} bytes'
+                     .format(name=name, **cur))
+    return '\n'.join(lines)
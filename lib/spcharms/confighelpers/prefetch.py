@@ -0,0 +1,146 @@
+"""
+A StorPool Juju charm helper module for downloading the StorPool packages
+into the apt cache in the background while the charm is still waiting for
+its configuration, so that the actual installation is a local operation.
+"""
+import os
+import signal
+import subprocess
+import time
+
+from charmhelpers.core import unitdata
+
+from spcharms.confighelpers import dpkg as spcdpkg
+from spcharms.confighelpers import log as spclog
+from spcharms.confighelpers import perf as spcperf
+
+KV_PREFETCH = 'storpool-config.prefetch'
+
+PREFETCH_LOG = '/var/log/storpool/storpool-config-prefetch.log'
+
+WAIT_TIMEOUT = 600
+WAIT_INTERVAL = 2
+
+
+def rdebug(s, *args, **kwargs):
+    """
+    Pass the diagnostic message string `s` to the central diagnostic logger,
+    formatting it with any arguments only if it is going to be logged.
+    """
+    spclog.rdebug(s, *args, **kwargs)
+
+
+def apt_version(name, wanted):
+    """
+    Find the newest version of a package available in the apt sources
+    that matches the requested one; return None for "any version" and
+    False if there is no such version.
+    """
+    if wanted == '*':
+        return None
+    spcperf.count_procs()
+    try:
+        output = subprocess.check_output(['apt-cache', 'madison', name],
+                                         stderr=subprocess.DEVNULL).decode()
+    except (OSError, subprocess.CalledProcessError):
+        return False
+    for line in output.split('\n'):
+        parts = [part.strip() for part in line.split('|')]
+        if len(parts) >= 2 and parts[0] == name and \
+                spcdpkg.version_matches(wanted, parts[1]):
+            return parts[1]
+    return False
+
+
+def running(pid, procroot='/proc'):
+    """
+    Check whether the process with the specified ID is still our apt-get
+    download run and not something else that reused the process ID.
+    """
+    try:
+        with open(os.path.join(procroot, str(pid), 'cmdline'),
+                  mode='rb') as f:
+            args = f.read().split(b'\0')
+    except (IOError, OSError):
+        return False
+    return b'apt-get' in [os.path.basename(arg) for arg in args[:1]] and \
+        b'--download-only' in args
+
+
+def start(packages):
+    """
+    Start downloading the specified packages (name: version) unless
+    the same set is already being (or has been) downloaded.  Return
+    True if a new download was started.
+    """
+    rec = unitdata.kv().get(KV_PREFETCH)
+    if rec is not None:
+        if rec['packages'] == packages:
+            return False
+        cancel()
+
+    args = []
+    for name in sorted(packages.keys()):
+        version = apt_version(name, packages[name])
+        if version is False:
+            rdebug('no {name} version {ver} in the apt sources yet, '
+                   'not prefetching', name=name, ver=packages[name])
+            return False
+        elif version is None:
+            args.append(name)
+        else:
+            args.append('{name}={ver}'.format(name=name, ver=version))
+
+    # apt resumes any partial downloads left over from a previous run.
+    cmd = ['apt-get', 'install', '--download-only', '-y', '-q', '--'] + args
+    rdebug('prefetching packages: {cmd}', cmd=' '.join(cmd))
+    env = dict(os.environ)
+    env['DEBIAN_FRONTEND'] = 'noninteractive'
+    logdir = os.path.dirname(PREFETCH_LOG)
+    if not os.path.isdir(logdir):
+        os.makedirs(logdir, mode=0o755)
+    spcperf.count_procs()
+    with open(PREFETCH_LOG, mode='a') as logf:
+        proc = subprocess.Popen(cmd, stdin=subprocess.DEVNULL, stdout=logf,
+                                stderr=subprocess.STDOUT, env=env,
+                                start_new_session=True)
+    unitdata.kv().set(KV_PREFETCH, {
+        'packages': packages,
+        'pid': proc.pid,
+    })
+    return True
+
+
+def wait(timeout=WAIT_TIMEOUT, interval=WAIT_INTERVAL):
+    """
+    Wait for a running download to complete, so that it does not hold
+    the apt cache lock while the packages are being installed.  Return
+    False if it is still running after `timeout` seconds.
+    """
+    rec = unitdata.kv().get(KV_PREFETCH)
+    if rec is None:
+        return True
+    deadline = time.time() + timeout
+    while running(rec['pid']):
+        if time.time() >= deadline:
+            rdebug('the package prefetch (pid {pid}) is still running',
+                   pid=rec['pid'])
+            return False
+        time.sleep(interval)
+    return True
+
+
+def cancel():
+    """
+    Stop a running download and forget about it.
+    """
+    rec = unitdata.kv().get(KV_PREFETCH)
+    if rec is None:
+        return
+    if running(rec['pid']):
+        rdebug('stopping the package prefetch (pid {pid})', pid=rec['pid'])
+        try:
+            os.kill(rec['pid'], signal.SIGTERM)
+        except OSError:
+            pass
+    unitdata.kv().unset(KV_PREFETCH)
@@ -0,0 +1,64 @@
+"""
+A StorPool Juju charm helper module for coalescing the unit status updates
+made by the storpool-config layer's handlers during a single hook.
+
+The handlers update an in-memory status and only the final one is passed
+on to Juju when the handler returns (see perf.at_handler_exit()), along
+with the ones that announce a long-running step, at most once every
+MIN_INTERVAL seconds.  Thus the unit status is still set in the order
+the handlers of all the layers run in.  Outside of a Juju unit every
+update is passed on right away.
+"""
+import time
+
+from spcharms import status as spstatus
+from spcharms.confighelpers import perf as spcperf
+
+MIN_INTERVAL = 10
+
+_state = {
+    'current': None,
+    'sent': None,
+    'sent_at': None,
+    'registered': False,
+}
+
+
+def send(status):
+    """
+    Pass a status on to Juju.
+    """
+    spstatus.npset(*status)
+    _state['sent'] = status
+    _state['sent_at'] = time.time()
+
+
+def npset(status, message, immediate=False):
+    """
+    Update the unit status.  If `immediate` is set, the handler is about
+    to start a long-running step, so let Juju know unless it was told
+    about something else very recently.
+    """
+    if not spcperf.enabled():
+        spstatus.npset(status, message)
+        return
+
+    if not _state['registered']:
+        _state['registered'] = True
+        spcperf.at_handler_exit(flush)
+    _state['current'] = (status, message)
+    if immediate and _state['current'] != _state['sent'] and \
+            (_state['sent_at'] is None or
+             time.time() - _state['sent_at'] >= MIN_INTERVAL):
+        send(_state['current'])
+
+
+def flush():
+    """
+    Pass the last status set by the current handler on to Juju if it has
+    not been sent already.
+    """
+    if _state['current'] is not None and \
+            _state['current'] != _state['sent']:
+        send(_state['current'])
+    _state['current'] = None
@@ -0,0 +1,230 @@
+"""
+A StorPool Juju charm helper module for examining the network interface
+hardware and computing the NIC settings for the StorPool interfaces
+according to a named tuning profile.
+"""
+import os
+import subprocess
+
+from spcharms.confighelpers import perf as spcperf
+
+SYS_CLASS_NET = 'sys/class/net'
+
+# Each profile lists the ethtool pause, coalescing and ring settings in
+# the order they should be applied.  A ring size of "max" means
+# the hardware maximum; all ring sizes are clamped to that maximum.
+PROFILES = {
+    'default': {
+        'pause': [('autoneg', 'off'), ('tx', 'off'), ('rx', 'on')],
+        'coalesce': [('rx-usecs', 16)],
+        'ring': [('rx', 4096), ('tx', 512)],
+    },
+    'latency': {
+        'pause': [('autoneg', 'off'), ('tx', 'off'), ('rx', 'on')],
+        'coalesce': [('adaptive-rx', 'off'), ('rx-usecs', 0),
+                     ('rx-frames', 1)],
+        'ring': [('rx', 1024), ('tx', 512)],
+    },
+    'throughput': {
+        'pause': [('autoneg', 'off'), ('tx', 'on'), ('rx', 'on')],
+        'coalesce': [('adaptive-rx', 'on')],
+        'ring': [('rx', 'max'), ('tx', 'max')],
+    },
+}
+
+# On links at least this fast the default ring sizes are too small.
+FAST_LINK_SPEED = 25000
+FAST_LINK_RING = [('rx', 'max'), ('tx', 4096)]
+
+
+def read_sys(path, default=None):
+    """
+    Read a single value from a sysfs file.
+    """
+    try:
+        with open(path, mode='r') as f:
+            return f.read().strip()
+    except (IOError, OSError):
+        return default
+
+
+def read_sys_int(path, default=None):
+    """
+    Read a single integer value from a sysfs file.
+    """
+    value = read_sys(path)
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return default
+
+
+def run_ethtool(option, iface):
+    """
+    Query the current settings of a network interface using ethtool;
+    return None if the query failed.
+    """
+    spcperf.count_procs()
+    try:
+        return subprocess.check_output(['/sbin/ethtool', option, iface],
+                                       stderr=subprocess.DEVNULL).decode()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def parse_rings(output):
+    """
+    Parse the output of `ethtool -g` into a dictionary with the "max"
+    and "current" RX and TX ring sizes.
+    """
+    res = {'max': {}, 'current': {}}
+    section = None
+    for line in output.split('\n'):
+        if line.startswith('Pre-set maximums'):
+            section = 'max'
+            continue
+        elif line.startswith('Current hardware settings'):
+            section = 'current'
+            continue
+        if section is None:
+            continue
+        parts = line.split(':', 1)
+        if len(parts) != 2 or parts[0] not in ('RX', 'TX'):
+            continue
+        try:
+            res[section][parts[0].lower()] = int(parts[1].strip())
+        except ValueError:
+            pass
+    return res
+
+
+def parse_coalesce(output):
+    """
+    Parse the output of `ethtool -c` into a dictionary of the supported
+    coalescing parameters and their current values.
+    """
+    res = {}
+    for line in output.split('\n'):
+        line = line.strip()
+        if line.startswith('Adaptive RX:'):
+            words = line.split()
+            res['adaptive-rx'] = words[2]
+            if len(words) > 4:
+                res['adaptive-tx'] = words[4]
+            continue
+        parts = line.split(':', 1)
+        if len(parts) != 2 or ' ' in parts[0]:
+            continue
+        value = parts[1].strip()
+        if value in ('', 'n/a'):
+            continue
+        try:
+            res[parts[0]] = int(value)
+        except ValueError:
+            res[parts[0]] = value
+    return res
+
+
+def nic_info(iface, sysroot='/', ethtool=None):
+    """
+    Examine a network interface: driver, link speed, number of queues,
+    NUMA node, ring size limits, and supported coalescing parameters.
+    Return None if the interface does not exist.
+    """
+    if ethtool is None:
+        ethtool = run_ethtool
+    base = os.path.join(sysroot, SYS_CLASS_NET, iface)
+    if not os.path.isdir(base):
+        return None
+
+    driver_link = os.path.join(base, 'device', 'driver')
+    if os.path.exists(driver_link):
+        driver = os.path.basename(os.path.realpath(driver_link))
+    else:
+        driver = None
+
+    queues_dir = os.path.join(base, 'queues')
+    if os.path.isdir(queues_dir):
+        queues = len([name for name in os.listdir(queues_dir)
+                      if name.startswith('rx-')])
+    else:
+        queues = 0
+
+    output = ethtool('-g', iface)
+    rings = parse_rings(output) if output is not None else None
+    output = ethtool('-c', iface)
+    coalesce = parse_coalesce(output) if output is not None else None
+
+    return {
+        'driver': driver,
+        'speed': read_sys_int(os.path.join(base, 'speed'), -1),
+        'queues': queues,
+        'numa_node': read_sys_int(os.path.join(base, 'device', 'numa_node'),
+                                  -1),
+        'rings': rings,
+        'coalesce': coalesce,
+    }
+
+
+def nic_settings(profile, info):
+    """
+    Compute the ethtool settings for a network interface according to
+    the specified profile, adapting them to the hardware described by
+    `info` if it is not None.
+    """
+    prof = PROFILES[profile]
+    ring = prof['ring']
+    if profile == 'default' and info is not None and \
+            info['speed'] >= FAST_LINK_SPEED:
+        ring = FAST_LINK_RING
+
+    maxima = info['rings']['max'] if info is not None and \
+        info['rings'] is not None else None
+    rings = []
+    for (key, value) in ring:
+        if maxima is None:
+            if value != 'max':
+                rings.append((key, value))
+            continue
+        limit = maxima.get(key)
+        if limit is None or limit <= 0:
+            continue
+        rings.append((key, limit if value == 'max' else min(value, limit)))
+
+    supported = info['coalesce'] if info is not None else None
+    if supported is None:
+        if info is not None:
+            coalesce = []
+        else:
+            coalesce = list(prof['coalesce'])
+    else:
+        coalesce = [(key, value) for (key, value) in prof['coalesce']
+                    if key in supported]
+
+    return {
+        'pause': list(prof['pause']),
+        'coalesce': coalesce,
+        'ring': rings,
+    }
+
+
+def format_settings(pairs):
+    """
+    Format a list of ethtool (parameter, value) pairs.
+    """
+    return ' '.join('{key} {value}'.format(key=key, value=value)
+                    for (key, value) in pairs)
+
+
+def post_up_lines(iface, settings):
+    """
+    Produce the "post-up" lines that apply the ethtool settings.
+    """
+    res = []
+    for (option, key) in (('-A', 'pause'), ('-C', 'coalesce'),
+                          ('-G', 'ring')):
+        if settings[key]:
+            res.append('post-up /sbin/ethtool {option} {iface} {args} || true'
+                       .format(option=option, iface=iface,
+                               args=format_settings(settings[key])))
+    return res
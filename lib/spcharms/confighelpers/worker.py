@@ -0,0 +1,55 @@
+"""
+A StorPool Juju charm helper module for running a long operation, e.g. an apt
+install, in a background thread while the hook goes on with other work that
+does not depend on its result.
+"""
+import threading
+
+
+class Worker(object):
+    """
+    Run a function in a background thread and collect its result.
+    """
+
+    def __init__(self, func, *args, **kwargs):
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs
+        self.result = None
+        self.error = None
+        self.thread = threading.Thread(target=self._run,
+                                       name='storpool-config-worker')
+        self.thread.daemon = True
+
+    def _run(self):
+        """
+        Invoke the function and store its result or the raised exception.
+        """
+        try:
+            self.result = self.func(*self.args, **self.kwargs)
+        except Exception as e:
+            self.error = e
+
+    def start(self):
+        """
+        Start running the function; return the worker itself.
+        """
+        self.thread.start()
+        return self
+
+    def wait(self):
+        """
+        Wait for the function to complete and return its result or raise
+        the exception that it raised.
+        """
+        self.thread.join()
+        if self.error is not None:
+            raise self.error
+        return self.result
+
+
+def start(func, *args, **kwargs):
+    """
+    Start running a function in a background thread.
+    """
+    return Worker(func, *args, **kwargs).start()
@@ -3,19 +3,41 @@ A Juju layer for installing and configuring the base StorPool packages.
 """
 from __future__ import print_function
 
-import tempfile
+import json
+import os
 import subprocess
+import tempfile
+import time
 
 from charms import reactive
-from charmhelpers.core import hookenv, templating
-
-from spcharms import config as spconfig
-from spcharms.confighelpers import network as spcnetwork
-from spcharms import repo as sprepo
-from spcharms import states as spstates
-from spcharms import status as spstatus
-from spcharms import txn
-from spcharms import utils as sputils
+from charmhelpers.core import hookenv, unitdata
+
+from spcharms.confighelpers import lazy as spclazy
+from spcharms.confighelpers import perf as spcperf
+
+# Most hooks only run a couple of our handlers, if any; only load
+# the modules that do the actual work when they are first needed.
+templating = spclazy.module('charmhelpers.core.templating')
+spconfig = spclazy.module('spcharms.config')
+spcclusterconf = spclazy.module('spcharms.confighelpers.clusterconf')
+spcconfindex = spclazy.module('spcharms.confighelpers.confindex')
+spccpuplan = spclazy.module('spcharms.confighelpers.cpuplan')
+spcdpkg = spclazy.module('spcharms.confighelpers.dpkg')
+spcdrift = spclazy.module('spcharms.confighelpers.drift')
+spcfiles = spclazy.module('spcharms.confighelpers.files')
+spchugepages = spclazy.module('spcharms.confighelpers.hugepages')
+spcirq = spclazy.module('spcharms.confighelpers.irq')
+spckmod = spclazy.module('spcharms.confighelpers.kmod')
+spclog = spclazy.module('spcharms.confighelpers.log')
+spcnetwork = spclazy.module('spcharms.confighelpers.network')
+spcprefetch = spclazy.module('spcharms.confighelpers.prefetch')
+spcstatus = spclazy.module('spcharms.confighelpers.status')
+spctuning = spclazy.module('spcharms.confighelpers.tuning')
+spcworker = spclazy.module('spcharms.confighelpers.worker')
+sprepo = spclazy.module('spcharms.repo')
+spstates = spclazy.module('spcharms.states')
+txn = spclazy.module('spcharms.txn')
+sputils = spclazy.module('spcharms.utils')
 
 STATES_REDO = {
     'set': ['l-storpool-config.configure'],
@@ -24,26 +46,362 @@ STATES_REDO = {
         'l-storpool-config.config-available',
         'l-storpool-config.config-written',
         'l-storpool-config.config-network',
+        'l-storpool-config.network-applied',
+        'l-storpool-config.hugepages',
+        'l-storpool-config.cpuset',
         'l-storpool-config.package-try-install',
         'l-storpool-config.package-installed',
     ],
 }
 
+STATES_CONFIG_CHANGED = {
+    'set': ['l-storpool-config.configure'],
+    'unset': ['l-storpool-config.configured'],
+}
+
+STAGE_STATES = {
+    'package': [
+        'l-storpool-config.package-try-install',
+        'l-storpool-config.package-installed',
+    ],
+    'config': ['l-storpool-config.config-written'],
+    'cpus': ['l-storpool-config.cpuset'],
+    'memory': ['l-storpool-config.hugepages'],
+    'network': [
+        'l-storpool-config.config-network',
+        'l-storpool-config.network-applied',
+    ],
+}
+
+OPTION_STAGES = {
+    'hugepages': ['memory'],
+    'irq_exclude_cpus': ['network'],
+    'irq_pinning': ['network'],
+    'nic_tuning_profile': ['network'],
+    # The verbatim and the structured StorPool configuration are compared
+    # as rendered for this unit, see option_digests().
+    'storpool_conf': ['config', 'cpus', 'memory', 'network'],
+    'storpool_cores': ['cpus'],
+    'storpool_version': ['package'],
+}
+
+STORPOOL_CONF = '/etc/storpool.conf'
+
+FSYNC_POLICIES = ('none', 'file', 'full')
+
+KV_CONF_RECORD = 'storpool-config.conf-record'
+KV_APPLIED_CONFIG = 'storpool-config.applied-config'
+KV_CONFIG_CHANGED = 'storpool-config.config-changed'
+
+# The work done in advance while the packages are being installed; it only
+# lives as long as the hook does.
+_prepared = {}
+
+
+def rdebug(s, *args, **kwargs):
+    """
+    Pass the diagnostic message string `s` to the central diagnostic logger,
+    formatting it with any arguments only if it is going to be logged.
+    """
+    spclog.rdebug(s, *args, **kwargs)
+
+
+def conf_unchanged(digest):
+    """
+    Check whether the StorPool configuration file that we installed last
+    time has the same contents as the newly rendered one and has not been
+    modified since.  Return the recorded SP_OURID value if so.
+    """
+    rec = unitdata.kv().get(KV_CONF_RECORD)
+    if rec is None or rec.get('digest') != digest:
+        return None
+    st = spcfiles.stat_key(STORPOOL_CONF)
+    if st is None or st != rec.get('stat'):
+        return None
+    return rec.get('oid')
+
+
+def conf_drifted():
+    """
+    Check whether the StorPool configuration file has been modified since
+    we installed it.  Only read it if its inode number, size, or
+    modification time have changed; if the contents are still the same,
+    update the record so that the next check is a single stat call again.
+    """
+    rec = unitdata.kv().get(KV_CONF_RECORD)
+    if rec is None:
+        return False
+    st = spcfiles.stat_key(STORPOOL_CONF)
+    if st is not None and st == rec.get('stat'):
+        return False
+    if st is None:
+        return True
+    try:
+        with open(STORPOOL_CONF, mode='r', encoding='UTF-8') as f:
+            contents = f.read()
+    except (IOError, OSError, ValueError):
+        return True
+    if spcfiles.contents_digest(contents) != rec.get('digest'):
+        return True
+    rec['stat'] = st
+    unitdata.kv().set(KV_CONF_RECORD, rec)
+    return False
+
+
+def effective_conf(config):
+    """
+    Return the contents of the StorPool configuration file for this unit.
+    Raise a ValueError if the structured configuration is invalid.
+    """
+    return spcclusterconf.effective_conf(
+        config.get('storpool_conf', None),
+        config.get('storpool_conf_yaml', None))
+
+
+def fsync_policy():
+    """
+    Return the configured way of syncing the StorPool configuration file
+    to disk: "none", "file", or "full" (the file and its directory).
+    """
+    policy = spconfig.m().get('storpool_conf_fsync', None)
+    return policy if policy in FSYNC_POLICIES else 'full'
+
+
+def install_conf(contents):
+    """
+    Write the StorPool configuration file into a temporary file next to
+    the real one, created with the final permissions, and let txn replace
+    the real one with it and record the change so it may be rolled back.
+    Then sync the installed file (and, for the "full" policy, its directory)
+    to disk as the charm configuration says.
+    """
+    policy = fsync_policy()
+    (dirname, basename) = os.path.split(STORPOOL_CONF)
+    (fd, tempname) = tempfile.mkstemp(dir=dirname,
+                                      prefix='.{base}.'.format(base=basename))
+    try:
+        with os.fdopen(fd, mode='w') as tempf:
+            os.fchmod(tempf.fileno(), 0o644)
+            print(contents, file=tempf, end='')
+
+        rdebug('about to invoke txn install')
+        with spcperf.measure('txn-install', procs=1):
+            txn.install('-o', 'root', '-g', 'root', '-m', '644', '--',
+                        tempname, STORPOOL_CONF)
+    finally:
+        try:
+            os.unlink(tempname)
+        except OSError:
+            pass
+
+    synced = [STORPOOL_CONF] if policy != 'none' else []
+    if policy == 'full':
+        synced.append(dirname)
+    for path in synced:
+        fd = os.open(path, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+
+def render_conf(spconf):
+    """
+    Render the StorPool configuration file from the effective text.
+    """
+    return templating.render(source='storpool.conf',
+                             target=None,
+                             context={
+                              'storpool_conf': spconf,
+                             },
+                             )
+
+
+def prepare_config(config):
+    """
+    Render the StorPool configuration file for this unit and, unless it is
+    already installed, index and validate it.  Return a dictionary with
+    either an "error" message or the "contents", their "digest", and
+    the indexed "cfg" (None if the file is up to date).
+    """
+    try:
+        spconf = effective_conf(config)
+    except ValueError as e:
+        return {'error': 'invalid storpool_conf_yaml: {e}'.format(e=e)}
+    contents = render_conf(spconf)
+    digest = spcfiles.contents_digest(contents)
+    res = {
+        'error': None,
+        'contents': contents,
+        'digest': digest,
+        'cfg': None,
+    }
+    if conf_unchanged(digest) is not None:
+        return res
+
+    rdebug('indexing the new contents')
+    cfg = spcconfindex.index_text(contents)
+    problems = cfg.validate()
+    if problems:
+        return {'error': 'invalid StorPool config: {problems}'
+                         .format(problems=', '.join(problems))}
+    res['cfg'] = cfg
+    return res
+
+
+def network_options(config):
+    """
+    Return the NIC tuning profile and the CPUs that the StorPool interfaces'
+    interrupts should not be pinned to, including the ones dedicated to
+    the StorPool services.  Raise a ValueError if the charm
+    config options are invalid.
+    """
+    profile = config.get('nic_tuning_profile', None)
+    if profile is None or profile == '':
+        profile = 'default'
+    if profile not in spctuning.PROFILES:
+        profs = ', '.join(sorted(spctuning.PROFILES))
+        raise ValueError('invalid nic_tuning_profile "{prof}", should be one '
+                         'of {profs}'.format(prof=profile, profs=profs))
+
+    irq_exclude = None
+    if config.get('irq_pinning', False):
+        exclude = config.get('irq_exclude_cpus', None)
+        try:
+            irq_exclude = sorted(
+                set(spcirq.parse_cpulist(exclude or '')) |
+                set(spcirq.storpool_cpus()) |
+                set(spccpuplan.planned_cpus()))
+        except ValueError:
+            raise ValueError('invalid irq_exclude_cpus "{cpus}"'
+                             .format(cpus=exclude))
+    return (profile, irq_exclude)
+
+
+def prepare_network(config, cfg):
+    """
+    Plan the changes to the StorPool interfaces' configuration.  Return
+    None if that should be left to the network stage itself.
+    """
+    if sputils.check_in_lxc():
+        return None
+    ifaces = cfg.get('SP_IFACE', None)
+    if ifaces is None:
+        return None
+    try:
+        (profile, irq_exclude) = network_options(config)
+    except ValueError:
+        return None
+    return {
+        'key': [ifaces, profile, irq_exclude],
+        'plan': spcnetwork.plan_interfaces(ifaces, profile=profile,
+                                           irq_exclude=irq_exclude),
+    }
+
+
+def prepare(config):
+    """
+    Do the work of the config and network stages that does not need
+    the StorPool packages installed: render, index, and validate
+    the configuration file and plan the interface changes.
+    """
+    _prepared.clear()
+    try:
+        if not reactive.helpers.is_state('l-storpool-config.config-written'):
+            _prepared['config'] = prepare_config(config)
+            if _prepared['config']['error'] is not None:
+                return
+        if not reactive.helpers.is_state('l-storpool-config.config-network'):
+            prep = _prepared.get('config')
+            if prep is not None and prep['cfg'] is not None:
+                cfg = prep['cfg']
+            else:
+                cfg = spcconfindex.get_config(STORPOOL_CONF)
+            _prepared['network'] = prepare_network(config, cfg)
+    except Exception as e:
+        # The stages will do it themselves and report any problems.
+        rdebug('could not prepare the configuration in advance: {e}', e=e)
+        _prepared.clear()
+
+
+def option_digests(config, conf):
+    """
+    Return digests of the current values of the charm config options that
+    affect the various stages of our work.  The StorPool configuration is
+    represented by the `conf` text rendered for this unit, so that changes
+    to the other hosts' sections do not make us redo anything.
+    """
+    res = dict((opt, spcfiles.contents_digest(
+        json.dumps(config.get(opt, None)))) for opt in OPTION_STAGES.keys())
+    res['storpool_conf'] = spcfiles.contents_digest(conf)
+    return res
+
 
-def rdebug(s):
+def changed_stages(current):
     """
-    Pass the diagnostic message string `s` to the central diagnostic logger.
+    Compare the current charm config option digests to the ones recorded
+    the last time the configuration was applied and return the set of
+    stages that need to be redone.
     """
-    sputils.rdebug(s, prefix='config')
+    applied = unitdata.kv().get(KV_APPLIED_CONFIG)
+    if applied is None:
+        return set(STAGE_STATES.keys())
 
+    stages = set()
+    for opt, value in current.items():
+        if applied.get(opt) != value:
+            rdebug('the {opt} charm config option has changed', opt=opt)
+            stages.update(OPTION_STAGES[opt])
+    return stages
 
-@reactive.hook('install')
+
+def config_changed_at():
+    """
+    Return the time the latest charm configuration that needs to be
+    applied was seen.
+    """
+    return unitdata.kv().get(KV_CONFIG_CHANGED, 0)
+
+
+def settle_window():
+    """
+    Return the number of seconds to wait for the charm configuration to
+    stop changing before applying it.
+    """
+    value = spconfig.m().get('config_settle_time', None)
+    try:
+        return max(int(value), 0) if value is not None else 0
+    except ValueError:
+        return 0
+
+
+def stage_may_proceed(stage):
+    """
+    Check at a stage boundary whether the charm configuration has settled.
+    If it was changed within the settle window, more changes may be on
+    the way, so do not apply it yet; the work is picked up again by
+    the first hook that runs after the window has passed.
+    """
+    changed = config_changed_at()
+    remaining = changed + settle_window() - time.time()
+    if remaining <= 0:
+        return True
+    rdebug('the charm configuration changed {ago:.0f}s ago, deferring '
+           'the {stage} stage', stage=stage, ago=time.time() - changed)
+    spcstatus.npset('maintenance',
+                    'waiting for the charm configuration to settle')
+    return False
+
+
+@reactive.hook('install', 'upgrade-charm')
 def register():
     """
-    Register our hook state mappings.
+    Register our hook state mappings; do it again on upgrade so that
+    the units deployed with an older version of the layer pick up
+    the current ones.
     """
     spstates.register('storpool-config', {
-        'config-changed': STATES_REDO,
+        'config-changed': STATES_CONFIG_CHANGED,
         'upgrade-charm': STATES_REDO,
     })
 
@@ -52,6 +410,7 @@ def register():
 @reactive.when('l-storpool-config.configure')
 @reactive.when_not('l-storpool-config.configured')
 @reactive.when_not('l-storpool-config.stopped')
+@spcperf.stage('config-changed')
 def config_changed():
     """
     Check if the configuration is complete or has been changed.
@@ -60,48 +419,93 @@ def config_changed():
     reactive.remove_state('l-storpool-config.configure')
     config = spconfig.m()
 
-    # Remove any states that say we have accomplished anything...
-    for state in STATES_REDO['unset']:
-        reactive.remove_state(state)
-    spconfig.unset_our_id()
-
-    spconf = config.get('storpool_conf', None)
-    rdebug('and we do{xnot} have a storpool_conf setting'
-           .format(xnot=' not' if spconf is None else ''))
-    if spconf is None or spconf == '':
+    try:
+        spconf = effective_conf(config)
+    except ValueError as e:
+        spcstatus.npset('blocked',
+                        'invalid storpool_conf_yaml: {e}'.format(e=e))
+        return
+    rdebug('and we do{xnot} have a StorPool configuration',
+           xnot=' not' if spconf == '' else '')
+    if spconf == '':
+        # Remove any states that say we have accomplished anything...
+        for state in STATES_REDO['unset']:
+            reactive.remove_state(state)
+        spconfig.unset_our_id()
+        unitdata.kv().unset(KV_APPLIED_CONFIG)
         return
 
+    # ...but only those that the changed settings actually affect.
+    current = option_digests(config, spconf)
+    stages = changed_stages(current)
+    rdebug('stages to redo: {stages}', stages=sorted(stages))
+    for stage in sorted(stages):
+        for state in STAGE_STATES[stage]:
+            reactive.remove_state(state)
+    if 'config' in stages:
+        spconfig.unset_our_id()
+    if stages:
+        unitdata.kv().set(KV_CONFIG_CHANGED, time.time())
+    unitdata.kv().set(KV_APPLIED_CONFIG, current)
+
     # And let's make sure we try installing any packages we need...
     reactive.set_state('l-storpool-config.config-available')
     reactive.set_state('l-storpool-config.package-try-install')
 
     # This will probably race with some others, but oh well
-    spstatus.npset('maintenance',
-                   'waiting for the StorPool charm configuration and '
-                   'the StorPool repo setup')
+    spcstatus.npset('maintenance',
+                    'waiting for the StorPool charm configuration and '
+                    'the StorPool repo setup')
 
 
 @reactive.when('storpool-repo-add.available')
 @reactive.when_not('l-storpool-config.config-available')
 @reactive.when_not('l-storpool-config.stopped')
+@spcperf.stage('not-ready-no-config')
 def not_ready_no_config():
     """
     Note that some configuration settings are missing.
     """
     rdebug('well, it seems we have a repo, but we do not have a config yet')
-    spstatus.npset('maintenance',
-                   'waiting for the StorPool charm configuration')
+    spcstatus.npset('maintenance',
+                    'waiting for the StorPool charm configuration')
+
+
+@reactive.when('storpool-helper.config-set')
+@reactive.when('storpool-repo-add.available')
+@reactive.when_not('l-storpool-config.config-available')
+@reactive.when_not('l-storpool-config.package-installed')
+@reactive.when_not('l-storpool-config.stopped')
+@spcperf.stage('prefetch-packages')
+def prefetch_packages():
+    """
+    Download the StorPool packages in the background while waiting for
+    the rest of the charm configuration.
+    """
+    spver = spconfig.m().get('storpool_version', None)
+    if spver is None or spver == '':
+        return
+
+    packages = {
+        'txn-install': '*',
+        'storpool-config': spver,
+    }
+    if not spcdpkg.missing(packages):
+        return
+    if spcprefetch.start(packages):
+        rdebug('started downloading the StorPool packages')
 
 
 @reactive.when_not('storpool-repo-add.available')
 @reactive.when('l-storpool-config.config-available')
 @reactive.when_not('l-storpool-config.stopped')
+@spcperf.stage('not-ready-no-repo')
 def not_ready_no_repo():
     """
     Note that the `storpool-repo` layer has not yet completed its work.
     """
     rdebug('well, it seems we have a config, but we do not have a repo yet')
-    spstatus.npset('maintenance', 'waiting for the StorPool repo setup')
+    spcstatus.npset('maintenance', 'waiting for the StorPool repo setup')
 
 
 @reactive.when('storpool-helper.config-set')
@@ -110,6 +514,7 @@ def not_ready_no_repo():
                'l-storpool-config.package-try-install')
 @reactive.when_not('l-storpool-config.package-installed')
 @reactive.when_not('l-storpool-config.stopped')
+@spcperf.stage('install-package')
 def install_package():
     """
     Install the base StorPool packages.
@@ -117,35 +522,64 @@ def install_package():
     rdebug('the repo hook has become available and '
            'we do have the configuration')
 
-    spstatus.npset('maintenance', 'obtaining the requested StorPool version')
+    spcstatus.npset('maintenance', 'obtaining the requested StorPool version')
     spver = spconfig.m().get('storpool_version', None)
     if spver is None or spver == '':
         rdebug('no storpool_version key in the charm config yet')
         return
+    if not stage_may_proceed('package'):
+        return
 
-    spstatus.npset('maintenance',
-                   'installing the StorPool configuration packages')
-    reactive.remove_state('l-storpool-config.package-try-install')
-    (err, newly_installed) = sprepo.install_packages({
+    packages = {
         'txn-install': '*',
         'storpool-config': spver,
-    })
+    }
+    if not spcdpkg.missing(packages):
+        rdebug('the requested packages are already installed, '
+               'not running apt')
+        reactive.remove_state('l-storpool-config.package-try-install')
+        reactive.set_state('l-storpool-config.package-installed')
+        spcstatus.npset('maintenance', '')
+        return
+
+    spcstatus.npset('maintenance',
+                    'installing the StorPool configuration packages',
+                    immediate=True)
+    reactive.remove_state('l-storpool-config.package-try-install')
+    with spcperf.measure('prefetch-wait'):
+        if not spcprefetch.wait():
+            rdebug('going ahead with the installation anyway')
+
+    # Only installing the configuration file needs the packages, so do
+    # everything else while apt is busy.
+    installer = spcworker.start(sprepo.install_packages, packages)
+    with spcperf.measure('prepare'):
+        prepare(spconfig.m())
+    with spcperf.measure('install-packages', procs=1):
+        try:
+            (err, newly_installed) = installer.wait()
+        except Exception as e:
+            rdebug('the background package installation failed: {e}; '
+                   'trying again', e=e)
+            spcperf.count_procs()
+            (err, newly_installed) = sprepo.install_packages(packages)
     if err is not None:
-        rdebug('oof, we could not install packages: {err}'.format(err=err))
+        rdebug('oof, we could not install packages: {err}', err=err,
+               level=spclog.INFO)
         rdebug('removing the package-installed state')
         reactive.remove_state('l-storpool-config.package-installed')
         return
 
     if newly_installed:
-        rdebug('it seems we managed to install some packages: {names}'
-               .format(names=newly_installed))
+        rdebug('it seems we managed to install some packages: {names}',
+               names=newly_installed, level=spclog.INFO)
         sprepo.record_packages('storpool-config', newly_installed)
     else:
         rdebug('it seems that all the packages were installed already')
 
     rdebug('setting the package-installed state')
     reactive.set_state('l-storpool-config.package-installed')
-    spstatus.npset('maintenance', '')
+    spcstatus.npset('maintenance', '')
 
 
 @reactive.when('storpool-helper.config-set')
@@ -153,46 +587,114 @@ def install_package():
                'l-storpool-config.package-installed')
 @reactive.when_not('l-storpool-config.config-written')
 @reactive.when_not('l-storpool-config.stopped')
+@spcperf.stage('write-out-config')
 def write_out_config():
     """
     Write out the StorPool configuration file specified in the charm config.
     """
+    if not stage_may_proceed('config'):
+        return
     rdebug('about to write out the /etc/storpool.conf file')
-    spstatus.npset('maintenance', 'updating the /etc/storpool.conf file')
-    with tempfile.NamedTemporaryFile(dir='/tmp',
-                                     mode='w+t',
-                                     delete=True) as spconf:
-        rdebug('about to write the contents to the temporary file {sp}'
-               .format(sp=spconf.name))
-        templating.render(source='storpool.conf',
-                          target=spconf.name,
-                          owner='root',
-                          perms=0o600,
-                          context={
-                           'storpool_conf': spconfig.m()['storpool_conf'],
-                          },
-                          )
-        rdebug('about to invoke txn install')
-        txn.install('-o', 'root', '-g', 'root', '-m', '644', '--',
-                    spconf.name, '/etc/storpool.conf')
-        rdebug('it seems that /etc/storpool.conf has been created')
+    spcstatus.npset('maintenance', 'updating the /etc/storpool.conf file')
+    prep = _prepared.pop('config', None)
+    if prep is None:
+        prep = prepare_config(spconfig.m())
+    else:
+        rdebug('using the configuration prepared during the package '
+               'installation')
+    if prep['error'] is not None:
+        spcstatus.npset('blocked', prep['error'])
+        return
 
-        rdebug('trying to read it now')
-        spconfig.drop_cache()
-        cfg = spconfig.get_dict()
+    contents = prep['contents']
+    digest = prep['digest']
+    oid = conf_unchanged(digest)
+    if oid is not None:
+        rdebug('the {conf} file is already up to date, our id is {oid}',
+               conf=STORPOOL_CONF, oid=oid)
+        spconfig.set_our_id(oid)
+    else:
+        cfg = prep['cfg']
+        if cfg is None:
+            # The file was modified since the configuration was prepared.
+            prep = prepare_config(spconfig.m())
+            if prep['error'] is not None:
+                spcstatus.npset('blocked', prep['error'])
+                return
+            cfg = prep['cfg']
         oid = cfg['SP_OURID']
+        rdebug('got {len} keys in the StorPool config, our id is {oid}',
+               len=len(cfg), oid=oid)
+
+        install_conf(contents)
+        rdebug('it seems that {conf} has been created', conf=STORPOOL_CONF)
+        spconfig.drop_cache()
+        spcconfindex.remember(cfg, STORPOOL_CONF)
         spconfig.set_our_id(oid)
-        rdebug('got {len} keys in the StorPool config, our id is {oid}'
-               .format(len=len(cfg), oid=oid))
+
+        st = spcfiles.stat_key(STORPOOL_CONF)
+        if st is not None:
+            unitdata.kv().set(KV_CONF_RECORD, {
+                'digest': digest,
+                'stat': st,
+                'oid': oid,
+            })
+        else:
+            unitdata.kv().unset(KV_CONF_RECORD)
 
     rdebug('setting the config-written state')
     reactive.set_state('l-storpool-config.config-written')
-    spstatus.npset('maintenance', '')
+    spcstatus.npset('maintenance', '')
+
+
+@reactive.when('l-storpool-config.config-written')
+@reactive.when_not('l-storpool-config.hugepages')
+@reactive.when_not('l-storpool-config.stopped')
+@spcperf.stage('reserve-hugepages')
+def reserve_hugepages():
+    """
+    Reserve the hugepages needed by the StorPool services if requested.
+    """
+    if sputils.check_in_lxc():
+        rdebug('running in an LXC container, not reserving hugepages')
+        reactive.set_state('l-storpool-config.hugepages')
+        return
+    if not stage_may_proceed('memory'):
+        return
+
+    hplan = None
+    if spconfig.m().get('hugepages', False):
+        cfg = spcconfindex.get_config(STORPOOL_CONF)
+        try:
+            hplan = spchugepages.plan(cfg)
+        except ValueError as e:
+            spcstatus.npset('blocked', 'cannot reserve hugepages: {e}'
+                                       .format(e=e))
+            return
+    rdebug('hugepages plan: {hplan}', hplan=hplan)
+
+    spcstatus.npset('maintenance', 'reserving hugepages')
+    spchugepages.persist(hplan)
+    if hplan is not None:
+        report = spchugepages.reserve(hplan)
+        missing = spchugepages.shortfall(report)
+        if missing:
+            hookenv.log('storpool-config: could only reserve {got} of {want} '
+                        'hugepages, the rest will be reserved at the next '
+                        'boot'.format(want=hplan['total'],
+                                      got=hplan['total'] - missing),
+                        hookenv.WARNING)
+        rdebug('hugepages reservation: {report}', report=report,
+               level=spclog.INFO)
+
+    reactive.set_state('l-storpool-config.hugepages')
+    spcstatus.npset('maintenance', '')
 
 
 @reactive.when('l-storpool-config.config-written')
 @reactive.when_not('l-storpool-config.config-network')
 @reactive.when_not('l-storpool-config.stopped')
+@spcperf.stage('setup-interfaces')
 def setup_interfaces():
     """
     Set up the IPv4 addresses of some interfaces if requested.
@@ -201,26 +703,195 @@ def setup_interfaces():
         rdebug('running in an LXC container, not setting up interfaces')
         reactive.set_state('l-storpool-config.config-network')
         return
+    if not stage_may_proceed('network'):
+        return
 
     rdebug('trying to parse the StorPool interface configuration')
-    spstatus.npset('maintenance',
-                   'parsing the StorPool interface configuration')
-    cfg = spconfig.get_dict()
+    spcstatus.npset('maintenance',
+                    'parsing the StorPool interface configuration')
+    cfg = spcconfindex.get_config(STORPOOL_CONF)
     ifaces = cfg.get('SP_IFACE', None)
     if ifaces is None:
         hookenv.set('error', 'No SP_IFACES in the StorPool config')
         return
-    rdebug('got interfaces: {ifaces}'.format(ifaces=ifaces))
+    rdebug('got interfaces: {ifaces}', ifaces=ifaces)
 
-    spcnetwork.fixup_interfaces(ifaces)
+    try:
+        (profile, irq_exclude) = network_options(spconfig.m())
+    except ValueError as e:
+        spcstatus.npset('blocked', str(e))
+        return
+    if irq_exclude is not None:
+        rdebug('about to pin the StorPool interfaces\' interrupts, '
+               'avoiding CPUs {cpus}', cpus=irq_exclude)
+
+    prep = _prepared.pop('network', None)
+    if prep is not None and prep['key'] == [ifaces, profile, irq_exclude]:
+        rdebug('using the interface changes planned during the package '
+               'installation')
+        spcnetwork.commit_plan(prep['plan'])
+    else:
+        try:
+            spcnetwork.fixup_interfaces(ifaces, profile=profile,
+                                        irq_exclude=irq_exclude)
+        except ValueError as e:
+            spcstatus.npset('blocked', 'invalid SP_IFACE "{ifaces}": {e}'
+                                       .format(ifaces=ifaces, e=e))
+            return
 
     rdebug('well, looks like it is all done...')
     reactive.set_state('l-storpool-config.config-network')
-    spstatus.npset('maintenance', '')
+    spcstatus.npset('maintenance', '')
+
+
+@reactive.when('l-storpool-config.config-network')
+@reactive.when_not('l-storpool-config.cpuset')
+@reactive.when_not('l-storpool-config.stopped')
+@spcperf.stage('plan-cpus')
+def plan_cpus():
+    """
+    Dedicate some CPU cores to the StorPool services if requested.
+    """
+    if sputils.check_in_lxc():
+        rdebug('running in an LXC container, not choosing any CPUs')
+        reactive.set_state('l-storpool-config.cpuset')
+        return
+    if not stage_may_proceed('cpus'):
+        return
+
+    config = spconfig.m()
+    cores = config.get('storpool_cores', None)
+    try:
+        count = int(cores or 0)
+    except ValueError:
+        count = -1
+    if count < 0:
+        spcstatus.npset('blocked', 'invalid storpool_cores "{cores}"'
+                                   .format(cores=cores))
+        return
+
+    cpus = None
+    if count > 0:
+        reason = spccpuplan.unsupported()
+        if reason is not None:
+            spcstatus.npset('blocked', reason)
+            return
+        cfg = spcconfindex.get_config(STORPOOL_CONF)
+        try:
+            cplan = spccpuplan.plan(cfg.get('SP_IFACE', None) or '', count)
+        except ValueError as e:
+            spcstatus.npset('blocked', str(e))
+            return
+        rdebug('StorPool CPU plan: {cplan}', cplan=cplan, level=spclog.INFO)
+        cpus = cplan['cpus']
+
+    spcstatus.npset('maintenance', 'dedicating CPUs to the StorPool services')
+    if spccpuplan.apply(cpus) and config.get('irq_pinning', False):
+        rdebug('the StorPool CPUs have changed, pinning the interrupts again')
+        reactive.remove_state('l-storpool-config.config-network')
+
+    reactive.set_state('l-storpool-config.cpuset')
+    spcstatus.npset('maintenance', '')
+
+
+@reactive.when('l-storpool-config.config-network')
+@reactive.when_not('l-storpool-config.network-applied')
+@reactive.when_not('l-storpool-config.stopped')
+@spcperf.stage('apply-interfaces')
+def apply_interfaces():
+    """
+    Apply the MTU and NIC settings to the live network interfaces instead of
+    waiting for them to be brought up again.
+    """
+    if sputils.check_in_lxc():
+        rdebug('running in an LXC container, not touching the interfaces')
+        reactive.set_state('l-storpool-config.network-applied')
+        return
+
+    rdebug('about to apply the network settings to the live interfaces')
+    spcstatus.npset('maintenance',
+                    'applying the StorPool network interface settings',
+                    immediate=True)
+    failed = spcnetwork.apply_interfaces()
+    if failed:
+        rdebug('{cnt} network command(s) failed, the settings will be '
+               'applied at the next ifup', cnt=failed)
+
+    reactive.set_state('l-storpool-config.network-applied')
+    spcstatus.npset('maintenance', '')
+
+
+@reactive.hook('update-status')
+@spcperf.stage('check-drift')
+def check_drift():
+    """
+    Check whether the files and the settings that we manage have been
+    changed behind our back and only redo the stages that they belong to.
+    """
+    is_state = reactive.helpers.is_state
+    if is_state('l-storpool-config.stopped'):
+        return
+
+    if is_state('l-storpool-config.config-written') and conf_drifted():
+        rdebug('the {conf} file has been modified, writing it out again',
+               conf=STORPOOL_CONF, level=spclog.INFO)
+        reactive.remove_state('l-storpool-config.config-written')
+
+    if is_state('l-storpool-config.config-network'):
+        drifted = spcdrift.config_drift()
+        if drifted:
+            rdebug('the network configuration has been modified: {files}',
+                   files=' '.join(drifted), level=spclog.INFO)
+            reactive.remove_state('l-storpool-config.config-network')
+
+    if is_state('l-storpool-config.network-applied'):
+        drifted = spcdrift.mtu_drift()
+        if drifted:
+            rdebug('the MTU of {ifaces} has changed, applying the network '
+                   'settings again', ifaces=' '.join(drifted),
+                   level=spclog.INFO)
+            reactive.remove_state('l-storpool-config.network-applied')
+
+
+def rollback_files():
+    """
+    Roll back the txn-installed files and let the boot loader, systemd,
+    and irqbalance know about the removed ones.
+    """
+    def removed(paths):
+        """
+        Return the files among `paths` that the rollback has removed.
+        """
+        return [path for path in paths
+                if path in existed and not os.path.exists(path)]
+
+    grub = [spchugepages.GRUB_SNIPPET]
+    units = [spccpuplan.SLICE_DROPIN, spcirq.IRQBALANCE_DROPIN]
+    irqbalance = [spcirq.IRQBALANCE_DROPIN, spcirq.POLICY_SCRIPT]
+    existed = set(path for path in grub + units + irqbalance
+                  if os.path.exists(path))
+
+    rdebug('about to roll back any txn-installed files')
+    txn.rollback_if_needed()
+
+    if removed(grub):
+        rdebug('removed {path}, regenerating the boot loader configuration',
+               path=spchugepages.GRUB_SNIPPET)
+        spcperf.count_procs()
+        subprocess.call(['update-grub'])
+    if removed(units):
+        rdebug('removed our systemd drop-ins, reloading systemd')
+        spcperf.count_procs()
+        subprocess.call(['systemctl', 'daemon-reload'])
+    if removed(irqbalance):
+        rdebug('removed the irqbalance ban list, restarting it')
+        spcperf.count_procs()
+        subprocess.call(['systemctl', 'try-restart', 'irqbalance.service'])
 
 
 @reactive.when('l-storpool-config.stop')
 @reactive.when_not('l-storpool-config.stopped')
+@spcperf.stage('remove-leftovers')
 def remove_leftovers():
     """
     Clean up, remove configuration files, uninstall packages.
@@ -229,40 +900,35 @@ def remove_leftovers():
     reactive.remove_state('l-storpool-config.stop')
 
     try:
-        rdebug('about to roll back any txn-installed files')
-        txn.rollback_if_needed()
+        rollback_files()
     except Exception as e:
-        rdebug('Could not run txn rollback: {e}'.format(e=e))
+        rdebug('Could not run txn rollback: {e}', e=e)
 
     if not sputils.check_in_lxc():
         try:
             rdebug('about to remove any loaded kernel modules')
-
-            mods_b = subprocess.check_output(['lsmod'])
-            for module_data in mods_b.decode().split('\n'):
-                module = module_data.split(' ', 1)[0]
-                rdebug('- got module {mod}'.format(mod=module))
-                if module.startswith('storpool_'):
-                    rdebug('  - trying to remove it')
-                    subprocess.call(['rmmod', module])
+            report = spckmod.unload_modules()
+            rdebug('removed kernel modules: {lst}',
+                   lst=' '.join(report['removed']))
 
             # Any remaining? (not an error, just, well...)
-            rdebug('checking for any remaining StorPool modules')
-            remaining = []
-            mods_b = subprocess.check_output(['lsmod'])
-            for module_data in mods_b.decode().split('\n'):
-                module = module_data.split(' ', 1)[0]
-                if module.startswith('storpool_'):
-                    remaining.append(module)
-            if remaining:
-                rdebug('some modules were left over: {lst}'
-                       .format(lst=' '.join(sorted(remaining))))
+            if report['remaining']:
+                if spclog.enabled(spclog.TRACE):
+                    for name, mod in sorted(report['remaining'].items()):
+                        rdebug('- module {name} was left over: {reason}',
+                               name=name, reason=mod['reason'],
+                               level=spclog.TRACE)
+                rdebug('{cnt} module(s) were left over',
+                       cnt=len(report['remaining']))
             else:
                 rdebug('looks like we got rid of them all!')
 
             rdebug('that is all for the modules')
         except Exception as e:
-            rdebug('Could not remove kernel modules: {e}'.format(e=e))
+            rdebug('Could not remove kernel modules: {e}', e=e)
+
+    rdebug('stopping any package downloads')
+    spcprefetch.cancel()
 
     rdebug('removing any config-related packages')
     sprepo.unrecord_packages('storpool-config')
@@ -0,0 +1,66 @@
+#!/usr/bin/python3
+
+"""
+Generate synthetic /etc/network/interfaces trees for the benchmarks.
+"""
+
+import os
+
+
+def iface_name(idx):
+    """
+    Return the name of the idx-th generated interface.
+    """
+    return 'eth{idx}'.format(idx=idx)
+
+
+def write_stanzas(fname, first, count, include=None):
+    """
+    Write `count` interface stanzas starting with the `first` interface,
+    optionally preceded by a "source-directory" directive.
+    """
+    with open(fname, mode='w') as f:
+        if include is not None:
+            print('source-directory {inc}\n'.format(inc=include), file=f)
+        for idx in range(first, first + count):
+            name = iface_name(idx)
+            print('auto {name}\n'
+                  'iface {name} inet manual\n'
+                  '    post-up /bin/true\n'.format(name=name), file=f)
+
+
+def generate_tree(base, stanzas, depth=4, per_file=50):
+    """
+    Create an /etc/network/interfaces-like tree under the `base` directory:
+    a main file that includes a directory of files, the first of which
+    includes the next directory and so on `depth` levels deep, with
+    `stanzas` interface stanzas spread evenly across the levels.
+    Return the path to the main file and the list of interface names.
+    """
+    main = os.path.join(base, 'interfaces')
+    with open(main, mode='w') as f:
+        print('auto lo\niface lo inet loopback\n', file=f)
+        print('source-directory {base}/interfaces.d'.format(base=base),
+              file=f)
+
+    per_level = [stanzas // depth + (1 if lvl < stanzas % depth else 0)
+                 for lvl in range(depth)]
+    first = 0
+    dirname = os.path.join(base, 'interfaces.d')
+    for lvl in range(depth):
+        os.mkdir(dirname)
+        subdir = os.path.join(dirname, 'sub')
+        include = subdir if lvl + 1 < depth else None
+        files = max((per_level[lvl] + per_file - 1) // per_file, 1)
+        left = per_level[lvl]
+        for fidx in range(files):
+            count = min(per_file, left)
+            write_stanzas(os.path.join(dirname,
+                                       'ifaces-{idx:04}'.format(idx=fidx)),
+                          first, count,
+                          include=include if fidx == 0 else None)
+            first += count
+            left -= count
+        dirname = subdir
+
+    return (main, [iface_name(idx) for idx in range(stanzas)])
@@ -0,0 +1,316 @@
+#!/usr/bin/python3
+
+"""
+Benchmarks for the storpool-config network configuration update and
+the reactive handler chain.  Run from the top of the source tree:
+
+    python3 -m unit_tests.bench.run [--update] [--threshold 1.5]
+
+The results are compared to the ones stored in baseline.json and
+the program exits with a non-zero status if any of them are slower than
+the baseline by more than the threshold factor.
+"""
+
+import argparse
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+import mock
+
+root_path = os.path.realpath('.')
+if root_path not in sys.path:
+    sys.path.insert(0, root_path)
+
+from unit_tests import test_config as tconfig
+from unit_tests import test_network as tnetwork
+from unit_tests.bench import gentree
+
+BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                        'baseline.json')
+
+DEFAULT_SIZES = [200, 1000, 5000]
+DEFAULT_THRESHOLD = 1.5
+
+# Differences smaller than this are treated as noise.
+MIN_DIFF = 0.002
+
+REPEAT = 5
+
+
+class DictKV(object):
+    """
+    A minimal in-memory replacement for the unitdata key/value store.
+    """
+
+    def __init__(self):
+        self.data = {}
+
+    def get(self, key, default=None):
+        return self.data.get(key, default)
+
+    def set(self, key, value):
+        self.data[key] = value
+
+    def unset(self, key):
+        self.data.pop(key, None)
+
+
+def txn_copy(*args, **kwargs):
+    """
+    Install the files by copying them into the target.
+    """
+    if '--' in args:
+        args = args[args.index('--') + 1:]
+    for fname in args[:-1]:
+        shutil.copy(fname, args[-1])
+
+
+def measure(func, setup=None, repeat=REPEAT):
+    """
+    Run `setup` (untimed) and then `func` (timed) `repeat` times and
+    return the shortest time.
+    """
+    best = None
+    for _ in range(repeat):
+        arg = setup() if setup is not None else None
+        start = time.perf_counter()
+        func(arg)
+        elapsed = time.perf_counter() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+
+def bench_fixup_file(tempd, size):
+    """
+    Time fixup_interfaces_file() on a fresh tree with every tenth
+    interface missing a line, and then again on the updated tree with
+    a warm cache and nothing left to do.
+    """
+    spcifaces = tnetwork.spcifaces
+    spcnetwork = tnetwork.spcnetwork
+    counter = [0]
+    state = {}
+
+    def setup():
+        counter[0] += 1
+        base = os.path.join(tempd, 'fixup-{size}-{cnt}'
+                            .format(size=size, cnt=counter[0]))
+        os.mkdir(base)
+        (main, names) = gentree.generate_tree(base, size)
+        data = dict((name, ['mtu 9000']) for name in names[::10])
+        cache = spcifaces.InterfacesCache()
+        state.update(main=main, data=data, cache=cache)
+        return state
+
+    def run(st):
+        spcnetwork.fixup_interfaces_file(st['main'], st['data'], set(),
+                                         st['cache'])
+
+    def warm():
+        return state
+
+    res = {}
+    with mock.patch.object(tnetwork.txn, 'install', new=txn_copy):
+        res['fixup_file_cold_{size}'.format(size=size)] = \
+            measure(run, setup)
+        res['fixup_file_warm_{size}'.format(size=size)] = \
+            measure(run, warm)
+    return res
+
+
+def bench_fixup_interfaces(tempd, size):
+    """
+    Time a full fixup_interfaces() run for two physical NICs against
+    a generated tree and a fake sysfs, starting with an empty
+    interfaces cache each time.
+    """
+    spcnetwork = tnetwork.spcnetwork
+    spctuning = tnetwork.spctuning
+    base = os.path.join(tempd, 'full-{size}'.format(size=size))
+    sysroot = os.path.join(base, 'root')
+    os.makedirs(sysroot)
+    for iface in ('eth0', 'eth1'):
+        tnetwork.create_fake_nic(sysroot, iface, 25000)
+    (main, _) = gentree.generate_tree(base, size)
+    real_fixup = spcnetwork.fixup_interfaces_file
+    kv = DictKV()
+
+    def fixup_file(fname, data, handled, cache=None):
+        return real_fixup(main, data, handled, cache)
+
+    def setup():
+        kv.data.clear()
+
+    def run(_):
+        spcnetwork.fixup_interfaces('eth0,eth1', sysroot=sysroot,
+                                    backend='ifupdown')
+
+    with mock.patch.object(tnetwork.txn, 'install', new=txn_copy), \
+            mock.patch.object(spcnetwork, 'fixup_interfaces_file',
+                              new=fixup_file), \
+            mock.patch.object(spctuning, 'run_ethtool',
+                              new=tnetwork.fake_ethtool), \
+            mock.patch('charmhelpers.core.unitdata.kv', new=lambda: kv):
+        return {
+            'fixup_interfaces_{size}'.format(size=size):
+            measure(run, setup),
+        }
+
+
+def bench_handlers(tempd):
+    """
+    Time the config_changed -> install_package -> write_out_config ->
+    setup_interfaces handler chain over the test suite's mocks.
+    """
+    testee = tconfig.testee
+    r_state = tconfig.r_state
+    r_config = tconfig.r_config
+    r_kv = tconfig.r_kv
+    conf_path = os.path.join(tempd, 'storpool.conf')
+
+    def setup():
+        r_state.r_set_states([
+            'storpool-helper.config-set',
+            'storpool-repo-add.available',
+            'l-storpool-config.configure',
+        ])
+        r_config.r_clear_config()
+        hosts = ''.join('[node{idx}]\nSP_OURID={idx}\n'.format(idx=idx)
+                        for idx in range(2, 300))
+        r_config.r_set('storpool_conf',
+                       'SP_OURID=1\nSP_IFACE=eth0,eth1\n{hosts}'
+                       .format(hosts=hosts))
+        r_config.r_set('storpool_version', '19.01')
+        r_kv.r_clear_kv()
+        if os.path.exists(conf_path):
+            os.unlink(conf_path)
+
+    def run(_):
+        testee.config_changed()
+        testee.install_package()
+        testee.write_out_config()
+        testee.setup_interfaces()
+        assert r_state.is_state('l-storpool-config.config-network')
+
+    with mock.patch('charms.reactive.set_state', new=r_state.set_state), \
+            mock.patch('charms.reactive.remove_state',
+                       new=r_state.remove_state), \
+            mock.patch('charms.reactive.helpers.is_state',
+                       new=r_state.is_state), \
+            mock.patch('charmhelpers.core.hookenv.charm_dir',
+                       new=os.getcwd), \
+            mock.patch.object(testee, 'STORPOOL_CONF', new=conf_path), \
+            mock.patch.object(tconfig.txn, 'install', new=txn_copy), \
+            mock.patch.object(tconfig.sprepo, 'install_packages',
+                              return_value=(None, [])), \
+            mock.patch.object(tconfig.sputils, 'check_in_lxc',
+                              return_value=False), \
+            mock.patch.object(tconfig.spconfig, 'set_our_id'), \
+            mock.patch.object(testee.spctuning, 'PROFILES',
+                              new=tnetwork.spctuning.PROFILES):
+        return {
+            'handler_chain': measure(run, setup),
+        }
+
+
+def run_all(sizes):
+    """
+    Run all the benchmarks, return a dictionary of the results.
+    """
+    tempd = tempfile.mkdtemp(prefix='bench-config.')
+    try:
+        res = {}
+        for size in sizes:
+            res.update(bench_fixup_file(tempd, size))
+            res.update(bench_fixup_interfaces(tempd, size))
+        res.update(bench_handlers(tempd))
+        return res
+    finally:
+        shutil.rmtree(tempd)
+
+
+def compare(results, baseline, threshold):
+    """
+    Print the results next to the baseline ones; return the names of
+    the benchmarks that have regressed.
+    """
+    regressed = []
+    for name in sorted(results.keys()):
+        value = results[name]
+        base = baseline.get(name)
+        if base is None:
+            print('{name:28} {value:10.4f}s'.format(name=name, value=value))
+            continue
+        ratio = value / base if base > 0 else 0.0
+        bad = value > base * threshold and value - base > MIN_DIFF
+        print('{name:28} {value:10.4f}s  baseline {base:.4f}s  x{ratio:.2f}'
+              '{bad}'.format(name=name, value=value, base=base, ratio=ratio,
+                             bad='  REGRESSION' if bad else ''))
+        if bad:
+            regressed.append(name)
+    return regressed
+
+
+def main():
+    """
+    Parse the command-line options, run the benchmarks.
+    """
+    parser = argparse.ArgumentParser(
+        prog='bench',
+        description='Benchmark the storpool-config network fixup and '
+                    'handler chain')
+    parser.add_argument('-b', '--baseline', default=BASELINE,
+                        help='the file with the stored baseline results')
+    parser.add_argument('-o', '--output',
+                        help='also write the results to this JSON file')
+    parser.add_argument('-s', '--sizes',
+                        help='comma-separated tree sizes (default: {sizes})'
+                        .format(sizes=','.join(map(str, DEFAULT_SIZES))))
+    parser.add_argument('-t', '--threshold', type=float,
+                        help='the allowed slowdown factor (default: '
+                        'the one in the baseline file or {thr})'
+                        .format(thr=DEFAULT_THRESHOLD))
+    parser.add_argument('-u', '--update', action='store_true',
+                        help='store the results as the new baseline')
+    args = parser.parse_args()
+
+    sizes = DEFAULT_SIZES if args.sizes is None else \
+        [int(size) for size in args.sizes.split(',')]
+    try:
+        with open(args.baseline, mode='r') as f:
+            stored = json.load(f)
+    except (IOError, OSError):
+        stored = {}
+    threshold = args.threshold if args.threshold is not None else \
+        stored.get('threshold', DEFAULT_THRESHOLD)
+
+    results = run_all(sizes)
+    regressed = compare(results, stored.get('results', {}), threshold)
+
+    if args.output is not None:
+        with open(args.output, mode='w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+    if args.update:
+        with open(args.baseline, mode='w') as f:
+            rounded = dict((name, round(value, 6))
+                           for (name, value) in results.items())
+            json.dump({'threshold': threshold, 'results': rounded}, f,
+                      indent=2, sort_keys=True)
+            print('', file=f)
+        print('Stored the results in {fname}'.format(fname=args.baseline))
+        return 0
+
+    if regressed:
+        print('Regressions (threshold x{thr}): {names}'
+              .format(thr=threshold, names=', '.join(regressed)))
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -2,4 +2,20 @@
 
 import mock
 
+clusterconf = mock.Mock()
+confindex = mock.Mock()
+cpuplan = mock.Mock()
+dpkg = mock.Mock()
+drift = mock.Mock()
+files = mock.Mock()
+hugepages = mock.Mock()
+irq = mock.Mock()
+kmod = mock.Mock()
+lazy = mock.Mock()
+log = mock.Mock()
 network = mock.Mock()
+perf = mock.Mock()
+prefetch = mock.Mock()
+status = mock.Mock()
+tuning = mock.Mock()
+worker = mock.Mock()
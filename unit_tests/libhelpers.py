@@ -0,0 +1,59 @@
+#!/usr/bin/python3
+
+"""
+Helpers for testing the storpool-config layer's own library modules.
+"""
+
+import importlib
+import os
+import sys
+import types
+
+
+def load_confighelpers(*names):
+    """
+    Load the real spcharms.confighelpers modules, leaving the rest of
+    the spcharms package mocked.
+    """
+    prefix = 'spcharms.confighelpers'
+
+    def ours(name):
+        return name == prefix or name.startswith(prefix + '.')
+
+    # Only forget about the helper modules afterwards; anything else that
+    # they import, e.g. charmhelpers, must stay the same module object so
+    # that the tests can patch it.
+    saved = dict((name, mod) for (name, mod) in sys.modules.items()
+                 if ours(name))
+    try:
+        pkg = types.ModuleType(prefix)
+        pkg.__path__ = [os.path.realpath('lib/spcharms/confighelpers')]
+        sys.modules[prefix] = pkg
+        return tuple(map(lambda name: importlib.import_module(
+            prefix + '.' + name), names))
+    finally:
+        for name in [name for name in sys.modules.keys() if ours(name)]:
+            del sys.modules[name]
+        sys.modules.update(saved)
+
+
+def create_fake_nic(sysroot, iface, speed, driver='mlx5_core', numa=0,
+                    queues=4, mtu=1500):
+    """
+    Create the sysfs files for a fake network interface.
+    """
+    base = os.path.join(sysroot, 'sys', 'class', 'net', iface)
+    drvdir = os.path.join(sysroot, 'sys', 'bus', 'pci', 'drivers', driver)
+    if not os.path.isdir(drvdir):
+        os.makedirs(drvdir)
+    os.makedirs(os.path.join(base, 'device'))
+    os.symlink(drvdir, os.path.join(base, 'device', 'driver'))
+    for idx in range(queues):
+        os.makedirs(os.path.join(base, 'queues', 'rx-{idx}'.format(idx=idx)))
+        os.makedirs(os.path.join(base, 'queues', 'tx-{idx}'.format(idx=idx)))
+    with open(os.path.join(base, 'speed'), mode='w') as f:
+        print(speed, file=f)
+    with open(os.path.join(base, 'device', 'numa_node'), mode='w') as f:
+        print(numa, file=f)
+    with open(os.path.join(base, 'mtu'), mode='w') as f:
+        print(mtu, file=f)
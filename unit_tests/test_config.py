@@ -5,12 +5,17 @@ A set of unit tests for the storpool-config layer.
 """
 
 import os
+import shutil
+import subprocess
 import sys
+import tempfile
+import threading
 import unittest
 
 import mock
 
-from charmhelpers.core import hookenv
+from charms import reactive
+from charmhelpers.core import hookenv, unitdata
 
 root_path = os.path.realpath('.')
 if root_path not in sys.path:
@@ -21,11 +26,23 @@ if lib_path not in sys.path:
     sys.path.insert(0, lib_path)
 
 from spcharms import config as spconfig
+from spcharms import confighelpers as spconfighelpers
 from spcharms import repo as sprepo
 from spcharms import status as spstatus
 from spcharms import txn
 from spcharms import utils as sputils
 
+from unit_tests.libhelpers import load_confighelpers
+
+# The StorPool config index, the file, logging, performance measurement
+# and status helpers, the background worker, and the lazy module loader
+# are simple enough to test along with the rest.
+(spconfighelpers.clusterconf, spconfighelpers.confindex,
+ spconfighelpers.files, spconfighelpers.lazy, spconfighelpers.log,
+ spconfighelpers.perf, spconfighelpers.status, spconfighelpers.worker) = \
+    load_confighelpers('clusterconf', 'confindex', 'files', 'lazy', 'log',
+                       'perf', 'status', 'worker')
+
 
 class MockReactive(object):
     def r_clear_states(self):
@@ -90,11 +107,30 @@ class MockConfig(object):
                              '"{name}" attribute'.format(name=name))
 
 
+class MockKV(object):
+    def r_clear_kv(self):
+        self.data = {}
+
+    def __init__(self):
+        self.r_clear_kv()
+
+    def get(self, key, default=None):
+        return self.data.get(key, default)
+
+    def set(self, key, value):
+        self.data[key] = value
+
+    def unset(self, key):
+        self.data.pop(key, None)
+
+
 r_state = MockReactive()
 r_config = MockConfig()
+r_kv = MockKV()
 
 # Do not give hookenv.config() a chance to run at all
 hookenv.config = lambda: exit('You just called to say... what?!')
+unitdata.kv = lambda: r_kv
 spconfig.m = lambda: r_config
 
 
@@ -128,11 +164,35 @@ class TestStorPoolConfig(unittest.TestCase):
         super(TestStorPoolConfig, self).setUp()
         r_state.r_clear_states()
         r_config.r_clear_config()
+        r_kv.r_clear_kv()
+        testee._prepared.clear()
         sputils.err.side_effect = lambda *args: self.fail_on_err(*args)
 
     def fail_on_err(self, msg):
         self.fail('sputils.err() invoked: {msg}'.format(msg=msg))
 
+    @mock.patch('charmhelpers.core.hookenv.hook_name')
+    def test_register(self, hook_name):
+        """
+        Test that the state mappings are registered on install and again
+        on upgrade, so that the already deployed units get the new ones.
+        """
+        handler = reactive.bus.Handler.get(testee.register)
+        r_kv.set('reactive.dispatch.phase', 'hooks')
+        for (hook, expected) in (('install', True),
+                                 ('upgrade-charm', True),
+                                 ('config-changed', False),
+                                 ('update-status', False)):
+            hook_name.return_value = hook
+            self.assertEqual(expected, handler.test(), hook)
+
+        with mock.patch.object(testee.spstates, 'register') as register:
+            testee.register()
+            register.assert_called_once_with('storpool-config', {
+                'config-changed': testee.STATES_CONFIG_CHANGED,
+                'upgrade-charm': testee.STATES_REDO,
+            })
+
     @mock_reactive_states
     @mock.patch('spcharms.status.npset')
     def test_check_config(self, npset):
@@ -215,6 +275,8 @@ class TestStorPoolConfig(unittest.TestCase):
         self.assertEquals(count_npset + 1, npset.call_count)
         self.assertEquals(count_unset + 7, spconfig.unset_our_id.call_count)
 
+        # Forget what we applied last time, redo everything
+        r_kv.r_clear_kv()
         r_state.r_set_states(states['weird'])
         r_config.r_set('storpool_conf', 'something')
         testee.config_changed()
@@ -222,6 +284,7 @@ class TestStorPoolConfig(unittest.TestCase):
         self.assertEquals(count_npset + 2, npset.call_count)
         self.assertEquals(count_unset + 8, spconfig.unset_our_id.call_count)
 
+        r_kv.r_clear_kv()
         r_state.r_set_states(states['all'])
         r_config.r_set('storpool_conf', 'something')
         testee.config_changed()
@@ -229,6 +292,118 @@ class TestStorPoolConfig(unittest.TestCase):
         self.assertEquals(count_npset + 3, npset.call_count)
         self.assertEquals(count_unset + 9, spconfig.unset_our_id.call_count)
 
+    @mock_reactive_states
+    @mock.patch('spcharms.status.npset')
+    def test_check_config_changes(self, npset):
+        """
+        Test that the config-changed hook only redoes the stages affected
+        by the changed charm config options.
+        """
+        done = set([
+            'l-storpool-config.config-available',
+            'l-storpool-config.config-written',
+            'l-storpool-config.config-network',
+            'l-storpool-config.package-installed',
+        ])
+        count_unset = spconfig.unset_our_id.call_count
+
+        # The first time around everything is redone.
+        r_config.r_set('storpool_conf', 'something')
+        r_config.r_set('storpool_version', '0.1.0')
+        r_state.r_set_states(done)
+        testee.config_changed()
+        self.assertEquals(set([
+            'l-storpool-config.config-available',
+            'l-storpool-config.package-try-install',
+        ]), r_state.r_get_states())
+        self.assertEquals(count_unset + 1, spconfig.unset_our_id.call_count)
+
+        # Nothing changed, nothing to redo.
+        r_state.r_set_states(done)
+        testee.config_changed()
+        self.assertEquals(done | set([
+            'l-storpool-config.package-try-install',
+        ]), r_state.r_get_states())
+        self.assertEquals(count_unset + 1, spconfig.unset_our_id.call_count)
+
+        # Only the package version changed.
+        r_state.r_set_states(done)
+        r_config.r_set('storpool_version', '0.2.0')
+        testee.config_changed()
+        self.assertEquals(set([
+            'l-storpool-config.config-available',
+            'l-storpool-config.config-written',
+            'l-storpool-config.config-network',
+            'l-storpool-config.package-try-install',
+        ]), r_state.r_get_states())
+        self.assertEquals(count_unset + 1, spconfig.unset_our_id.call_count)
+
+        # Only the StorPool configuration changed.
+        r_state.r_set_states(done)
+        r_config.r_set('storpool_conf', 'something else')
+        testee.config_changed()
+        self.assertEquals(set([
+            'l-storpool-config.config-available',
+            'l-storpool-config.package-installed',
+            'l-storpool-config.package-try-install',
+        ]), r_state.r_get_states())
+        self.assertEquals(count_unset + 2, spconfig.unset_our_id.call_count)
+
+    @mock_reactive_states
+    @mock.patch('socket.gethostname')
+    def test_check_config_structured(self, gethostname):
+        """
+        Test that only changes to the common settings or to this unit's
+        section of the structured configuration are acted upon.
+        """
+        def structured(node1, node2):
+            return 'common:\n  SP_CLUSTER_ID: a.a\n' \
+                'hosts:\n  node1:\n    SP_OURID: {n1}\n' \
+                '  node2:\n    SP_OURID: {n2}\n'.format(n1=node1, n2=node2)
+
+        done = set([
+            'l-storpool-config.config-available',
+            'l-storpool-config.config-written',
+            'l-storpool-config.config-network',
+            'l-storpool-config.package-installed',
+        ])
+        gethostname.return_value = 'node1.example.com'
+        r_config.r_set('storpool_version', '0.1.0')
+        r_config.r_set('storpool_conf_yaml', structured(1, 2))
+        self.assertEquals('SP_CLUSTER_ID=a.a\n\n[node1]\nSP_OURID=1\n',
+                          testee.effective_conf(r_config))
+        testee.config_changed()
+        self.assertEquals(set([
+            'l-storpool-config.config-available',
+            'l-storpool-config.package-try-install',
+        ]), r_state.r_get_states())
+
+        # Another host's section changed, nothing to do here.
+        r_state.r_set_states(done)
+        r_config.r_set('storpool_conf_yaml', structured(1, 3))
+        testee.config_changed()
+        self.assertEquals(done | set([
+            'l-storpool-config.package-try-install',
+        ]), r_state.r_get_states())
+
+        # Our own section changed.
+        r_config.r_set('storpool_conf_yaml', structured(4, 3))
+        testee.config_changed()
+        self.assertEquals(set([
+            'l-storpool-config.config-available',
+            'l-storpool-config.package-installed',
+            'l-storpool-config.package-try-install',
+        ]), r_state.r_get_states())
+
+        # An invalid structured configuration changes nothing.
+        r_state.r_set_states(done)
+        count_npset = spstatus.npset.call_count
+        r_config.r_set('storpool_conf_yaml', 'hosts: [node1]')
+        testee.config_changed()
+        self.assertEquals(done, r_state.r_get_states())
+        self.assertEquals(count_npset + 1, spstatus.npset.call_count)
+        self.assertEquals('blocked', spstatus.npset.call_args[0][0])
+
     @mock_reactive_states
     def test_install_package(self):
         """
@@ -281,6 +456,225 @@ class TestStorPoolConfig(unittest.TestCase):
         self.assertEquals(count_record + 1, sprepo.record_packages.call_count)
         self.assertEquals(set([INSTALLED_STATE]), r_state.r_get_states())
 
+    @mock_reactive_states
+    def test_install_package_installed(self):
+        """
+        Test that apt is not run if the packages are already installed.
+        """
+        count_install = sprepo.install_packages.call_count
+        r_config.r_set('storpool_version', '0.1.0')
+        r_state.r_set_states(set(['l-storpool-config.package-try-install']))
+
+        with mock.patch.object(testee.spcdpkg, 'missing') as missing:
+            missing.return_value = {}
+            testee.install_package()
+            missing.assert_called_once_with({
+                'txn-install': '*',
+                'storpool-config': '0.1.0',
+            })
+        self.assertEquals(count_install, sprepo.install_packages.call_count)
+        self.assertEquals(set([INSTALLED_STATE]), r_state.r_get_states())
+
+    @mock_reactive_states
+    @mock.patch('charmhelpers.core.hookenv.charm_dir')
+    def test_install_package_prepare(self, charm_dir):
+        """
+        Test that the configuration is prepared while apt is running and
+        that the later stages only install it.
+        """
+        tempd = tempfile.mkdtemp(prefix='test-config.')
+        self.addCleanup(shutil.rmtree, tempd)
+        conf_path = os.path.join(tempd, 'storpool.conf')
+        charm_dir.return_value = os.getcwd()
+        r_config.r_set('storpool_version', '0.1.0')
+        r_config.r_set('storpool_conf', 'SP_OURID=1\nSP_IFACE=eth1\n')
+        r_state.r_set_states(set(['l-storpool-config.package-try-install']))
+
+        prepared = threading.Event()
+        seen = []
+        real_prepare = testee.prepare
+
+        def check_prepare(config):
+            real_prepare(config)
+            prepared.set()
+
+        def check_install(packages):
+            seen.append(prepared.wait(5))
+            return (None, [])
+
+        sprepo.install_packages.side_effect = check_install
+        self.addCleanup(setattr, sprepo.install_packages, 'side_effect', None)
+        txn.install.side_effect = lambda *args: \
+            shutil.copy(args[-2], args[-1])
+        spconfig.set_our_id.side_effect = None
+        index_text = mock.Mock(wraps=testee.spcconfindex.index_text)
+        count_commit = testee.spcnetwork.commit_plan.call_count
+        count_fixup = testee.spcnetwork.fixup_interfaces.call_count
+
+        with mock.patch.object(testee, 'STORPOOL_CONF', new=conf_path), \
+                mock.patch.object(testee, 'prepare', new=check_prepare), \
+                mock.patch.object(testee.spcconfindex, 'index_text',
+                                  new=index_text), \
+                mock.patch.object(testee.spcdpkg, 'missing') as missing, \
+                mock.patch.object(testee.spctuning, 'PROFILES',
+                                  new={'default': {}}), \
+                mock.patch.object(sputils, 'check_in_lxc') as in_lxc:
+            missing.return_value = {'storpool-config': '0.1.0'}
+            in_lxc.return_value = False
+            testee.install_package()
+            self.assertEquals([True], seen)
+            self.assertEquals(1, index_text.call_count)
+            self.assertEquals(set(['config', 'network']),
+                              set(testee._prepared.keys()))
+            self.assertEquals(['eth1', 'default', None],
+                              testee._prepared['network']['key'])
+
+            testee.write_out_config()
+            self.assertEquals(1, index_text.call_count)
+            with open(conf_path, mode='r') as f:
+                self.assertEquals('SP_OURID=1\nSP_IFACE=eth1\n', f.read())
+
+            testee.setup_interfaces()
+            self.assertEquals(count_commit + 1,
+                              testee.spcnetwork.commit_plan.call_count)
+            self.assertEquals(count_fixup,
+                              testee.spcnetwork.fixup_interfaces.call_count)
+            self.assertEquals({}, testee._prepared)
+
+        self.assertEquals(set([
+            INSTALLED_STATE,
+            'l-storpool-config.config-written',
+            'l-storpool-config.config-network',
+        ]), r_state.r_get_states())
+
+    @mock_reactive_states
+    @mock.patch('subprocess.call')
+    def test_remove_leftovers(self, call):
+        """
+        Test that the boot loader configuration is regenerated, systemd
+        reloaded, and irqbalance restarted if the rollback removes
+        the files that they use.
+        """
+        tempd = tempfile.mkdtemp(prefix='test-config.')
+        self.addCleanup(shutil.rmtree, tempd)
+        (grub, dropin, irq_dropin, policy) = [
+            os.path.join(tempd, name)
+            for name in ('grub.cfg', 'slice.conf', 'irqbalance.conf',
+                         'policy')]
+
+        def rollback():
+            """
+            Remove the files that txn installed.
+            """
+            for path in (grub, dropin, irq_dropin, policy):
+                if os.path.exists(path):
+                    os.unlink(path)
+
+        txn.rollback_if_needed.side_effect = rollback
+        self.addCleanup(setattr, txn.rollback_if_needed, 'side_effect', None)
+        r_state.r_set_states(set(['l-storpool-config.stop']))
+        with mock.patch.object(testee.spchugepages, 'GRUB_SNIPPET',
+                               new=grub), \
+                mock.patch.object(testee.spccpuplan, 'SLICE_DROPIN',
+                                  new=dropin), \
+                mock.patch.object(testee.spcirq, 'IRQBALANCE_DROPIN',
+                                  new=irq_dropin), \
+                mock.patch.object(testee.spcirq, 'POLICY_SCRIPT',
+                                  new=policy), \
+                mock.patch.object(sputils, 'check_in_lxc') as in_lxc:
+            in_lxc.return_value = True
+            testee.remove_leftovers()
+            self.assertEqual([], call.call_args_list)
+
+            with open(grub, mode='w') as f:
+                print('GRUB_CMDLINE_LINUX="hugepages=512"', file=f)
+            r_state.r_set_states(set(['l-storpool-config.stop']))
+            testee.remove_leftovers()
+            self.assertEqual([mock.call(['update-grub'])],
+                             call.call_args_list)
+
+            call.reset_mock()
+            with open(dropin, mode='w') as f:
+                print('[Slice]\nAllowedCPUs=6-7', file=f)
+            r_state.r_set_states(set(['l-storpool-config.stop']))
+            testee.remove_leftovers()
+            self.assertEqual([mock.call(['systemctl', 'daemon-reload'])],
+                             call.call_args_list)
+
+            call.reset_mock()
+            for path in (irq_dropin, policy):
+                with open(path, mode='w') as f:
+                    print('# ours', file=f)
+            r_state.r_set_states(set(['l-storpool-config.stop']))
+            testee.remove_leftovers()
+            self.assertEqual([
+                mock.call(['systemctl', 'daemon-reload']),
+                mock.call(['systemctl', 'try-restart', 'irqbalance.service']),
+            ], call.call_args_list)
+        self.assertIn('l-storpool-config.stopped', r_state.r_get_states())
+
+    @mock_reactive_states
+    def test_setup_interfaces_invalid(self):
+        """
+        Test that an invalid SP_IFACE setting blocks the network stage.
+        """
+        fixup = testee.spcnetwork.fixup_interfaces
+        fixup.side_effect = ValueError('invalid literal for int()')
+        self.addCleanup(setattr, fixup, 'side_effect', None)
+        r_state.r_set_states(set(['l-storpool-config.config-written']))
+        with mock.patch.object(sputils, 'check_in_lxc') as in_lxc, \
+                mock.patch.object(testee.spcconfindex, 'get_config') as get, \
+                mock.patch.object(testee.spctuning, 'PROFILES',
+                                  new={'default': {}}), \
+                mock.patch('spcharms.status.npset') as npset:
+            in_lxc.return_value = False
+            get.return_value = {'SP_IFACE': 'eth0=9000x'}
+            testee.setup_interfaces()
+            self.assertEquals('blocked', npset.call_args[0][0])
+            self.assertTrue(npset.call_args[0][1].startswith(
+                'invalid SP_IFACE "eth0=9000x"'))
+        self.assertEquals(set(['l-storpool-config.config-written']),
+                          r_state.r_get_states())
+
+    @mock_reactive_states
+    @mock.patch('time.time')
+    def test_settle(self, now):
+        """
+        Test that the stages wait for the configuration to settle.
+        """
+        count_install = sprepo.install_packages.call_count
+        sprepo.install_packages.return_value = (None, [])
+        r_config.r_set('storpool_conf', 'SP_OURID=1\n')
+        r_config.r_set('storpool_version', '0.1.0')
+        r_config.r_set('config_settle_time', 60)
+        now.return_value = 1000.0
+        testee.config_changed()
+        self.assertEquals(1000.0, testee.config_changed_at())
+
+        # A second change right away, still nothing done.
+        r_config.r_set('storpool_version', '0.2.0')
+        now.return_value = 1030.0
+        testee.config_changed()
+        self.assertEquals(1030.0, testee.config_changed_at())
+        testee.install_package()
+        self.assertEquals(count_install, sprepo.install_packages.call_count)
+        self.assertEquals('maintenance', spstatus.npset.call_args[0][0])
+
+        # No changes, the settle window is not extended.
+        now.return_value = 1060.0
+        testee.config_changed()
+        self.assertEquals(1030.0, testee.config_changed_at())
+
+        # The window has passed, the latest configuration is applied.
+        now.return_value = 1091.0
+        testee.install_package()
+        self.assertEquals(count_install + 1,
+                          sprepo.install_packages.call_count)
+        self.assertEquals(set([
+            'l-storpool-config.config-available',
+            INSTALLED_STATE,
+        ]), r_state.r_get_states())
+
     @mock_reactive_states
     @mock.patch('charmhelpers.core.hookenv.charm_dir')
     def test_write_out_config(self, charm_dir):
@@ -296,23 +690,453 @@ class TestStorPoolConfig(unittest.TestCase):
                                 .format(var=key, value=conf[key]),
                                 sorted(conf)))
         r_config.r_set('storpool_conf', conf_text)
+        tempd = tempfile.mkdtemp(prefix='test-config.')
+        self.addCleanup(shutil.rmtree, tempd)
+        conf_path = os.path.join(tempd, 'storpool.conf')
 
         def txn_check(*args):
             """
             Make sure txn.install() was invoked correctly.
             """
             self.assertTrue(len(args) >= 2)
-            self.assertEqual(args[-1], '/etc/storpool.conf')
+            self.assertEqual(args[-1], conf_path)
+            self.assertEqual(tempd, os.path.dirname(args[-2]))
+            self.assertEqual(0o644, os.stat(args[-2]).st_mode & 0o777)
             with open(args[-2], mode='r') as f:
                 contents = f.read()
                 self.assertEquals(conf_text, contents)
+            shutil.copy(args[-2], args[-1])
 
         txn.install.side_effect = txn_check
-        spconfig.get_dict.return_value = conf
         spconfig.set_our_id.side_effect = lambda v: \
             self.assertEquals(conf['SP_OURID'], v)
         count_set = spconfig.set_our_id.call_count
         charm_dir.return_value = os.getcwd()
 
-        testee.write_out_config()
-        self.assertEquals(count_set + 1, spconfig.set_our_id.call_count)
+        real_fsync = os.fsync
+        synced = []
+
+        def fsync_record(fd):
+            """
+            Record the path of the file or directory being synced.
+            """
+            synced.append(os.readlink('/proc/self/fd/{fd}'.format(fd=fd)))
+            real_fsync(fd)
+
+        with mock.patch.object(testee, 'STORPOOL_CONF', new=conf_path), \
+                mock.patch('os.fsync') as fsync:
+            fsync.side_effect = fsync_record
+            testee.write_out_config()
+            self.assertEquals(count_set + 1, spconfig.set_our_id.call_count)
+            self.assertEquals([conf_path, tempd], synced)
+
+            r_kv.r_clear_kv()
+            r_config.r_set('storpool_conf_fsync', 'file')
+            testee.write_out_config()
+            self.assertEquals(count_set + 2, spconfig.set_our_id.call_count)
+            self.assertEquals([conf_path, tempd, conf_path], synced)
+
+            r_kv.r_clear_kv()
+            r_config.r_set('storpool_conf_fsync', 'none')
+            testee.write_out_config()
+            self.assertEquals(count_set + 3, spconfig.set_our_id.call_count)
+            self.assertEquals(3, fsync.call_count)
+
+        # The temporary file is gone, only the installed one is left.
+        self.assertEquals(['storpool.conf'], os.listdir(tempd))
+
+    @mock_reactive_states
+    @mock.patch('charmhelpers.core.hookenv.charm_dir')
+    def test_write_out_config_unchanged(self, charm_dir):
+        """
+        Test that the config file is not installed and parsed again if
+        its contents have not changed.
+        """
+        tempd = tempfile.mkdtemp(prefix='test-config.')
+        self.addCleanup(shutil.rmtree, tempd)
+        conf_path = os.path.join(tempd, 'storpool.conf')
+
+        conf = {
+            'SP_OURID': '1',
+            'SP_CLUSTER_ID': 'a.a',
+        }
+        r_config.r_set('storpool_conf', 'SP_OURID=1\n')
+
+        txn.install.side_effect = lambda *args: \
+            shutil.copy(args[-2], args[-1])
+        spconfig.set_our_id.side_effect = lambda v: \
+            self.assertEquals(conf['SP_OURID'], v)
+        charm_dir.return_value = os.getcwd()
+        count_install = txn.install.call_count
+        count_set = spconfig.set_our_id.call_count
+        index_text = mock.Mock(wraps=testee.spcconfindex.index_text)
+        count_get = 0
+
+        with mock.patch.object(testee, 'STORPOOL_CONF', new=conf_path), \
+                mock.patch.object(testee.spcconfindex, 'index_text',
+                                  new=index_text):
+            # The first time the file is written out
+            testee.write_out_config()
+            self.assertEquals(count_install + 1, txn.install.call_count)
+            self.assertEquals(count_get + 1, index_text.call_count)
+            self.assertEquals(count_set + 1, spconfig.set_our_id.call_count)
+
+            # The second time nothing needs to be done
+            testee.write_out_config()
+            self.assertEquals(count_install + 1, txn.install.call_count)
+            self.assertEquals(count_get + 1, index_text.call_count)
+            self.assertEquals(count_set + 2, spconfig.set_our_id.call_count)
+
+            # Somebody modified the file behind our back
+            with open(conf_path, mode='a') as f:
+                print('# oops', file=f)
+            testee.write_out_config()
+            self.assertEquals(count_install + 2, txn.install.call_count)
+            self.assertEquals(count_get + 2, index_text.call_count)
+            self.assertEquals(count_set + 3, spconfig.set_our_id.call_count)
+
+            # A real change in the charm config
+            r_config.r_set('storpool_conf', 'SP_OURID=1\nSP_X=y\n')
+            testee.write_out_config()
+            self.assertEquals(count_install + 3, txn.install.call_count)
+            self.assertEquals(count_get + 3, index_text.call_count)
+            self.assertEquals(count_set + 4, spconfig.set_our_id.call_count)
+
+    @mock_reactive_states
+    @mock.patch('charmhelpers.core.hookenv.charm_dir')
+    def test_check_drift(self, charm_dir):
+        """
+        Test that the update-status drift check only clears the states of
+        the stages whose files or settings have been changed.
+        """
+        tempd = tempfile.mkdtemp(prefix='test-config.')
+        self.addCleanup(shutil.rmtree, tempd)
+        conf_path = os.path.join(tempd, 'storpool.conf')
+        r_config.r_set('storpool_conf', 'SP_OURID=1\n')
+        txn.install.side_effect = lambda *args: \
+            shutil.copy(args[-2], args[-1])
+        spconfig.set_our_id.side_effect = None
+        charm_dir.return_value = os.getcwd()
+        done = set([
+            'l-storpool-config.config-written',
+            'l-storpool-config.config-network',
+            'l-storpool-config.network-applied',
+        ])
+
+        with mock.patch.object(testee, 'STORPOOL_CONF', new=conf_path), \
+                mock.patch.object(testee.spcdrift,
+                                  'config_drift') as config_drift, \
+                mock.patch.object(testee.spcdrift, 'mtu_drift') as mtu_drift:
+            config_drift.return_value = []
+            mtu_drift.return_value = []
+            r_state.r_set_states(done)
+            testee.write_out_config()
+            testee.check_drift()
+            self.assertEquals(done, r_state.r_get_states())
+
+            # Only touched, the record is updated.
+            os.utime(conf_path, ns=(0, 0))
+            testee.check_drift()
+            self.assertEquals(done, r_state.r_get_states())
+            self.assertEquals(spconfighelpers.files.stat_key(conf_path),
+                              r_kv.get(testee.KV_CONF_RECORD)['stat'])
+
+            with open(conf_path, mode='a') as f:
+                print('SP_OURID=2', file=f)
+            testee.check_drift()
+            self.assertEquals(done - set(['l-storpool-config.config-written']),
+                              r_state.r_get_states())
+            testee.write_out_config()
+            self.assertEquals(done, r_state.r_get_states())
+            with open(conf_path, mode='r') as f:
+                self.assertEquals('SP_OURID=1\n', f.read())
+
+            config_drift.return_value = ['/etc/network/interfaces']
+            mtu_drift.return_value = ['eth1']
+            testee.check_drift()
+            self.assertEquals(set(['l-storpool-config.config-written']),
+                              r_state.r_get_states())
+
+            # Nothing is checked after the layer has been stopped.
+            r_state.r_set_states(done | set(['l-storpool-config.stopped']))
+            testee.check_drift()
+            self.assertEquals(done | set(['l-storpool-config.stopped']),
+                              r_state.r_get_states())
+
+    @mock_reactive_states
+    def test_reserve_hugepages(self):
+        """
+        Test that the hugepages are only reserved if requested.
+        """
+        hp = testee.spchugepages
+        hp.reset_mock()
+        with mock.patch.object(sputils, 'check_in_lxc') as in_lxc, \
+                mock.patch.object(testee.spcconfindex, 'get_config') as get:
+            in_lxc.return_value = False
+            get.return_value = {'SP_CACHE_SIZE': '64'}
+            testee.reserve_hugepages()
+            hp.persist.assert_called_once_with(None)
+            self.assertEqual(0, hp.reserve.call_count)
+            self.assertEquals(set(['l-storpool-config.hugepages']),
+                              r_state.r_get_states())
+
+            r_state.r_clear_states()
+            r_config.r_set('hugepages', True)
+            hp.plan.return_value = {'page_kb': 2048, 'total': 32,
+                                    'nodes': {0: 32}}
+            hp.shortfall.return_value = 0
+            testee.reserve_hugepages()
+            hp.plan.assert_called_once_with({'SP_CACHE_SIZE': '64'})
+            hp.persist.assert_called_with(hp.plan.return_value)
+            hp.reserve.assert_called_once_with(hp.plan.return_value)
+            self.assertEquals(set(['l-storpool-config.hugepages']),
+                              r_state.r_get_states())
+
+            # Invalid settings block the stage.
+            r_state.r_clear_states()
+            hp.plan.side_effect = ValueError('invalid SP_CACHE_SIZE')
+            with mock.patch('spcharms.status.npset') as npset:
+                testee.reserve_hugepages()
+                self.assertEquals('blocked', npset.call_args[0][0])
+            hp.plan.side_effect = None
+            self.assertEquals(set(), r_state.r_get_states())
+
+    @mock_reactive_states
+    def test_plan_cpus(self):
+        """
+        Test that the CPUs are only dedicated if requested and that
+        the interrupts are pinned again if they change.
+        """
+        cp = testee.spccpuplan
+        cp.reset_mock()
+        done = set(['l-storpool-config.config-network'])
+        with mock.patch.object(sputils, 'check_in_lxc') as in_lxc, \
+                mock.patch.object(testee.spcconfindex, 'get_config') as get:
+            in_lxc.return_value = False
+            get.return_value = {'SP_IFACE': 'eth0,eth1'}
+            cp.apply.return_value = False
+            cp.unsupported.return_value = None
+            r_state.r_set_states(done)
+            testee.plan_cpus()
+            self.assertEqual(0, cp.plan.call_count)
+            cp.apply.assert_called_once_with(None)
+            self.assertEquals(done | set(['l-storpool-config.cpuset']),
+                              r_state.r_get_states())
+
+            r_state.r_set_states(done)
+            r_config.r_set('storpool_cores', 2)
+            r_config.r_set('irq_pinning', True)
+            cp.plan.return_value = {'nodes': [1], 'cpus': [6, 7, 14, 15]}
+            cp.apply.return_value = True
+            testee.plan_cpus()
+            cp.plan.assert_called_once_with('eth0,eth1', 2)
+            cp.apply.assert_called_with([6, 7, 14, 15])
+            self.assertEquals(set(['l-storpool-config.cpuset']),
+                              r_state.r_get_states())
+
+            # Asking for too many cores blocks the stage.
+            r_state.r_set_states(done)
+            cp.plan.side_effect = ValueError('too many')
+            with mock.patch('spcharms.status.npset') as npset:
+                testee.plan_cpus()
+                self.assertEquals('blocked', npset.call_args[0][0])
+            cp.plan.side_effect = None
+            self.assertEquals(done, r_state.r_get_states())
+
+            # So does a host that cannot confine the StorPool services.
+            cp.unsupported.return_value = 'needs cgroup v2'
+            cp.plan.reset_mock()
+            with mock.patch('spcharms.status.npset') as npset:
+                testee.plan_cpus()
+                npset.assert_called_with('blocked', 'needs cgroup v2')
+            self.assertEqual(0, cp.plan.call_count)
+            self.assertEquals(done, r_state.r_get_states())
+
+
+IMPORT_BUDGET = 0.25
+
+IMPORT_CHECK = '''
+import sys
+import time
+
+sys.path.insert(0, {lib!r})
+sys.path.insert(0, {root!r})
+
+import charms.reactive
+
+start = time.time()
+import {module}
+print(time.time() - start)
+print(' '.join(sorted(sys.modules.keys())))
+'''
+
+HEAVY_MODULES = [
+    'charmhelpers.core.templating',
+    'jinja2',
+    'spcharms.config',
+    'spcharms.confighelpers.network',
+    'spcharms.confighelpers.netplan',
+    'spcharms.repo',
+    'spcharms.txn',
+]
+
+
+class TestImportTime(unittest.TestCase):
+    """
+    Test that loading the layer at the start of each hook is cheap.
+    """
+
+    def test_import(self):
+        """
+        Import the layer with the real helper modules in a fresh Python
+        interpreter and make sure it does not load the ones that only
+        some handlers need.
+        """
+        script = IMPORT_CHECK.format(lib=os.path.realpath('lib'),
+                                     root=root_path,
+                                     module='reactive.storpool_config')
+        output = subprocess.check_output([sys.executable, '-c', script],
+                                         universal_newlines=True)
+        (elapsed, modules) = output.strip().split('\n')
+        loaded = set(modules.split())
+        self.assertIn('spcharms.confighelpers.perf', loaded)
+        self.assertEqual([], [name for name in HEAVY_MODULES
+                              if name in loaded])
+        self.assertLess(float(elapsed), IMPORT_BUDGET)
+
+    def test_import_drift(self):
+        """
+        Make sure that the update-status drift check does not load
+        the modules that write the network configuration.
+        """
+        script = IMPORT_CHECK.format(lib=os.path.realpath('lib'),
+                                     root=root_path,
+                                     module='spcharms.confighelpers.drift')
+        output = subprocess.check_output([sys.executable, '-c', script],
+                                         universal_newlines=True)
+        loaded = set(output.strip().split('\n')[1].split())
+        self.assertIn('spcharms.confighelpers.files', loaded)
+        self.assertEqual([], [name for name in HEAVY_MODULES + [
+            'spcharms.confighelpers.interfaces',
+            'spcharms.confighelpers.irq',
+            'spcharms.confighelpers.linkstate',
+        ] if name in loaded])
+
+
+class TestConfigIndex(unittest.TestCase):
+    """
+    Test the indexed StorPool configuration reader.
+    """
+
+    CONF = '\n'.join([
+        'SP_CLUSTER_ID=a.a',
+        'SP_IFACE=eth0',
+        '',
+        '[other]',
+        'SP_OURID=2',
+        'SP_IFACE=eth9',
+        '',
+        '[  node1 ]',
+        'SP_OURID = "1"',
+        '# SP_IFACE=eth7',
+        "SP_IFACE='eth1,eth2'",
+        '',
+        '[node1.example.com]',
+        'SP_CACHE_SIZE=4096',
+        '',
+    ])
+
+    def test_sections(self):
+        """
+        Test that only the common section and this host's ones are used.
+        """
+        idx = spconfighelpers.confindex
+        cfg = idx.IndexedConfig(self.CONF.encode(),
+                                hostname='node1.example.com')
+        self.assertEqual(2, len(cfg.host))
+        self.assertIsNone(cfg._values)
+        self.assertEqual('1', cfg['SP_OURID'])
+        self.assertEqual('eth1,eth2', cfg.get('SP_IFACE'))
+        self.assertEqual('4096', cfg.get('SP_CACHE_SIZE'))
+        self.assertEqual('a.a', cfg.get('SP_CLUSTER_ID'))
+        self.assertEqual([], cfg.validate())
+
+        cfg = idx.IndexedConfig(self.CONF.encode(), hostname='another')
+        self.assertEqual('eth0', cfg.get('SP_IFACE'))
+        self.assertNotIn('SP_OURID', cfg)
+        self.assertEqual(['no SP_OURID for this host'], cfg.validate())
+
+    def test_snapshot(self):
+        """
+        Test that the file is only read again when it changes.
+        """
+        idx = spconfighelpers.confindex
+        host = 'node1.example.com'
+        tempd = tempfile.mkdtemp(prefix='test-config.')
+        self.addCleanup(shutil.rmtree, tempd)
+        conf_path = os.path.join(tempd, 'storpool.conf')
+        with open(conf_path, mode='w') as f:
+            f.write(self.CONF)
+
+        cfg = idx.index_text(self.CONF, hostname=host)
+        idx.remember(cfg, conf_path)
+        self.assertIs(cfg, idx.get_config(conf_path, hostname=host))
+        self.assertIs(cfg, idx.get_config(conf_path))
+
+        with open(conf_path, mode='a') as f:
+            f.write('SP_OURID=3\n')
+        updated = idx.get_config(conf_path, hostname=host)
+        self.assertIsNot(cfg, updated)
+        self.assertEqual('3', updated['SP_OURID'])
+        self.assertIs(updated, idx.get_config(conf_path, hostname=host))
+
+        os.utime(conf_path, ns=(0, 0))
+        self.assertIsNot(updated, idx.get_config(conf_path, hostname=host))
+
+
+class TestClusterConfig(unittest.TestCase):
+    """
+    Test the structured StorPool configuration.
+    """
+
+    def test_render(self):
+        """
+        Test the combination of the structured and verbatim settings.
+        """
+        cc = spconfighelpers.clusterconf
+        structured = '\n'.join([
+            'common:',
+            '  SP_CLUSTER_ID: a.a',
+            '  SP_NODE_NON_VOTING: false',
+            'hosts:',
+            '  node1:',
+            '    SP_OURID: 1',
+            '  node2.example.com:',
+            '    SP_OURID: 2',
+        ])
+        self.assertEquals('SP_X=y', cc.effective_conf('SP_X=y', None))
+        self.assertEquals(''.join([
+            'SP_CLUSTER_ID=a.a\n',
+            'SP_NODE_NON_VOTING=false\n',
+            'SP_X=y\n',
+            '\n',
+            '[node1]\n',
+            'SP_OURID=1\n',
+        ]), cc.effective_conf('SP_X=y', structured,
+                              hostname='node1.example.com'))
+        self.assertTrue(cc.effective_conf(
+            '', structured, hostname='node2.example.com').endswith(
+                '\n[node2.example.com]\nSP_OURID=2\n'))
+        self.assertEquals('SP_CLUSTER_ID=a.a\nSP_NODE_NON_VOTING=false\n',
+                          cc.effective_conf('', structured, hostname='node3'))
+
+    def test_invalid(self):
+        """
+        Test that invalid structured configurations are rejected.
+        """
+        cc = spconfighelpers.clusterconf
+        for text in ('- a', 'common: [1]', 'other: {}', 'hosts: 1',
+                     'common:\n  A: [1]', 'hosts:\n  n1:\n    A:',
+                     'common: {'):
+            self.assertRaises(ValueError, cc.parse, text)
+        self.assertEquals({'common': {}, 'hosts': {}}, cc.parse(''))
@@ -0,0 +1,173 @@
+#!/usr/bin/python3
+
+"""
+A set of unit tests for the storpool-config CPU planning helpers.
+"""
+
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+import mock
+
+root_path = os.path.realpath('.')
+if root_path not in sys.path:
+    sys.path.insert(0, root_path)
+
+lib_path = os.path.realpath('unit_tests/lib')
+if lib_path not in sys.path:
+    sys.path.insert(0, lib_path)
+
+from spcharms import txn
+
+from unit_tests.libhelpers import create_fake_nic, load_confighelpers
+
+(spccpuplan, spcirq) = load_confighelpers('cpuplan', 'irq')
+
+DPKG_STATUS = '''Package: systemd
+Status: install ok installed
+Version: {version}
+'''
+
+
+class TestCPUPlan(unittest.TestCase):
+    """
+    Test the choice of the CPU cores dedicated to the StorPool services.
+    """
+    def setUp(self):
+        """
+        Create a fake sysfs tree with two NUMA nodes of four cores with
+        two hardware threads each.
+        """
+        super(TestCPUPlan, self).setUp()
+        self.sysroot = tempfile.mkdtemp(prefix='test-cpuplan.')
+        self.addCleanup(shutil.rmtree, self.sysroot)
+        create_fake_nic(self.sysroot, 'eth0', 25000, numa=1)
+        create_fake_nic(self.sysroot, 'eth1', 25000, numa=0)
+        create_fake_nic(self.sysroot, 'eth2', 25000, numa=1)
+
+        cpudir = os.path.join(self.sysroot, 'sys', 'devices', 'system', 'cpu')
+        os.makedirs(cpudir)
+        with open(os.path.join(cpudir, 'online'), mode='w') as f:
+            print('0-15', file=f)
+        for cpu in range(16):
+            topo = os.path.join(cpudir, 'cpu{cpu}'.format(cpu=cpu),
+                                'topology')
+            os.makedirs(topo)
+            for (name, value) in (('physical_package_id', cpu % 8 // 4),
+                                  ('core_id', cpu % 4)):
+                with open(os.path.join(topo, name), mode='w') as f:
+                    print(value, file=f)
+        for (node, cpus) in (('0', '0-3,8-11'), ('1', '4-7,12-15')):
+            ndir = os.path.join(self.sysroot, 'sys', 'devices', 'system',
+                                'node', 'node' + node)
+            os.makedirs(ndir)
+            with open(os.path.join(ndir, 'cpulist'), mode='w') as f:
+                print(cpus, file=f)
+
+    def test_plan(self):
+        """
+        Test that whole cores are chosen, the interfaces' NUMA node first.
+        """
+        cores = spccpuplan.cpu_cores(sysroot=self.sysroot)
+        self.assertEqual(8, len(cores))
+        self.assertEqual({'node': 1, 'cpus': [5, 13]}, cores[5])
+
+        self.assertEqual([1, 0], spccpuplan.nic_nodes(
+            'eth0.100=9000,eth1,eth2', sysroot=self.sysroot))
+        self.assertEqual({'nodes': [1, 0], 'cpus': [6, 7, 14, 15]},
+                         spccpuplan.plan('eth0.100=9000,eth1,eth2', 2,
+                                         sysroot=self.sysroot))
+        self.assertEqual([3, 4, 5, 6, 7, 11, 12, 13, 14, 15],
+                         spccpuplan.plan('eth0,eth1,eth2', 5,
+                                         sysroot=self.sysroot)['cpus'])
+        self.assertEqual({'nodes': [0], 'cpus': [3, 11]},
+                         spccpuplan.plan('eth1', 1, sysroot=self.sysroot))
+        self.assertEqual({'nodes': [], 'cpus': [7, 15]},
+                         spccpuplan.plan('', 1, sysroot=self.sysroot))
+        self.assertRaises(ValueError, spccpuplan.plan, 'eth0', 8,
+                          sysroot=self.sysroot)
+
+    @mock.patch('subprocess.call')
+    @mock.patch('charmhelpers.core.unitdata.kv')
+    def test_apply(self, kv, call):
+        """
+        Test that the drop-in is only installed and systemd only reloaded
+        when the CPU set changes.
+        """
+        data = {}
+        kv.return_value.get.side_effect = lambda key, default=None: \
+            data.get(key, default)
+        kv.return_value.set.side_effect = data.__setitem__
+        kv.return_value.unset.side_effect = lambda key: data.pop(key, None)
+        txn.install.reset_mock()
+        txn.install.side_effect = lambda *args: \
+            shutil.copy(args[-2], args[-1])
+        self.addCleanup(setattr, txn.install, 'side_effect', None)
+
+        dropin = os.path.join(self.sysroot, 'etc', 'systemd', 'system',
+                              'storpool.slice.d', 'cpus.conf')
+        with mock.patch.object(spccpuplan, 'SLICE_DROPIN', new=dropin):
+            self.assertFalse(spccpuplan.apply(None))
+            self.assertEqual(0, txn.install.call_count)
+
+            self.assertTrue(spccpuplan.apply([6, 7, 14, 15]))
+            self.assertEqual(1, txn.install.call_count)
+            self.assertEqual([mock.call(['systemctl', 'daemon-reload'])],
+                             call.call_args_list)
+            with open(dropin, mode='r') as f:
+                self.assertTrue(f.read().endswith(
+                    '\n[Slice]\nAllowedCPUs=6-7,14-15\n'))
+            self.assertEqual([6, 7, 14, 15], spccpuplan.planned_cpus())
+
+            self.assertFalse(spccpuplan.apply([6, 7, 14, 15]))
+            self.assertEqual(1, txn.install.call_count)
+
+            self.assertTrue(spccpuplan.apply(None))
+            self.assertEqual(2, txn.install.call_count)
+            with open(dropin, mode='r') as f:
+                self.assertNotIn('AllowedCPUs', f.read())
+            self.assertEqual([], spccpuplan.planned_cpus())
+
+    def test_unsupported(self):
+        """
+        Test that the StorPool CPU set is read from and only set in
+        the unified cgroup hierarchy with a recent enough systemd.
+        """
+        status = os.path.join(self.sysroot, 'status')
+        cgroot = os.path.join(self.sysroot, 'sys', 'fs', 'cgroup')
+        os.makedirs(os.path.join(cgroot, 'cpuset', 'storpool.slice'))
+        with open(os.path.join(self.sysroot, spcirq.STORPOOL_CPUSET_V1),
+                  mode='w') as f:
+            print('2-3', file=f)
+
+        self.assertFalse(spcirq.cgroup_unified(self.sysroot))
+        self.assertEqual([2, 3], spcirq.storpool_cpus(self.sysroot))
+        self.assertIn('cgroup v2', spccpuplan.unsupported(
+            self.sysroot, dpkg_status=status))
+
+        os.makedirs(os.path.join(cgroot, 'storpool.slice'))
+        with open(os.path.join(cgroot, 'cgroup.controllers'),
+                  mode='w') as f:
+            print('cpuset cpu io memory pids', file=f)
+        self.assertTrue(spcirq.cgroup_unified(self.sysroot))
+        self.assertEqual([], spcirq.storpool_cpus(self.sysroot))
+        with open(os.path.join(self.sysroot, spcirq.STORPOOL_CPUSET_V2),
+                  mode='w') as f:
+            print('6-7', file=f)
+        self.assertEqual([6, 7], spcirq.storpool_cpus(self.sysroot))
+
+        self.assertIsNone(spccpuplan.systemd_version(status))
+        self.assertIn('found none', spccpuplan.unsupported(
+            self.sysroot, dpkg_status=status))
+        for (version, ok) in (('237-3ubuntu10.57', False),
+                              ('1:243-8', False),
+                              ('245.4-4ubuntu3.22', True)):
+            with open(status, mode='w') as f:
+                print(DPKG_STATUS.format(version=version), file=f)
+            # Make sure that the dpkg status file is read again.
+            os.utime(status, ns=(0, len(version)))
+            self.assertEqual(ok, spccpuplan.unsupported(
+                self.sysroot, dpkg_status=status) is None)
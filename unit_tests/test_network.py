@@ -0,0 +1,789 @@
+#!/usr/bin/python3
+
+"""
+A set of unit tests for the storpool-config network helpers.
+"""
+
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import unittest
+
+import mock
+import yaml
+
+root_path = os.path.realpath('.')
+if root_path not in sys.path:
+    sys.path.insert(0, root_path)
+
+lib_path = os.path.realpath('unit_tests/lib')
+if lib_path not in sys.path:
+    sys.path.insert(0, lib_path)
+
+from spcharms import txn
+
+from unit_tests.libhelpers import create_fake_nic, load_confighelpers
+
+(spcdrift, spcfiles, spcifaces, spcifspec, spcirq, spclinkstate,
+ spcnetplan, spcnetwork, spctuning) = \
+    load_confighelpers('drift', 'files', 'interfaces', 'ifspec', 'irq',
+                       'linkstate', 'netplan', 'network', 'tuning')
+
+IFACES_MAIN = '''auto lo
+iface lo inet loopback
+
+source {base}/interfaces.d/*
+
+auto eth0
+iface eth0 inet manual
+    post-up /bin/true
+
+auto eth1
+iface eth1 inet manual
+'''
+
+IFACES_SUB = '''auto eth2
+iface eth2 inet static
+    address 10.1.1.1/24
+
+auto eth3
+iface eth3 inet manual'''
+
+ETHTOOL_RINGS = '''Ring parameters for {iface}:
+Pre-set maximums:
+RX:\t\t8192
+RX Mini:\tn/a
+RX Jumbo:\t0
+TX:\t\t8192
+Current hardware settings:
+RX:\t\t1024
+RX Mini:\tn/a
+RX Jumbo:\t0
+TX:\t\t1024
+'''
+
+ETHTOOL_COALESCE = '''Coalesce parameters for {iface}:
+Adaptive RX: on  TX: on
+stats-block-usecs: n/a
+rx-usecs: 8
+rx-frames: 128
+tx-usecs: 8
+'''
+
+PROC_INTERRUPTS = '''       CPU0   CPU1
+  0:     10      0  IO-APIC  2-edge  timer
+ 40:      0      0  PCI-MSI  1-edge  mlx5_async0@pci:0000:3b:00.0
+ 41:    100      0  PCI-MSI  2-edge  mlx5_comp0@pci:0000:3b:00.0
+ 42:    100      0  PCI-MSI  3-edge  mlx5_comp1@pci:0000:3b:00.0
+ 43:    100      0  PCI-MSI  4-edge  mlx5_comp2@pci:0000:3b:00.0
+ 50:    100      0  PCI-MSI  5-edge  eth1-TxRx-0
+ 51:    100      0  PCI-MSI  6-edge  eth1-TxRx-1
+ 52:    100      0  PCI-MSI  7-edge  veth1-TxRx-0
+'''
+
+
+NETPLAN_CLOUD = {
+    'network': {
+        'version': 2,
+        'ethernets': {
+            'storage0': {'match': {'name': 'eth0'}, 'set-name': 'eth0'},
+        },
+        'vlans': {
+            'vlan100': {'id': 100, 'link': 'storage0'},
+        },
+    },
+}
+
+
+def fake_ethtool(option, iface):
+    """
+    Return the canned output of ethtool queries.
+    """
+    if option == '-g':
+        return ETHTOOL_RINGS.format(iface=iface)
+    elif option == '-c':
+        return ETHTOOL_COALESCE.format(iface=iface)
+    return None
+
+
+class TestNetwork(unittest.TestCase):
+    """
+    Test the parsing and updating of the network interface configuration.
+    """
+    def setUp(self):
+        """
+        Create a temporary /etc/network/interfaces tree.
+        """
+        super(TestNetwork, self).setUp()
+        self.tempd = tempfile.mkdtemp(prefix='test-network.')
+        self.addCleanup(shutil.rmtree, self.tempd)
+        os.mkdir(os.path.join(self.tempd, 'interfaces.d'))
+        self.main = os.path.join(self.tempd, 'interfaces')
+        self.sub = os.path.join(self.tempd, 'interfaces.d', 'storage')
+        with open(self.main, mode='w') as f:
+            f.write(IFACES_MAIN.format(base=self.tempd))
+        with open(self.sub, mode='w') as f:
+            f.write(IFACES_SUB)
+
+        txn.install.reset_mock()
+        txn.install.side_effect = self.txn_install
+
+    def txn_install(self, *args, **kwargs):
+        """
+        Copy the files into the target directory.
+        """
+        self.assertTrue(kwargs.get('exact'))
+        for fname in args[:-1]:
+            shutil.copy(fname, args[-1])
+
+    def test_parse(self):
+        """
+        Test the parsed model of an interfaces file.
+        """
+        model = spcifaces.parse_file(self.main)
+        self.assertEqual(['lo', 'eth0', 'eth1'],
+                         [s['iface'] for s in model['stanzas']])
+        self.assertEqual([['source', self.tempd + '/interfaces.d/*']],
+                         model['includes'])
+        self.assertEqual(['post-up /bin/true'],
+                         model['stanzas'][1]['options'])
+        self.assertEqual(9, model['stanzas'][1]['insert'])
+        self.assertEqual(11, model['stanzas'][2]['insert'])
+
+        model = spcifaces.parse_file(self.sub)
+        self.assertFalse(model['eol'])
+        self.assertEqual(6, model['stanzas'][1]['insert'])
+
+    def test_fixup(self):
+        """
+        Test that the missing lines are added and that nothing is
+        rewritten or parsed again on a second run.
+        """
+        data = {
+            'eth0': ['post-up /bin/true', 'post-up /bin/false'],
+            'eth3': ['mtu 9000'],
+        }
+        cache = spcifaces.InterfacesCache()
+        spcnetwork.fixup_interfaces_file(self.main, data, set(), cache)
+        self.assertEqual(2, txn.install.call_count)
+
+        with open(self.main, mode='r') as f:
+            lines = f.read().split('\n')
+        self.assertEqual(['iface eth0 inet manual',
+                          '    post-up /bin/true',
+                          '',
+                          'post-up /bin/false',
+                          'auto eth1'], lines[6:11])
+        with open(self.sub, mode='r') as f:
+            self.assertTrue(f.read().endswith(
+                'iface eth3 inet manual\nmtu 9000\n'))
+
+        # Round-trip the cache through its serialized form; the modified
+        # files were cached right after they were written.
+        cache = spcifaces.InterfacesCache(cache.to_dict())
+        real_parse_file = spcifaces.parse_file
+        with mock.patch.object(spcifaces, 'parse_file') as parse_file:
+            parse_file.side_effect = real_parse_file
+            spcnetwork.fixup_interfaces_file(self.main, data, set(), cache)
+            self.assertEqual(0, parse_file.call_count)
+            self.assertEqual(2, txn.install.call_count)
+            self.assertFalse(cache.dirty)
+
+            # Somebody edits a file behind our back.
+            with open(self.sub, mode='a') as f:
+                print('# hello', file=f)
+            spcnetwork.fixup_interfaces_file(self.main, data, set(), cache)
+            self.assertEqual(1, parse_file.call_count)
+            self.assertEqual(2, txn.install.call_count)
+
+    def test_fixup_profile(self):
+        """
+        Test that switching the tuning profile replaces the ethtool and
+        MTU lines that we added before and leaves the rest alone.
+        """
+        def eth0_lines(profile, mtu):
+            settings = spctuning.nic_settings(profile, None)
+            return ['post-up /sbin/ip link set dev eth0 mtu {mtu}'
+                    .format(mtu=mtu)] + \
+                spctuning.post_up_lines('eth0', settings)
+
+        def eth0_options():
+            model = spcifaces.parse_file(self.main)
+            return [stanza['options'] for stanza in model['stanzas']
+                    if stanza['iface'] == 'eth0'][0]
+
+        cache = spcifaces.InterfacesCache()
+        spcnetwork.fixup_interfaces_file(
+            self.main, {'eth0': eth0_lines('default', 9000)}, set(), cache)
+        self.assertEqual(['post-up /bin/true'] + eth0_lines('default', 9000),
+                         eth0_options())
+
+        spcnetwork.fixup_interfaces_file(
+            self.main, {'eth0': eth0_lines('latency', 1500)}, set(), cache)
+        options = eth0_options()
+        self.assertEqual('post-up /bin/true', options[0])
+        self.assertEqual(sorted(eth0_lines('latency', 1500)),
+                         sorted(options[1:]))
+        self.assertEqual(1, len([line for line in options
+                                 if line.startswith('post-up /sbin/ethtool '
+                                                    '-G eth0 ')]))
+        self.assertIn('post-up /sbin/ethtool -G eth0 rx 1024 tx 512 || true',
+                      options)
+
+        # Nothing to do the second time around.
+        count = txn.install.call_count
+        spcnetwork.fixup_interfaces_file(
+            self.main, {'eth0': eth0_lines('latency', 1500)}, set(), cache)
+        self.assertEqual(count, txn.install.call_count)
+
+        # The stale cached models of an older version are not used.
+        self.assertEqual({}, spcifaces.InterfacesCache({
+            'files': cache.files,
+            'globs': cache.globs,
+        }).files)
+
+    @mock.patch('charmhelpers.core.unitdata.kv')
+    def test_drift(self, kv):
+        """
+        Test that only the files modified behind our back are reported.
+        """
+        data = {}
+        kv.return_value.get.side_effect = lambda key, default=None: \
+            data.get(key, default)
+        kv.return_value.set.side_effect = data.__setitem__
+        kv.return_value.unset.side_effect = lambda key: data.pop(key, None)
+
+        cache = spcifaces.InterfacesCache()
+        spcnetwork.fixup_interfaces_file(self.main, {'eth3': ['mtu 9000']},
+                                         set(), cache)
+        data[spcdrift.KV_INTERFACES_CACHE] = cache.to_dict()
+        dropin = os.path.join(self.tempd, 'dropin.conf')
+        txn.install.side_effect = lambda *args: \
+            shutil.copy(args[-2], args[-1])
+        self.assertTrue(spcfiles.install(dropin, 'a=b\n',
+                                         record=spcdrift.KV_MANAGED_FILES))
+        self.assertEqual([], spcdrift.config_drift())
+
+        # Only touched, the contents are the same.
+        os.utime(dropin, ns=(0, 0))
+        self.assertEqual([], spcdrift.config_drift())
+        self.assertEqual(
+            spcfiles.stat_key(dropin),
+            data[spcdrift.KV_MANAGED_FILES][dropin]['stat'])
+
+        with open(dropin, mode='w') as f:
+            print('a=c', file=f)
+        with open(self.sub, mode='a') as f:
+            print('# hello', file=f)
+        with open(os.path.join(self.tempd, 'interfaces.d', 'new'),
+                  mode='w') as f:
+            print('iface eth4 inet manual', file=f)
+        self.assertEqual([dropin, os.path.join(self.tempd, 'interfaces.d'),
+                          self.sub], sorted(spcdrift.config_drift()))
+
+        # The live MTU is checked against the desired one.
+        create_fake_nic(self.tempd, 'eth3', 25000, mtu=1500)
+        create_fake_nic(self.tempd, 'eth4', 25000, mtu=9000)
+        data[spcdrift.KV_NETWORK_DESIRED] = {
+            'eth3': {'mtu': 9000},
+            'eth4': {'mtu': 9000},
+            'eth5': {'mtu': 9000},
+        }
+        self.assertEqual(['eth3'], spcdrift.mtu_drift(sysroot=self.tempd))
+
+    def test_fixup_batch(self):
+        """
+        Test that all the modified files in a directory are installed by
+        a single txn invocation.
+        """
+        other = os.path.join(self.tempd, 'interfaces.d', 'other')
+        with open(other, mode='w') as f:
+            f.write('iface eth4 inet manual\n')
+        data = {
+            'eth3': ['mtu 9000'],
+            'eth4': ['mtu 9000'],
+        }
+        spcnetwork.fixup_interfaces_file(self.main, data, set())
+        self.assertEqual(1, txn.install.call_count)
+        self.assertEqual(os.path.join(self.tempd, 'interfaces.d'),
+                         txn.install.call_args[0][-1])
+        self.assertEqual(['other', 'storage'],
+                         sorted(os.listdir(os.path.dirname(other))))
+        for fname in (self.sub, other):
+            with open(fname, mode='r') as f:
+                self.assertTrue(f.read().endswith(' inet manual\nmtu 9000\n'))
+
+
+class TestTuning(unittest.TestCase):
+    """
+    Test the NIC tuning profiles.
+    """
+    def setUp(self):
+        """
+        Create a fake sysfs tree.
+        """
+        super(TestTuning, self).setUp()
+        self.sysroot = tempfile.mkdtemp(prefix='test-tuning.')
+        self.addCleanup(shutil.rmtree, self.sysroot)
+        create_fake_nic(self.sysroot, 'eth0', 100000, numa=1, queues=8)
+        create_fake_nic(self.sysroot, 'eth1', 10000, driver='ixgbe')
+
+    def test_info(self):
+        """
+        Test the examination of the NIC hardware.
+        """
+        info = spctuning.nic_info('eth0', sysroot=self.sysroot,
+                                  ethtool=fake_ethtool)
+        self.assertEqual('mlx5_core', info['driver'])
+        self.assertEqual(100000, info['speed'])
+        self.assertEqual(8, info['queues'])
+        self.assertEqual(1, info['numa_node'])
+        self.assertEqual({'rx': 8192, 'tx': 8192}, info['rings']['max'])
+        self.assertEqual({'rx': 1024, 'tx': 1024}, info['rings']['current'])
+        self.assertEqual('on', info['coalesce']['adaptive-rx'])
+        self.assertEqual(8, info['coalesce']['rx-usecs'])
+        self.assertNotIn('stats-block-usecs', info['coalesce'])
+
+        self.assertIsNone(spctuning.nic_info('eth2', sysroot=self.sysroot,
+                                             ethtool=fake_ethtool))
+
+    def test_profiles(self):
+        """
+        Test the post-up lines generated for the various profiles.
+        """
+        def lines(iface, profile, ethtool=fake_ethtool):
+            info = spctuning.nic_info(iface, sysroot=self.sysroot,
+                                      ethtool=ethtool)
+            settings = spctuning.nic_settings(profile, info)
+            return spctuning.post_up_lines(iface, settings)
+
+        pfx = 'post-up /sbin/ethtool '
+        sfx = ' || true'
+        self.assertEqual([
+            pfx + '-A eth1 autoneg off tx off rx on' + sfx,
+            pfx + '-C eth1 rx-usecs 16' + sfx,
+            pfx + '-G eth1 rx 4096 tx 512' + sfx,
+        ], lines('eth1', 'default'))
+        self.assertEqual([
+            pfx + '-A eth0 autoneg off tx off rx on' + sfx,
+            pfx + '-C eth0 rx-usecs 16' + sfx,
+            pfx + '-G eth0 rx 8192 tx 4096' + sfx,
+        ], lines('eth0', 'default'))
+        self.assertEqual([
+            pfx + '-A eth0 autoneg off tx on rx on' + sfx,
+            pfx + '-C eth0 adaptive-rx on' + sfx,
+            pfx + '-G eth0 rx 8192 tx 8192' + sfx,
+        ], lines('eth0', 'throughput'))
+        self.assertEqual([
+            pfx + '-A eth0 autoneg off tx off rx on' + sfx,
+            pfx + '-C eth0 adaptive-rx off rx-usecs 0 rx-frames 1' + sfx,
+            pfx + '-G eth0 rx 1024 tx 512' + sfx,
+        ], lines('eth0', 'latency'))
+
+        # No coalescing support, no information about the rings
+        self.assertEqual([
+            pfx + '-A eth1 autoneg off tx off rx on' + sfx,
+            pfx + '-G eth1 rx 4096 tx 512' + sfx,
+        ], lines('eth1', 'default', ethtool=lambda option, iface: None))
+
+        # An interface that does not exist yet gets the static values
+        self.assertEqual([
+            pfx + '-A eth2 autoneg off tx off rx on' + sfx,
+            pfx + '-C eth2 rx-usecs 16' + sfx,
+            pfx + '-G eth2 rx 4096 tx 512' + sfx,
+        ], lines('eth2', 'default'))
+        self.assertEqual([
+            pfx + '-A eth2 autoneg off tx on rx on' + sfx,
+            pfx + '-C eth2 adaptive-rx on' + sfx,
+        ], lines('eth2', 'throughput'))
+
+
+class TestIRQ(unittest.TestCase):
+    """
+    Test the IRQ affinity and RPS/XPS planning.
+    """
+    def setUp(self):
+        """
+        Create a fake sysfs and procfs tree.
+        """
+        super(TestIRQ, self).setUp()
+        self.sysroot = tempfile.mkdtemp(prefix='test-irq.')
+        self.addCleanup(shutil.rmtree, self.sysroot)
+        create_fake_nic(self.sysroot, 'eth0', 100000, numa=1, queues=3)
+        create_fake_nic(self.sysroot, 'eth1', 10000, driver='ixgbe',
+                        queues=2)
+        # Make eth0 look like a PCI device
+        pcidir = os.path.join(self.sysroot, 'sys', 'devices', 'pci0000:3a',
+                              '0000:3b:00.0')
+        os.makedirs(pcidir)
+        devlink = os.path.join(self.sysroot, 'sys', 'class', 'net', 'eth0',
+                               'device')
+        for name in os.listdir(devlink):
+            os.rename(os.path.join(devlink, name),
+                      os.path.join(pcidir, name))
+        os.rmdir(devlink)
+        os.symlink(pcidir, devlink)
+
+        for (node, cpus) in (('0', '0-3'), ('1', '4-7')):
+            ndir = os.path.join(self.sysroot, 'sys', 'devices', 'system',
+                                'node', 'node' + node)
+            os.makedirs(ndir)
+            with open(os.path.join(ndir, 'cpulist'), mode='w') as f:
+                print(cpus, file=f)
+        os.makedirs(os.path.join(self.sysroot, 'proc'))
+        with open(os.path.join(self.sysroot, 'proc', 'interrupts'),
+                  mode='w') as f:
+            f.write(PROC_INTERRUPTS)
+        for irq in (41, 42, 43, 50, 51):
+            os.makedirs(os.path.join(self.sysroot, 'proc', 'irq', str(irq)))
+
+    def test_cpulist(self):
+        """
+        Test the parsing and formatting of CPU lists and masks.
+        """
+        self.assertEqual([0, 1, 2, 3, 8, 10, 11],
+                         spcirq.parse_cpulist('0-3,8,10-11\n'))
+        self.assertEqual('0-3,8,10-11',
+                         spcirq.format_cpulist([11, 0, 1, 2, 3, 8, 10]))
+        self.assertEqual('f0', spcirq.cpu_mask([4, 5, 6, 7]))
+        self.assertEqual('1,00000001', spcirq.cpu_mask([0, 32]))
+
+    def test_plan(self):
+        """
+        Test that the interrupts are spread over the local CPUs that are
+        not excluded.
+        """
+        self.assertEqual([41, 42, 43], spcirq.nic_irqs('eth0', self.sysroot))
+        self.assertEqual([50, 51], spcirq.nic_irqs('eth1', self.sysroot))
+
+        plan = spcirq.plan_nic('eth0', 1, [4, 5], sysroot=self.sysroot)
+        self.assertEqual([6, 7], plan['cpus'])
+        self.assertEqual([[41, 6], [42, 7], [43, 6]], plan['irqs'])
+        self.assertEqual([[0, 'c0'], [1, 'c0'], [2, 'c0']], plan['rps'])
+        self.assertEqual([[0, '40'], [1, '80'], [2, '40']], plan['xps'])
+
+        self.assertIsNone(spcirq.plan_nic('eth0', 1, [4, 5, 6, 7],
+                                          sysroot=self.sysroot))
+
+        self.assertEqual(0, spcirq.apply_plan(plan, sysroot=self.sysroot))
+        with open(os.path.join(self.sysroot, 'proc', 'irq', '42',
+                               'smp_affinity_list'), mode='r') as f:
+            self.assertEqual('7\n', f.read())
+        with open(os.path.join(self.sysroot, 'sys', 'class', 'net', 'eth0',
+                               'queues', 'tx-1', 'xps_cpus'), mode='r') as f:
+            self.assertEqual('80\n', f.read())
+
+        lines = spcirq.post_up_lines(plan)
+        self.assertEqual([
+            'post-up /usr/local/sbin/storpool-config-pin-irqs eth0 6 7 '
+            '|| true',
+        ], lines[:1])
+        self.assertIn('echo c0 > /sys/class/net/eth0/queues/rx-0/rps_cpus',
+                      lines[1])
+        for line in lines:
+            self.assertTrue(spcnetwork.managed_line('eth0', line), line)
+        self.assertFalse(spcnetwork.managed_line('eth1', lines[0]))
+
+        self.assertIsNone(spcirq.irqbalance_dropin([]))
+        files = spcirq.render_files([plan])
+        self.assertEqual(
+            '[Service]\nExecStart=\n'
+            'ExecStart=/usr/sbin/irqbalance --foreground $IRQBALANCE_ARGS '
+            '--policyscript=/usr/local/sbin/storpool-config-irqbalance-policy'
+            '\n', spcirq.irqbalance_dropin([plan]))
+        self.assertEqual('755', files[spcirq.POLICY_SCRIPT][1])
+        self.assertIn('\nfor iface in eth0; do\n',
+                      files[spcirq.POLICY_SCRIPT][0])
+        self.assertEqual([spcirq.IRQBALANCE_DROPIN],
+                         list(spcirq.render_files([]).keys()))
+
+    def test_pin_script(self):
+        """
+        Test that the pinning script looks the interrupts up by name when
+        it runs, so that it follows them if their numbers change.
+        """
+        script = os.path.join(self.sysroot, 'pin-irqs')
+        with open(script, mode='w') as f:
+            f.write(spcirq.render_pin_script())
+
+        def affinity(irq):
+            with open(os.path.join(self.sysroot, 'proc', 'irq', str(irq),
+                                   'smp_affinity_list'), mode='r') as f:
+                return f.read()
+
+        env = dict(os.environ, SYSROOT=self.sysroot)
+        subprocess.check_call(['sh', script, 'eth0', '6', '7'], env=env)
+        self.assertEqual(['6\n', '7\n', '6\n'],
+                         [affinity(irq) for irq in (41, 42, 43)])
+        subprocess.check_call(['sh', script, 'eth1', '3'], env=env)
+        self.assertEqual(['3\n', '3\n'],
+                         [affinity(irq) for irq in (50, 51)])
+
+        # After a reboot the queues got other interrupt numbers.
+        with open(os.path.join(self.sysroot, 'proc', 'interrupts'),
+                  mode='w') as f:
+            f.write(PROC_INTERRUPTS.replace(' 41:', ' 44:'))
+        os.makedirs(os.path.join(self.sysroot, 'proc', 'irq', '44'))
+        subprocess.check_call(['sh', script, 'eth0', '5'], env=env)
+        self.assertEqual(['6\n', '5\n', '5\n', '5\n'],
+                         [affinity(irq) for irq in (41, 42, 43, 44)])
+
+
+class TestLinkState(unittest.TestCase):
+    """
+    Test the application of the network settings to the live interfaces.
+    """
+    def setUp(self):
+        """
+        Create a fake sysfs tree.
+        """
+        super(TestLinkState, self).setUp()
+        self.sysroot = tempfile.mkdtemp(prefix='test-linkstate.')
+        self.addCleanup(shutil.rmtree, self.sysroot)
+        create_fake_nic(self.sysroot, 'eth0', 100000)
+        create_fake_nic(self.sysroot, 'eth0.100', 100000)
+        create_fake_nic(self.sysroot, 'eth1', 10000, mtu=9000)
+        create_fake_nic(self.sysroot, 'eth1.200', 10000, mtu=9000)
+
+    def test_plan(self):
+        """
+        Test that only the settings that differ are changed and that
+        the MTU changes are ordered correctly.
+        """
+        desired = {
+            'eth0': {
+                'mtu': 9000,
+                'ring': [['rx', 8192], ['tx', 1024]],
+                'coalesce': [['adaptive-rx', 'on'], ['rx-usecs', 16]],
+            },
+            'eth0.100': {'mtu': 9000},
+            'eth1': {'mtu': 1500, 'ring': [], 'coalesce': []},
+            'eth1.200': {'mtu': 1500},
+            'eth2': {'mtu': 9000},
+        }
+        changes = spclinkstate.plan_changes(desired, sysroot=self.sysroot,
+                                            ethtool=fake_ethtool)
+        self.assertEqual([
+            'link set dev eth1.200 mtu 1500',
+            'link set dev eth1 mtu 1500',
+            'link set dev eth0 mtu 9000',
+            'link set dev eth0.100 mtu 9000',
+        ], changes['ip'])
+        self.assertEqual([
+            ['/sbin/ethtool', '-G', 'eth0', 'rx', '8192'],
+            ['/sbin/ethtool', '-C', 'eth0', 'rx-usecs', '16'],
+        ], changes['ethtool'])
+
+    @mock.patch('subprocess.call')
+    @mock.patch('subprocess.Popen')
+    def test_apply(self, popen, call):
+        """
+        Test that all the MTU changes are made by a single ip invocation.
+        """
+        popen.return_value.returncode = 0
+        call.return_value = 0
+        failed = spclinkstate.apply_changes({
+            'ip': ['link set dev eth0 mtu 9000',
+                   'link set dev eth0.100 mtu 9000'],
+            'ethtool': [['/sbin/ethtool', '-G', 'eth0', 'rx', '8192']],
+        })
+        self.assertEqual(0, failed)
+        self.assertEqual(1, popen.call_count)
+        self.assertEqual(['/sbin/ip', '-force', '-batch', '-'],
+                         popen.call_args[0][0])
+        popen.return_value.communicate.assert_called_once_with(
+            b'link set dev eth0 mtu 9000\nlink set dev eth0.100 mtu 9000\n')
+        call.assert_called_once_with(
+            ['/sbin/ethtool', '-G', 'eth0', 'rx', '8192'])
+
+
+class TestInterfaceModel(unittest.TestCase):
+    """
+    Test the StorPool interface model built from SP_IFACE.
+    """
+    def setUp(self):
+        """
+        Create a fake sysfs tree with a bond.
+        """
+        super(TestInterfaceModel, self).setUp()
+        self.sysroot = tempfile.mkdtemp(prefix='test-ifspec.')
+        self.addCleanup(shutil.rmtree, self.sysroot)
+        for iface in ('eth0', 'eth1', 'eth2'):
+            create_fake_nic(self.sysroot, iface, 25000)
+        bonding = os.path.join(self.sysroot, 'sys', 'class', 'net', 'bond0',
+                               'bonding')
+        os.makedirs(bonding)
+        with open(os.path.join(bonding, 'slaves'), mode='w') as f:
+            print('eth1 eth0', file=f)
+
+    def test_model(self):
+        """
+        Test that the parents get the largest MTU their children need and
+        that the bond slaves are found.
+        """
+        devices = spcifspec.build_model(
+            'bond0.100=9000,bond0.200=1500,eth2=1500,eth2.5,eth2.5.7=2000',
+            sysroot=self.sysroot)
+        self.assertEqual(['bond0', 'bond0.100', 'bond0.200', 'eth0', 'eth1',
+                          'eth2', 'eth2.5', 'eth2.5.7'],
+                         sorted(devices.keys()))
+        self.assertEqual('bond', devices['bond0']['kind'])
+        self.assertEqual(['eth0', 'eth1'], devices['bond0']['slaves'])
+        self.assertEqual(9000, devices['bond0']['mtu'])
+        self.assertEqual(1500, devices['bond0.200']['mtu'])
+        self.assertEqual('phys', devices['eth0']['kind'])
+        self.assertEqual(9000, devices['eth0']['mtu'])
+        self.assertEqual(9000, devices['eth2']['mtu'])
+        self.assertEqual('vlan', devices['eth2.5.7']['kind'])
+        self.assertEqual('eth2.5', devices['eth2.5.7']['parent'])
+
+    @mock.patch('charmhelpers.core.unitdata.kv')
+    def test_fixup(self, kv):
+        """
+        Test that the tuning is applied to the bond slaves and that
+        the VLAN parents get the right MTU.
+        """
+        kv.return_value.get.return_value = None
+        with mock.patch.object(spcnetwork, 'fixup_interfaces_file') as fix, \
+                mock.patch.object(spctuning, 'run_ethtool') as ethtool:
+            ethtool.return_value = None
+            desired = spcnetwork.fixup_interfaces('bond0.100,bond0.200=1500',
+                                                  sysroot=self.sysroot)
+            data = fix.call_args[0][1]
+
+        self.assertEqual(['bond0', 'bond0.100', 'bond0.200', 'eth0', 'eth1'],
+                         sorted(data.keys()))
+        self.assertEqual([
+            'post-up /sbin/ip link set dev bond0 mtu 9000',
+            'post-up /sbin/ip link set dev bond0.200 mtu 1500',
+        ], data['bond0.200'])
+        self.assertEqual(['post-up /sbin/ip link set dev bond0 mtu 9000'],
+                         data['bond0'])
+        self.assertEqual('post-up /sbin/ip link set dev eth1 mtu 9000',
+                         data['eth1'][0])
+        self.assertTrue(data['eth1'][1].startswith(
+            'post-up /sbin/ethtool -A eth1 '))
+        self.assertEqual({'mtu': 9000}, desired['bond0'])
+        self.assertEqual(9000, desired['eth0']['mtu'])
+        kv.return_value.set.assert_called_with(
+            spcdrift.KV_NETWORK_DESIRED, desired)
+
+
+class TestNetplan(unittest.TestCase):
+    """
+    Test the netplan backend.
+    """
+    def setUp(self):
+        """
+        Create a fake root filesystem.
+        """
+        super(TestNetplan, self).setUp()
+        self.root = tempfile.mkdtemp(prefix='test-netplan.')
+        self.addCleanup(shutil.rmtree, self.root)
+        os.makedirs(os.path.join(self.root, 'etc', 'netplan'))
+        os.makedirs(os.path.join(self.root, 'sbin'))
+
+        txn.install.reset_mock()
+        txn.install.side_effect = lambda *args: \
+            shutil.copy(args[-2], args[-1])
+
+    def test_detect(self):
+        """
+        Test the detection of the network configuration system.
+        """
+        self.assertEqual('ifupdown',
+                         spcnetwork.detect_backend(sysroot=self.root))
+        with open(os.path.join(self.root, 'etc', 'netplan', '50-cloud.yaml'),
+                  mode='w') as f:
+            print('network: {}', file=f)
+        self.assertEqual('netplan',
+                         spcnetwork.detect_backend(sysroot=self.root))
+        with open(os.path.join(self.root, 'sbin', 'ifup'), mode='w') as f:
+            pass
+        self.assertEqual('ifupdown',
+                         spcnetwork.detect_backend(sysroot=self.root))
+
+    @mock.patch('charmhelpers.core.unitdata.kv')
+    def test_write(self, kv):
+        """
+        Test that the overlay and the hook are written only if changed.
+        """
+        kv.return_value.get.return_value = {}
+        devices = spcifspec.build_model('eth0.100=9000,eth1=1500',
+                                        sysroot=self.root)
+        data = {
+            'eth0': ['post-up /sbin/ip link set dev eth0 mtu 9000',
+                     'post-up /sbin/ethtool -G eth0 rx 4096 || true'],
+            'eth0.100': ['post-up /sbin/ip link set dev eth0.100 mtu 9000'],
+        }
+        netplan_dir = os.path.join(self.root, 'etc', 'netplan')
+        with open(os.path.join(netplan_dir, '50-cloud.yaml'),
+                  mode='w') as f:
+            yaml.safe_dump(NETPLAN_CLOUD, f)
+        overlay = os.path.join(netplan_dir, '90-sp.yaml')
+        hook = os.path.join(self.root, 'etc', 'networkd-dispatcher',
+                            'carrier.d', '50-sp')
+        with mock.patch.object(spcnetplan, 'NETPLAN_DIR', new=netplan_dir), \
+                mock.patch.object(spcnetplan, 'NETPLAN_OVERLAY',
+                                  new=overlay), \
+                mock.patch.object(spcnetplan, 'DISPATCHER_HOOK', new=hook):
+            spcnetwork.write_netplan(devices, data)
+            self.assertEqual(2, txn.install.call_count)
+            spcnetwork.write_netplan(devices, data)
+            self.assertEqual(2, txn.install.call_count)
+
+        with open(overlay, mode='r') as f:
+            self.assertEqual({
+                'network': {
+                    'version': 2,
+                    'ethernets': {
+                        'storage0': {'mtu': 9000},
+                    },
+                    'vlans': {
+                        'vlan100': {'mtu': 9000},
+                    },
+                },
+            }, yaml.safe_load(f))
+        with open(hook, mode='r') as f:
+            contents = f.read()
+        self.assertIn('\teth0)\n\t\t/sbin/ip link set dev eth0 mtu 9000\n'
+                      '\t\t/sbin/ethtool -G eth0 rx 4096 || true\n\t\t;;\n',
+                      contents)
+        self.assertEqual([['-m', '600'], ['-m', '755']],
+                         [list(call[0][4:6])
+                          for call in txn.install.call_args_list])
+
+    def test_names(self):
+        """
+        Test that the StorPool interfaces are matched with the devices
+        defined in netplan.
+        """
+        names = spcnetplan.linux_names({
+            'ethernets': {
+                'storage0': {'match': {'name': 'eth0'}},
+                'eth1': {'match': {'macaddress': '00:11:22:33:44:55'}},
+                'renamed': {'match': {'name': 'en*'}, 'set-name': 'eth2'},
+                'any': {'match': {'name': 'en*'}},
+            },
+            'bonds': {
+                'bond0': {'interfaces': ['eth1', 'renamed']},
+            },
+            'vlans': {
+                'vlan100': {'id': 100, 'link': 'storage0'},
+                'bond0.200': {'id': 200, 'link': 'bond0'},
+                'vlan300': {'id': 300, 'link': 'nonexistent'},
+            },
+        })
+        self.assertEqual({
+            'eth0': ('ethernets', 'storage0'),
+            'eth1': ('ethernets', 'eth1'),
+            'eth2': ('ethernets', 'renamed'),
+            'any': ('ethernets', 'any'),
+            'bond0': ('bonds', 'bond0'),
+            'vlan100': ('vlans', 'vlan100'),
+            'eth0.100': ('vlans', 'vlan100'),
+            'bond0.200': ('vlans', 'bond0.200'),
+            'vlan300': ('vlans', 'vlan300'),
+        }, names)
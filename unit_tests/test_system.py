@@ -0,0 +1,610 @@
+#!/usr/bin/python3
+
+"""
+A set of unit tests for the storpool-config system helpers.
+"""
+
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import unittest
+
+import mock
+
+root_path = os.path.realpath('.')
+if root_path not in sys.path:
+    sys.path.insert(0, root_path)
+
+lib_path = os.path.realpath('unit_tests/lib')
+if lib_path not in sys.path:
+    sys.path.insert(0, lib_path)
+
+from unit_tests.libhelpers import load_confighelpers
+
+from spcharms import txn
+
+(spcdpkg, spchugepages, spckmod, spclog, spcperf, spcprefetch,
+ spcstatus) = \
+    load_confighelpers('dpkg', 'hugepages', 'kmod', 'log', 'perf',
+                       'prefetch', 'status')
+
+PROC_MODULES = {
+    'storpool_bd': '12345 1 storpool_rdma, Live 0x0',
+    'storpool_rdma': '12345 0 - Live 0x0',
+    'storpool_disk': '12345 1 nvme_fake, Live 0x0',
+    'storpool_ib': '12345 1 storpool_disk, Live 0x0',
+    'storpool_held': '12345 2 - Live 0x0',
+    'nvme_fake': '12345 0 - Live 0x0',
+    'ext4': '12345 3 - Live 0x0',
+}
+
+DPKG_STATUS = '''Package: txn-install
+Status: install ok installed
+Version: 0.2.0-1
+
+Package: storpool-config
+Status: install ok installed
+Priority: optional
+Version: 18.02.1035.8c1ffd3-1ubuntu1
+Description: StorPool configuration
+ with a continuation line
+ Version: 1.0
+
+Package: storpool-beacon
+Status: deinstall ok config-files
+Version: 18.02.1035.8c1ffd3-1ubuntu1
+'''
+
+APT_MADISON = '''storpool-config | 18.02.1100.aaaaaaa-1ubuntu1 | http://r b/m
+storpool-config | 18.02.1035.8c1ffd3-1ubuntu1 | http://r b/m
+storpool-config | 18.01.900.0000000-1ubuntu1 | http://r b/m
+'''
+
+
+class TestKernelModules(unittest.TestCase):
+    """
+    Test the unloading of the StorPool kernel modules.
+    """
+    def setUp(self):
+        """
+        Create a fake /proc/modules file.
+        """
+        super(TestKernelModules, self).setUp()
+        self.tempd = tempfile.mkdtemp(prefix='test-system.')
+        self.addCleanup(shutil.rmtree, self.tempd)
+        self.modules = os.path.join(self.tempd, 'modules')
+        self.write_modules(PROC_MODULES)
+
+    def write_modules(self, mods):
+        """
+        Write out the fake /proc/modules file.
+        """
+        with open(self.modules, mode='w') as f:
+            for name in sorted(mods):
+                print('{name} {data}'.format(name=name, data=mods[name]),
+                      file=f)
+
+    def test_order(self):
+        """
+        Test that the modules are unloaded users first and that the ones
+        that cannot be unloaded are reported.
+        """
+        mods = spckmod.read_modules(self.modules)
+        self.assertEqual(['storpool_rdma'], mods['storpool_bd']['used_by'])
+        (order, blocked) = spckmod.unload_order(
+            mods,
+            [name for name in mods if name.startswith('storpool_')])
+        self.assertEqual(['storpool_rdma', 'storpool_bd'], order)
+        self.assertEqual(set(['storpool_disk', 'storpool_ib',
+                              'storpool_held']),
+                         set(blocked.keys()))
+        self.assertEqual('used by nvme_fake', blocked['storpool_disk'])
+        self.assertEqual('used by storpool_disk', blocked['storpool_ib'])
+
+    @mock.patch('subprocess.call')
+    def test_unload(self, call):
+        """
+        Test that all the removable modules are unloaded at once.
+        """
+        def rmmod(cmd):
+            self.assertEqual(['rmmod', '--', 'storpool_rdma', 'storpool_bd'],
+                             cmd)
+            self.write_modules(dict(filter(lambda item: item[0] not in cmd,
+                                           PROC_MODULES.items())))
+            return 0
+
+        call.side_effect = rmmod
+        report = spckmod.unload_modules(path=self.modules, delay=0)
+        self.assertEqual(1, call.call_count)
+        self.assertEqual(['storpool_rdma', 'storpool_bd'], report['removed'])
+        self.assertEqual(['storpool_disk', 'storpool_held', 'storpool_ib'],
+                         sorted(report['remaining'].keys()))
+        self.assertEqual('in use, reference count 2',
+                         report['remaining']['storpool_held']['reason'])
+
+
+class TestDpkg(unittest.TestCase):
+    """
+    Test the dpkg status database lookups.
+    """
+    def setUp(self):
+        """
+        Create a fake dpkg status file.
+        """
+        super(TestDpkg, self).setUp()
+        self.tempd = tempfile.mkdtemp(prefix='test-dpkg.')
+        self.addCleanup(shutil.rmtree, self.tempd)
+        self.status = os.path.join(self.tempd, 'status')
+        with open(self.status, mode='w') as f:
+            f.write(DPKG_STATUS)
+
+    def test_parse(self):
+        """
+        Test that only the installed packages are returned.
+        """
+        self.assertEqual({
+            'txn-install': '0.2.0-1',
+            'storpool-config': '18.02.1035.8c1ffd3-1ubuntu1',
+        }, spcdpkg.parse_status(DPKG_STATUS))
+
+    def test_missing(self):
+        """
+        Test the version matching and the caching of the status file.
+        """
+        def missing(pkgs):
+            return sorted(spcdpkg.missing(pkgs, path=self.status).keys())
+
+        self.assertEqual([], missing({
+            'txn-install': '*',
+            'storpool-config': '18.02',
+        }))
+        self.assertEqual([], missing({
+            'storpool-config': '18.02.1035.8c1ffd3-1ubuntu1',
+        }))
+        self.assertEqual(['storpool-beacon', 'storpool-config'], missing({
+            'storpool-beacon': '*',
+            'storpool-config': '18.0',
+            'txn-install': '0.2.0',
+        }))
+
+        with mock.patch.object(spcdpkg, 'parse_status') as parse:
+            parse.return_value = {}
+            self.assertEqual([], missing({'txn-install': '*'}))
+            self.assertEqual(0, parse.call_count)
+
+            with open(self.status, mode='a') as f:
+                f.write('\n')
+            self.assertEqual(['txn-install'], missing({'txn-install': '*'}))
+            self.assertEqual(1, parse.call_count)
+
+
+class MockKV(object):
+    """
+    A trivial in-memory replacement for the unitdata key/value store.
+    """
+    def __init__(self):
+        self.data = {}
+
+    def get(self, key, default=None):
+        return self.data.get(key, default)
+
+    def set(self, key, value):
+        self.data[key] = value
+
+    def unset(self, key):
+        self.data.pop(key, None)
+
+
+class TestPrefetch(unittest.TestCase):
+    """
+    Test the background package downloads.
+    """
+    def setUp(self):
+        """
+        Create a fake /proc directory.
+        """
+        super(TestPrefetch, self).setUp()
+        self.tempd = tempfile.mkdtemp(prefix='test-prefetch.')
+        self.addCleanup(shutil.rmtree, self.tempd)
+        self.kv = MockKV()
+
+    def fake_process(self, pid, args):
+        """
+        Create a /proc/<pid>/cmdline file.
+        """
+        pdir = os.path.join(self.tempd, 'proc', str(pid))
+        os.makedirs(pdir)
+        with open(os.path.join(pdir, 'cmdline'), mode='wb') as f:
+            f.write(b'\0'.join(arg.encode() for arg in args) + b'\0')
+
+    def test_running(self):
+        """
+        Test that only our apt-get runs are recognized.
+        """
+        procroot = os.path.join(self.tempd, 'proc')
+        self.fake_process(100, ['/usr/bin/apt-get', 'install',
+                                '--download-only', 'foo'])
+        self.fake_process(101, ['apt-get', 'install', 'foo'])
+        self.fake_process(102, ['vim', 'apt-get', '--download-only'])
+        self.assertTrue(spcprefetch.running(100, procroot=procroot))
+        self.assertFalse(spcprefetch.running(101, procroot=procroot))
+        self.assertFalse(spcprefetch.running(102, procroot=procroot))
+        self.assertFalse(spcprefetch.running(103, procroot=procroot))
+
+    @mock.patch('subprocess.Popen')
+    @mock.patch('subprocess.check_output')
+    def test_start(self, check_output, popen):
+        """
+        Test that the right versions are downloaded, and only once.
+        """
+        check_output.return_value = APT_MADISON.encode()
+        popen.return_value.pid = 4242
+        packages = {
+            'txn-install': '*',
+            'storpool-config': '18.02',
+        }
+        log = os.path.join(self.tempd, 'log', 'prefetch.log')
+        kv = self.kv
+        with mock.patch('charmhelpers.core.unitdata.kv', new=lambda: kv), \
+                mock.patch.object(spcprefetch, 'PREFETCH_LOG', new=log), \
+                mock.patch.object(spcprefetch, 'running') as running:
+            running.return_value = False
+            self.assertTrue(spcprefetch.start(packages))
+            self.assertEqual(['apt-get', 'install', '--download-only', '-y',
+                              '-q', '--',
+                              'storpool-config=18.02.1100.aaaaaaa-1ubuntu1',
+                              'txn-install'], popen.call_args[0][0])
+            self.assertEqual(4242, self.kv.get(spcprefetch.KV_PREFETCH)['pid'])
+            self.assertFalse(spcprefetch.start(packages))
+            self.assertEqual(1, popen.call_count)
+
+            # Nothing to wait for.
+            self.assertTrue(spcprefetch.wait(timeout=0))
+            running.return_value = True
+            self.assertFalse(spcprefetch.wait(timeout=0))
+
+            # A different version replaces the running download.
+            with mock.patch('os.kill') as kill:
+                self.assertFalse(spcprefetch.start({'storpool-config': '19'}))
+                kill.assert_called_once_with(4242, spcprefetch.signal.SIGTERM)
+            self.assertIsNone(self.kv.get(spcprefetch.KV_PREFETCH))
+            self.assertEqual(1, popen.call_count)
+
+
+class TestPerf(unittest.TestCase):
+    """
+    Test the hook performance measurements.
+    """
+    def setUp(self):
+        """
+        Create a temporary directory for the performance log.
+        """
+        super(TestPerf, self).setUp()
+        spcperf._counters['atexit'] = False
+        self.tempd = tempfile.mkdtemp(prefix='test-perf.')
+        self.addCleanup(shutil.rmtree, self.tempd)
+
+    def test_disabled(self):
+        """
+        Test that nothing is recorded outside of a Juju unit.
+        """
+        @spcperf.stage('nothing')
+        def handler():
+            return 42
+
+        with mock.patch.dict(os.environ, clear=True), \
+                mock.patch.object(spcperf, 'PERF_LOG_DIR', new=self.tempd):
+            self.assertEqual(42, handler())
+            self.assertEqual([], spcperf._records)
+        self.assertEqual('handler', handler.__name__)
+        self.assertTrue(handler._action_id.endswith(':handler'))
+
+    @mock.patch('charmhelpers.core.hookenv.atexit')
+    @mock.patch('charmhelpers.core.hookenv.hook_name')
+    def test_record(self, hook_name, atexit):
+        """
+        Test that the stages are measured and summarized.
+        """
+        hook_name.return_value = 'config-changed'
+
+        @spcperf.stage('outer')
+        def handler():
+            with spcperf.measure('inner', procs=1):
+                spcperf.count_procs()
+                # Not started by us, not counted.
+                subprocess.call(['true'])
+            with open(os.path.join(self.tempd, 'data'), mode='w') as f:
+                f.write('x' * 4096)
+
+        with mock.patch.dict(os.environ, {'JUJU_UNIT_NAME': 'storpool/0'}), \
+                mock.patch.object(spcperf, 'PERF_LOG_DIR', new=self.tempd):
+            real_popen = subprocess.Popen
+            handler()
+            handler()
+            self.assertEqual(1, atexit.call_count)
+            spcperf.flush()
+            self.assertEqual([], spcperf._records)
+            path = spcperf.log_path()
+            self.assertIs(real_popen, subprocess.Popen)
+
+        self.assertEqual(os.path.join(self.tempd,
+                                      'storpool-config-perf-storpool-0.jsonl'),
+                         path)
+        records = spcperf.read_log(path)
+        self.assertEqual(['inner', 'outer', 'inner', 'outer'],
+                         [rec['stage'] for rec in records])
+        self.assertEqual('outer', records[0]['parent'])
+        self.assertEqual(4, len(spcperf.read_log(path, hooks=1)))
+
+        summary = spcperf.summarize(records)
+        self.assertEqual(2, summary['outer']['runs'])
+        self.assertEqual(4, summary['outer']['procs'])
+        self.assertEqual(4, summary['inner']['procs'])
+        self.assertGreaterEqual(summary['outer']['written'], 2 * 4096)
+        self.assertTrue(spcperf.format_summary(summary).startswith('outer: '))
+
+
+class TestStatus(unittest.TestCase):
+    """
+    Test the coalescing of the unit status updates.
+    """
+    def setUp(self):
+        """
+        Forget about any status updates made by other tests.
+        """
+        super(TestStatus, self).setUp()
+        spcstatus._state.update({
+            'current': None,
+            'sent': None,
+            'sent_at': None,
+            'registered': False,
+        })
+
+    @mock.patch('spcharms.status.npset')
+    def test_disabled(self, npset):
+        """
+        Test that the updates are passed on right away outside of a unit.
+        """
+        with mock.patch.dict(os.environ, clear=True):
+            spcstatus.npset('maintenance', 'one')
+            spcstatus.npset('maintenance', 'two')
+        self.assertEqual([mock.call('maintenance', 'one'),
+                          mock.call('maintenance', 'two')],
+                         npset.call_args_list)
+
+    @mock.patch('time.time')
+    @mock.patch('spcharms.status.npset')
+    def test_coalesce(self, npset, now):
+        """
+        Test that only the last status and the rate-limited long-running
+        steps are passed on to Juju.
+        """
+        now.return_value = 1000.0
+        with mock.patch.dict(os.environ, {'JUJU_UNIT_NAME': 'storpool/0'}):
+            spcstatus.npset('maintenance', 'obtaining the version')
+            spcstatus.npset('maintenance', 'installing', immediate=True)
+            self.assertEqual([mock.call('maintenance', 'installing')],
+                             npset.call_args_list)
+
+            # Too soon after the last one.
+            now.return_value = 1005.0
+            spcstatus.npset('maintenance', 'applying', immediate=True)
+            self.assertEqual(1, npset.call_count)
+            spcstatus.npset('maintenance', '')
+            self.assertEqual(1, npset.call_count)
+            spcstatus.flush()
+            self.assertEqual(2, npset.call_count)
+            self.assertEqual(mock.call('maintenance', ''), npset.call_args)
+
+            # Nothing new to send.
+            spcstatus.flush()
+            self.assertEqual(2, npset.call_count)
+
+            # The same status is not sent again.
+            now.return_value = 1100.0
+            spcstatus.npset('maintenance', '', immediate=True)
+            spcstatus.flush()
+            self.assertEqual(2, npset.call_count)
+
+    @mock.patch('charmhelpers.core.hookenv.atexit')
+    @mock.patch('charmhelpers.core.hookenv.hook_name')
+    @mock.patch('spcharms.status.npset')
+    def test_stage_flush(self, npset, hook_name, atexit):
+        """
+        Test that the last status is sent as soon as each handler returns,
+        so that the ones set by later handlers are not overwritten.
+        """
+        @spcperf.stage('first')
+        def first():
+            spcstatus.npset('maintenance', 'one')
+            spcstatus.npset('maintenance', 'two')
+
+        @spcperf.stage('failing')
+        def failing():
+            spcstatus.npset('blocked', 'three')
+            raise ValueError('three')
+
+        hook_name.return_value = 'config-changed'
+        with mock.patch.dict(os.environ, {'JUJU_UNIT_NAME': 'storpool/0'}):
+            first()
+            self.assertEqual([mock.call('maintenance', 'two')],
+                             npset.call_args_list)
+
+            # Another layer's handler sets its own status.
+            npset('active', 'other')
+
+            self.assertRaises(ValueError, failing)
+            self.assertEqual(mock.call('blocked', 'three'), npset.call_args)
+            self.assertEqual(3, npset.call_count)
+            spcstatus.flush()
+            self.assertEqual(3, npset.call_count)
+        del spcperf._records[:]
+
+
+class TestLog(unittest.TestCase):
+    """
+    Test the level-gated diagnostic logging.
+    """
+    def setUp(self):
+        """
+        Forget about the verbosity level.
+        """
+        super(TestLog, self).setUp()
+        spclog._state.update({'level': None})
+
+    @mock.patch('spcharms.utils.rdebug')
+    def test_levels(self, rdebug):
+        """
+        Test that the messages are only formatted if they will be logged.
+        """
+        class Expensive(object):
+            formatted = 0
+
+            def __format__(self, spec):
+                Expensive.formatted += 1
+                return 'expensive'
+
+        cfg = mock.Mock()
+        cfg.get.return_value = 'info'
+        with mock.patch.dict(os.environ, clear=True), \
+                mock.patch('spcharms.config.m', return_value=cfg):
+            spclog.rdebug('dump: {obj}', obj=Expensive())
+            spclog.rdebug('{cnt} thing(s)', cnt=2, level=spclog.INFO)
+            spclog.rdebug('no {braces} here', level=spclog.INFO)
+        self.assertEqual(0, Expensive.formatted)
+        self.assertEqual([mock.call('2 thing(s)', prefix='config'),
+                          mock.call('no {braces} here', prefix='config')],
+                         rdebug.call_args_list)
+
+        spclog._state['level'] = spclog.TRACE
+        with mock.patch.dict(os.environ, clear=True):
+            spclog.rdebug('dump: {obj}', obj=Expensive(), level=spclog.TRACE)
+        self.assertEqual(1, Expensive.formatted)
+        self.assertEqual(mock.call('dump: expensive', prefix='config'),
+                         rdebug.call_args)
+
+    @mock.patch('spcharms.utils.rdebug')
+    def test_lines(self, rdebug):
+        """
+        Test that each line of a message is passed on separately.
+        """
+        spclog._state['level'] = spclog.DEBUG
+        with mock.patch.dict(os.environ, {'JUJU_UNIT_NAME': 'storpool/0'}):
+            spclog.rdebug('line {idx}', idx=0)
+            spclog.rdebug('two\nlines')
+        self.assertEqual([mock.call('line 0', prefix='config'),
+                          mock.call('two', prefix='config'),
+                          mock.call('lines', prefix='config')],
+                         rdebug.call_args_list)
+
+
+class TestHugepages(unittest.TestCase):
+    """
+    Test the hugepages reservation.
+    """
+    def setUp(self):
+        """
+        Create a fake sysfs tree with two NUMA nodes.
+        """
+        super(TestHugepages, self).setUp()
+        self.sysroot = tempfile.mkdtemp(prefix='test-hugepages.')
+        self.addCleanup(shutil.rmtree, self.sysroot)
+        for node in (0, 1):
+            path = spchugepages.nr_hugepages_path(node, self.sysroot)
+            os.makedirs(os.path.dirname(path))
+            with open(path, mode='w') as f:
+                print(16 if node == 1 else 0, file=f)
+        os.makedirs(os.path.join(self.sysroot, 'sys', 'devices', 'system',
+                                 'node', 'power'))
+        os.makedirs(os.path.join(self.sysroot, 'proc', 'sys', 'vm'))
+
+    def test_plan(self):
+        """
+        Test that the pages are spread evenly over the NUMA nodes.
+        """
+        self.assertIsNone(spchugepages.plan({}, sysroot=self.sysroot))
+        self.assertEqual({
+            'page_kb': 2048,
+            'total': 4098,
+            'nodes': {0: 2049, 1: 2049},
+        }, spchugepages.plan({
+            'SP_CACHE_SIZE': '4097',
+            'SP_SERVER_INSTANCES': '2',
+        }, sysroot=self.sysroot))
+        self.assertEqual({None: 50}, spchugepages.plan({
+            'SP_CACHE_SIZE': '100',
+        }, sysroot=os.path.join(self.sysroot, 'nonexistent'))['nodes'])
+        with self.assertRaises(ValueError):
+            spchugepages.plan({'SP_CACHE_SIZE': 'lots'})
+
+    def test_reserve(self):
+        """
+        Test the runtime reservation and the report of any shortfall.
+        """
+        hplan = spchugepages.plan({'SP_CACHE_SIZE': '64'},
+                                  sysroot=self.sysroot)
+        self.assertEqual({0: 16, 1: 16}, hplan['nodes'])
+        report = spchugepages.reserve(hplan, sysroot=self.sysroot)
+        self.assertEqual({
+            0: {'wanted': 16, 'reserved': 16},
+            1: {'wanted': 16, 'reserved': 16},
+        }, report)
+        self.assertEqual(0, spchugepages.shortfall(report))
+        with open(os.path.join(self.sysroot, 'proc', 'sys', 'vm',
+                               'compact_memory'), mode='r') as f:
+            self.assertEqual('1\n', f.read())
+
+        # Only 20 pages could be found on node 0.
+        real_write_sys = spchugepages.write_sys
+
+        def short_write(path, value):
+            if path.endswith('nr_hugepages') and '/node0/' in path:
+                value = min(value, 20)
+            return real_write_sys(path, value)
+
+        hplan = spchugepages.plan({'SP_CACHE_SIZE': '128'},
+                                  sysroot=self.sysroot)
+        with mock.patch.object(spchugepages, 'write_sys',
+                               side_effect=short_write):
+            report = spchugepages.reserve(hplan, sysroot=self.sysroot)
+        self.assertEqual({'wanted': 32, 'reserved': 20}, report[0])
+        self.assertEqual(12, spchugepages.shortfall(report))
+
+    @mock.patch('subprocess.call')
+    def test_persist(self, call):
+        """
+        Test that the snippets are only installed when needed.
+        """
+        sysctl = os.path.join(self.sysroot, 'etc', 'sysctl.d', 'hp.conf')
+        grub = os.path.join(self.sysroot, 'etc', 'default', 'grub.d',
+                            'hp.cfg')
+        txn.install.reset_mock()
+        txn.install.side_effect = lambda *args: \
+            shutil.copy(args[-2], args[-1])
+        self.addCleanup(setattr, txn.install, 'side_effect', None)
+
+        with mock.patch.object(spchugepages, 'SYSCTL_SNIPPET', new=sysctl), \
+                mock.patch.object(spchugepages, 'GRUB_SNIPPET', new=grub):
+            spchugepages.persist(None)
+            self.assertEqual(0, txn.install.call_count)
+
+            hplan = {'page_kb': 2048, 'total': 32, 'nodes': {0: 32}}
+            spchugepages.persist(hplan)
+            self.assertEqual(2, txn.install.call_count)
+            self.assertEqual([mock.call(['update-grub'])],
+                             call.call_args_list)
+            with open(sysctl, mode='r') as f:
+                self.assertTrue(f.read().endswith(
+                    '\nvm.nr_hugepages = 32\n'))
+            with open(grub, mode='r') as f:
+                self.assertIn(' hugepagesz=2M hugepages=32"', f.read())
+
+            spchugepages.persist(hplan)
+            self.assertEqual(2, txn.install.call_count)
+
+            spchugepages.persist(None)
+            self.assertEqual(4, txn.install.call_count)
+            with open(sysctl, mode='r') as f:
+                self.assertNotIn('vm.nr_hugepages', f.read())